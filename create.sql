@@ -1,11 +1,43 @@
+DROP TABLE IF EXISTS hemnet_item_images;
+
+DROP TABLE IF EXISTS hemnet_item_details;
+
 DROP TABLE IF EXISTS hemnet_items;
 
 DROP TABLE IF EXISTS hemnet_comp_items;
 
+DROP TABLE IF EXISTS houm_matches;
+
 DROP TABLE IF EXISTS houm_favorites;
 
 DROP TABLE IF EXISTS houm_users;
 
+DROP TABLE IF EXISTS hemnet_broker_rollups;
+
+DROP TABLE IF EXISTS hemnet_area_rollups;
+
+DROP TABLE IF EXISTS hemnet_valuations;
+
+DROP TABLE IF EXISTS hemnet_item_lsh;
+
+DROP TABLE IF EXISTS hemnet_item_vectors;
+
+DROP TABLE IF EXISTS hemnet_listing_changes;
+
+DROP TABLE IF EXISTS hemnet_listing_links;
+
+DROP TABLE IF EXISTS hemnet_detections;
+
+DROP TABLE IF EXISTS crawl_frontier;
+
+DROP TABLE IF EXISTS crawl_rate_buckets;
+
+DROP TABLE IF EXISTS crawl_retry_queue;
+
+DROP TABLE IF EXISTS crawl_quota_usage;
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 --
 --
 CREATE TABLE hemnet_items (
@@ -36,13 +68,16 @@ CREATE TABLE hemnet_items (
     lot_size INTEGER,
     biarea INTEGER,
     address VARCHAR DEFAULT '',
+    address_street VARCHAR,
+    address_number VARCHAR,
+    address_unit VARCHAR,
+    address_key VARCHAR,
     geographic_area VARCHAR DEFAULT '',
     latitude FLOAT,
     longitude FLOAT,
     collected_at DATE,
     -- defaults to datetime.now() but stored as DATE
     title VARCHAR,
-    description TEXT,
     housing_form VARCHAR,
     tenure VARCHAR,
     days_on_hemnet INTEGER,
@@ -55,14 +90,28 @@ CREATE TABLE hemnet_items (
     bidding_started BOOLEAN,
     published_at TIMESTAMP,
     times_viewed INTEGER,
-    verified_bidding JSONB,
-    listing_broker_url VARCHAR,
-    listing_broker_gallery_url VARCHAR,
     post_code VARCHAR,
     municipality_name VARCHAR,
     region_name VARCHAR,
     county_name VARCHAR,
     districts JSONB,
+    housing_cooperative_name VARCHAR,
+    yearly_arrende_fee INTEGER,
+    yearly_leasehold_fee INTEGER,
+    land_area FLOAT,
+    supplemental_area FLOAT,
+    closest_water_distance_meters INTEGER,
+    coastline_distance_meters INTEGER
+);
+
+-- Cold side tables for hemnet_items: large text/JSON and image bytes live here
+-- so scans and aggregates over hemnet_items stay on narrow pages.
+CREATE TABLE hemnet_item_details (
+    item_id BIGINT PRIMARY KEY REFERENCES hemnet_items(id) ON DELETE CASCADE,
+    description TEXT,
+    verified_bidding JSONB,
+    listing_broker_url VARCHAR,
+    listing_broker_gallery_url VARCHAR,
     labels JSONB,
     relevant_amenities JSONB,
     listing_collection_ids JSONB,
@@ -82,21 +131,21 @@ CREATE TABLE hemnet_items (
     active_package JSONB,
     seller_package_recommendation JSONB,
     housing_cooperative JSONB,
-    housing_cooperative_name VARCHAR,
-    yearly_arrende_fee INTEGER,
-    yearly_leasehold_fee INTEGER,
-    land_area FLOAT,
     formatted_land_area VARCHAR,
     formatted_living_area VARCHAR,
     formatted_supplemental_area VARCHAR,
-    supplemental_area FLOAT,
     formatted_floor VARCHAR,
-    closest_water_distance_meters INTEGER,
-    coastline_distance_meters INTEGER,
     raw_listing JSONB,
     raw_apollo_state JSONB,
     broker_raw JSONB,
     broker_agency_raw JSONB,
+    -- Swedish full-text vector over the listing title (weight A) and
+    -- description (weight B), maintained by the triggers below.
+    search_vector TSVECTOR
+);
+
+CREATE TABLE hemnet_item_images (
+    item_id BIGINT PRIMARY KEY REFERENCES hemnet_items(id) ON DELETE CASCADE,
     main_image_url VARCHAR,
     main_image_bytes BYTEA,
     main_image_mime VARCHAR,
@@ -144,6 +193,54 @@ CREATE TABLE hemnet_comp_items (
     collected_at DATE
 );
 
+-- Weekly rollups of hemnet_items, kept up to date by HemnetPipeline and
+-- rebuilt with `python -m hemnet.rollups rebuild`. Averages are total / count.
+CREATE TABLE hemnet_broker_rollups (
+    broker_email VARCHAR NOT NULL,
+    broker_firm VARCHAR NOT NULL,
+    type VARCHAR NOT NULL,
+    week DATE NOT NULL,
+    items INTEGER NOT NULL DEFAULT 0,
+    price_total BIGINT NOT NULL DEFAULT 0,
+    priced_items INTEGER NOT NULL DEFAULT 0,
+    asked_price_total BIGINT NOT NULL DEFAULT 0,
+    asked_priced_items INTEGER NOT NULL DEFAULT 0,
+    square_meters_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_items INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (broker_email, broker_firm, type, week)
+);
+
+CREATE TABLE hemnet_area_rollups (
+    municipality_name VARCHAR NOT NULL,
+    geographic_area VARCHAR NOT NULL,
+    type VARCHAR NOT NULL,
+    week DATE NOT NULL,
+    items INTEGER NOT NULL DEFAULT 0,
+    price_total BIGINT NOT NULL DEFAULT 0,
+    priced_items INTEGER NOT NULL DEFAULT 0,
+    asked_price_total BIGINT NOT NULL DEFAULT 0,
+    asked_priced_items INTEGER NOT NULL DEFAULT 0,
+    square_meters_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_items INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (municipality_name, geographic_area, type, week)
+);
+
+-- Comparable-sales estimates for active listings, written by
+-- `python -m hemnet.valuation`. item_id is hemnet_items.id.
+CREATE TABLE hemnet_valuations (
+    item_id BIGINT PRIMARY KEY,
+    valued_at TIMESTAMP,
+    asked_price INTEGER,
+    price_per_sqm FLOAT,
+    estimated_price INTEGER,
+    price_low INTEGER,
+    price_high INTEGER,
+    comparables INTEGER NOT NULL DEFAULT 0,
+    effective_comparables FLOAT
+);
+
 CREATE TABLE houm_users (
     id BIGSERIAL PRIMARY KEY,
     name VARCHAR NOT NULL,
@@ -176,3 +273,213 @@ CREATE TABLE houm_favorites (
     created_at TIMESTAMP DEFAULT NOW(),
     PRIMARY KEY (user_id, hemnet_id)
 );
+
+-- Active listings matching a user's hard preferences, written by HemnetPipeline
+-- and `python -m hemnet.matching rematch`. score counts satisfied soft preferences.
+CREATE TABLE houm_matches (
+    user_id BIGINT NOT NULL REFERENCES houm_users(id) ON DELETE CASCADE,
+    hemnet_id BIGINT NOT NULL,
+    score INTEGER NOT NULL DEFAULT 0,
+    matched_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (user_id, hemnet_id)
+);
+
+-- "More like this" index over active listings (hemnet/similarity.py): one
+-- float16 feature vector per listing and its random-hyperplane LSH buckets.
+CREATE TABLE hemnet_item_vectors (
+    hemnet_id BIGINT PRIMARY KEY,
+    vector BYTEA NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE hemnet_item_lsh (
+    band INTEGER NOT NULL,
+    bucket BIGINT NOT NULL,
+    hemnet_id BIGINT NOT NULL,
+    PRIMARY KEY (band, bucket, hemnet_id)
+);
+
+CREATE INDEX ix_hemnet_item_lsh_hemnet_id ON hemnet_item_lsh (hemnet_id);
+
+-- Append-only change history of active listings (hemnet/timeline.py). changes
+-- holds only the fields that differ from the previous observation, or the full
+-- tracked state on keyframe rows.
+CREATE TABLE hemnet_listing_changes (
+    hemnet_id BIGINT NOT NULL,
+    observed_at TIMESTAMP NOT NULL,
+    seq INTEGER NOT NULL,
+    keyframe BOOLEAN NOT NULL DEFAULT FALSE,
+    changes JSONB NOT NULL,
+    asked_price INTEGER,
+    price_delta INTEGER,
+    PRIMARY KEY (hemnet_id, observed_at)
+);
+
+-- Sold hemnet_items rows linked to the active listing they were sold from
+-- (hemnet/linkage.py), with the prices needed for asking-vs-final analysis.
+CREATE TABLE hemnet_listing_links (
+    sold_item_id BIGINT PRIMARY KEY,
+    active_item_id BIGINT NOT NULL UNIQUE,
+    sold_hemnet_id BIGINT,
+    active_hemnet_id BIGINT,
+    confidence FLOAT NOT NULL,
+    evidence VARCHAR,
+    distance_m FLOAT,
+    asked_price INTEGER,
+    sold_price INTEGER,
+    sold_date DATE,
+    days_listed INTEGER,
+    linked_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE INDEX ix_hemnet_listing_links_active_hemnet_id ON hemnet_listing_links (active_hemnet_id);
+
+-- Publication, detection and commit time of listings found in watch mode
+-- (hemnet/watch.py).
+CREATE TABLE hemnet_detections (
+    hemnet_id BIGINT PRIMARY KEY,
+    published_at TIMESTAMP,
+    detected_at TIMESTAMP NOT NULL,
+    stored_at TIMESTAMP NOT NULL,
+    detection_secs FLOAT
+);
+
+CREATE INDEX ix_hemnet_detections_detected_at ON hemnet_detections (detected_at);
+
+-- Shared crawl frontier leased by scrapyd workers (hemnet/frontier.py).
+CREATE TABLE crawl_frontier (
+    crawl VARCHAR NOT NULL,
+    fingerprint VARCHAR(64) NOT NULL,
+    url TEXT NOT NULL,
+    request BYTEA NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_by VARCHAR,
+    lease_expires_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (crawl, fingerprint)
+);
+
+CREATE INDEX ix_crawl_frontier_next ON crawl_frontier (crawl, priority, created_at) WHERE state IN ('pending', 'leased');
+
+-- Token buckets shared by all crawler processes (hemnet/ratelimit.py).
+CREATE TABLE crawl_rate_buckets (
+    name VARCHAR PRIMARY KEY,
+    rate DOUBLE PRECISION NOT NULL,
+    burst DOUBLE PRECISION NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+-- Blocked or failed requests waiting for another attempt (hemnet/blocking.py).
+CREATE TABLE crawl_retry_queue (
+    spider VARCHAR NOT NULL,
+    fingerprint VARCHAR(64) NOT NULL,
+    url TEXT NOT NULL,
+    request BYTEA NOT NULL,
+    reason VARCHAR,
+    blocked_by JSON,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    state VARCHAR(16) NOT NULL DEFAULT 'waiting',
+    next_attempt_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (spider, fingerprint)
+);
+
+CREATE INDEX ix_crawl_retry_queue_due ON crawl_retry_queue (spider, next_attempt_at) WHERE state = 'waiting';
+
+-- Requests sent per request class and day, for the daily quotas (hemnet/priority.py).
+CREATE TABLE crawl_quota_usage (
+    day DATE NOT NULL,
+    request_class VARCHAR(16) NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, request_class)
+);
+
+CREATE INDEX ix_hemnet_listing_changes_price_cuts ON hemnet_listing_changes (observed_at) WHERE price_delta < 0;
+
+CREATE INDEX ix_hemnet_items_hemnet_id ON hemnet_items (hemnet_id);
+
+-- Broker aggregates (top seller, objects sold per area and period) and the
+-- same-name/different-email self join.
+CREATE INDEX ix_hemnet_items_broker_email_sold_date_price ON hemnet_items (broker_email, sold_date, price);
+
+CREATE INDEX ix_hemnet_items_broker_name_email ON hemnet_items (broker_name, broker_email);
+
+-- ORDER BY sold_date / price ... LIMIT and rooms BETWEEN filters.
+CREATE INDEX ix_hemnet_items_sold_date ON hemnet_items (sold_date);
+
+CREATE INDEX ix_hemnet_items_price ON hemnet_items (price);
+
+CREATE INDEX ix_hemnet_items_rooms ON hemnet_items (rooms);
+
+-- Substring search: geographic_area LIKE '%Göteborg%', address LIKE '%...%'.
+CREATE INDEX ix_hemnet_items_geographic_area_trgm ON hemnet_items USING GIN (geographic_area gin_trgm_ops);
+
+CREATE INDEX ix_hemnet_items_address_trgm ON hemnet_items USING GIN (address gin_trgm_ops);
+
+-- "All sales at this address": exact lookups on the normalized building key
+-- (hemnet/address.py) and trigram matching for misspelt queries.
+CREATE INDEX ix_hemnet_items_address_key ON hemnet_items (address_key);
+
+CREATE INDEX ix_hemnet_items_address_key_trgm ON hemnet_items USING GIN (address_key gin_trgm_ops);
+
+-- Full-text search (hemnet/search.py). The title lives on the hot table and
+-- the description on the cold one, so the vector cannot be a plain generated
+-- column; it is computed when the details row is written and refreshed when
+-- the title of an existing listing changes.
+CREATE OR REPLACE FUNCTION hemnet_item_search_vector(title TEXT, description TEXT)
+RETURNS TSVECTOR LANGUAGE SQL IMMUTABLE AS $$
+    SELECT setweight(to_tsvector('swedish', coalesce(title, '')), 'A')
+        || setweight(to_tsvector('swedish', coalesce(description, '')), 'B')
+$$;
+
+CREATE OR REPLACE FUNCTION hemnet_item_details_search() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.search_vector := hemnet_item_search_vector(
+        (SELECT title FROM hemnet_items WHERE id = NEW.item_id),
+        NEW.description
+    );
+    RETURN NEW;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION hemnet_items_title_search() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE hemnet_item_details
+    SET search_vector = hemnet_item_search_vector(NEW.title, description)
+    WHERE item_id = NEW.id;
+    RETURN NULL;
+END
+$$;
+
+CREATE TRIGGER hemnet_item_details_search
+    BEFORE INSERT OR UPDATE OF description ON hemnet_item_details
+    FOR EACH ROW EXECUTE FUNCTION hemnet_item_details_search();
+
+CREATE TRIGGER hemnet_items_title_search
+    AFTER UPDATE OF title ON hemnet_items
+    FOR EACH ROW WHEN (OLD.title IS DISTINCT FROM NEW.title)
+    EXECUTE FUNCTION hemnet_items_title_search();
+
+CREATE INDEX ix_hemnet_item_details_search_vector ON hemnet_item_details USING GIN (search_vector);
+
+CREATE INDEX ix_hemnet_comp_items_salda_id ON hemnet_comp_items (salda_id);
+
+CREATE INDEX ix_hemnet_comp_items_hemnet_id ON hemnet_comp_items (hemnet_id);
+
+-- BRIN indexes on the append-mostly time columns; a few pages cover the whole
+-- table and let date-range filters skip blocks. See
+-- migrations/002_partition_by_month.sql for the optional partitioned layout.
+CREATE INDEX hemnet_items_sold_date_brin ON hemnet_items USING BRIN (sold_date);
+
+CREATE INDEX hemnet_items_collected_at_brin ON hemnet_items USING BRIN (collected_at);
+
+CREATE INDEX hemnet_comp_items_collected_at_brin ON hemnet_comp_items USING BRIN (collected_at);
+
+CREATE INDEX hemnet_comp_items_publication_date_brin ON hemnet_comp_items USING BRIN (publication_date);
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+from pathlib import Path
+
+import psycopg2
+
+from run_queries import _load_env_file, _load_statements
+
+
+def _walk_plan(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk_plan(child)
+
+
+def _seq_scans(plan: dict, min_rows: int) -> list[tuple[str, int]]:
+    scans = []
+    for node in _walk_plan(plan):
+        if node.get("Node Type") != "Seq Scan":
+            continue
+        loops = node.get("Actual Loops", 1) or 1
+        rows = (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)) * loops
+        if rows >= min_rows:
+            scans.append((node.get("Relation Name", "?"), rows))
+    return scans
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run EXPLAIN (ANALYZE, BUFFERS) for each statement in queries.sql "
+        "and flag the ones that still scan tables sequentially."
+    )
+    parser.add_argument("--sql", default=None, help="queries file (default: queries.sql)")
+    parser.add_argument(
+        "--min-rows",
+        type=int,
+        default=1000,
+        help="ignore sequential scans that read fewer rows than this",
+    )
+    parser.add_argument("--verbose", action="store_true", help="print full plans")
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="exit non-zero if any statement is flagged or fails",
+    )
+    args = parser.parse_args()
+
+    base_dir = Path(__file__).resolve().parent
+    _load_env_file(Path(os.getenv("ENV_FILE", "")) if os.getenv("ENV_FILE") else base_dir / ".env")
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise SystemExit("Missing DATABASE_URL. Set it in the environment or .env.")
+
+    sql_path = Path(args.sql) if args.sql else base_dir / "queries.sql"
+    if not sql_path.exists():
+        raise SystemExit(f"Missing queries file: {sql_path}")
+
+    statements = _load_statements(sql_path)
+    if not statements:
+        raise SystemExit(f"No SQL statements found in {sql_path.name}.")
+
+    flagged = failed = 0
+    connection = psycopg2.connect(database_url)
+    try:
+        with connection.cursor() as cursor:
+            for index, statement in enumerate(statements, start=1):
+                first_word = statement.split(None, 1)[0].lower()
+                if first_word not in ("select", "with"):
+                    print(f"-- Query {index}: skipped (not a SELECT)")
+                    continue
+                # ANALYZE executes the statement; roll back so nothing sticks.
+                try:
+                    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}")
+                    (result,) = cursor.fetchone()
+                except psycopg2.Error as exc:
+                    # E.g. a table from a migration this database hasn't run.
+                    connection.rollback()
+                    failed += 1
+                    print(f"-- Query {index} failed: {exc}".rstrip())
+                    continue
+                connection.rollback()
+                if isinstance(result, str):
+                    result = json.loads(result)
+                explained = result[0]
+                plan = explained["Plan"]
+                scans = _seq_scans(plan, args.min_rows)
+                status = "SEQ SCAN" if scans else "ok"
+                print(
+                    f"-- Query {index}: {status} "
+                    f"time={explained.get('Execution Time', 0):.1f}ms "
+                    f"shared_hit={plan.get('Shared Hit Blocks', 0)} "
+                    f"shared_read={plan.get('Shared Read Blocks', 0)}"
+                )
+                for relation, rows in scans:
+                    print(f"   seq scan on {relation} ({rows} rows)")
+                if scans:
+                    flagged += 1
+                    print("   " + " ".join(statement.split())[:200])
+                if args.verbose:
+                    print(json.dumps(plan, indent=2))
+    finally:
+        connection.close()
+
+    print(f"\n{flagged} of {len(statements)} statements fall back to sequential scans.")
+    if failed:
+        print(f"{failed} of {len(statements)} statements failed.")
+    if args.strict and (flagged or failed):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Normalisation of Swedish street addresses.
+
+Scraped addresses vary in casing, spacing, abbreviations, floor suffixes and
+whether Swedish characters survived (``Andra Långgatan 28, 3tr`` vs the
+``andra-langgatan-28-3tr`` slugs)::
+
+    >>> parse_address("Andra Långgatan 28 B, 3 tr")
+    {'street': 'andra långgatan', 'number': '28b', 'unit': 'tr3',
+     'key': 'andra langgatan 28b'}
+
+``key`` folds å/ä/ö/é to ASCII and leaves the unit out, so every sale in the
+same building shares it. ``AddressPipeline`` stores the parts on every
+hemnet_items row (``address_street``, ``address_number``, ``address_unit``,
+``address_key``), which turns "all sales at this address" into an index
+lookup; a trigram index on ``address_key`` serves misspelt queries::
+
+    python -m hemnet.address lookup "Andra Långgatan 28"
+    python -m hemnet.address lookup "Andra Langgata 28" --fuzzy
+    python -m hemnet.address backfill        # rows stored before the columns
+"""
+import argparse
+import re
+import unicodedata
+
+from sqlalchemy import bindparam, func, select
+
+from .models import HemnetItem
+
+_FOLD = str.maketrans({"å": "a", "ä": "a", "ö": "o", "é": "e", "ü": "u"})
+
+# "Par-/kedje-/radhus" on active listings, parhus/kedjehus/radhus in slugs.
+_ROW_HOUSES = ("radhus", "parhus", "kedjehus")
+
+# Abbreviated street types ("Storg.", "Kungsv.", "Drottning g"), expanded
+# before the key is built. Only a trailing dot or a bare g/v after a space
+# counts, so names that merely end in g or v are left alone.
+_ABBREVIATIONS = (
+    (re.compile(r"(\w)g\.$"), r"\1gatan"),
+    (re.compile(r"(\w)v\.$"), r"\1vägen"),
+    (re.compile(r"\sg\.?$"), "gatan"),
+    (re.compile(r"\sv\.?$"), "vägen"),
+)
+
+_STREET_RE = re.compile(
+    r"^(?P<street>\D*?)\s*(?P<number>\d+)\s*(?P<letter>[a-zåäö](?![a-zåäö]))?"
+    r"\s*(?P<rest>.*)$"
+)
+_FLOOR_RES = (
+    re.compile(r"(?P<n>-?\d+)\s*(?:tr|trappor|trappa|trp)\b\.?"),
+    re.compile(r"\b(?:vån|våning|plan)\.?\s*(?P<n>-?\d+)"),
+    re.compile(r"\b(?:nb|bv|bottenvåning|entréplan)\b", re.UNICODE),
+)
+_FLAT_RE = re.compile(r"\b(?:lgh|lägenhet|lgh\.?nr)\.?\s*(?P<n>\d{3,4})\b")
+
+
+def clean(text):
+    """Lower case, NFC, single spaces, slug dashes turned into spaces."""
+    text = unicodedata.normalize("NFC", text or "").lower()
+    text = text.replace("-", " ").replace("_", " ")
+    return re.sub(r"\s+", " ", text).strip(" ,.")
+
+
+def fold(text):
+    return (text or "").translate(_FOLD)
+
+
+def _unit(rest):
+    parts = []
+    for pattern in _FLOOR_RES:
+        found = pattern.search(rest)
+        if found:
+            n = found.groupdict().get("n")
+            parts.append("tr{}".format(int(n)) if n else "tr0")
+            break
+    flat = _FLAT_RE.search(rest)
+    if flat:
+        parts.append("lgh{}".format(flat.group("n")))
+    return " ".join(parts) or None
+
+
+def parse_address(text):
+    """Canonical street, number, unit and building key of an address, or None."""
+    text = clean(text)
+    if not text:
+        return None
+    head, _, tail = text.partition(",")
+    match = _STREET_RE.match(head)
+    if not match or not match.group("street"):
+        street = re.sub(r"[^\w ]", "", head).strip()
+        if not street:
+            return None
+        return {"street": street, "number": None, "unit": _unit(tail),
+                "key": fold(street)}
+    street = match.group("street").strip()
+    for pattern, replacement in _ABBREVIATIONS:
+        street = pattern.sub(replacement, street)
+    street = re.sub(r"[^\w ]", "", street).strip()
+    number = match.group("number").lstrip("0") or "0"
+    if match.group("letter"):
+        number += match.group("letter")
+    unit = _unit(" ".join(filter(None, (match.group("rest"), tail))))
+    return {
+        "street": street,
+        "number": number,
+        "unit": unit,
+        "key": fold("{} {}".format(street, number)),
+    }
+
+
+def type_key(value):
+    """Canonical property type: ``Lägenhet`` (active listings) and ``lagenhet``
+    (sold URL slugs) are both ``lagenhet``; the row-house family is ``radhus``."""
+    key = fold(clean(value)).replace(" ", "")
+    if not key:
+        return None
+    if any(part in key for part in _ROW_HOUSES):
+        return "radhus"
+    return key.split("/")[0]
+
+
+def address_key(text):
+    """Building key of an address (see :func:`parse_address`), or None."""
+    parsed = parse_address(text)
+    return parsed["key"] if parsed else None
+
+
+def normalize_item(item):
+    """Set the address_* fields of an item from its ``address``."""
+    parsed = parse_address(item.get("address")) or {}
+    item["address_street"] = parsed.get("street")
+    item["address_number"] = parsed.get("number")
+    item["address_unit"] = parsed.get("unit")
+    item["address_key"] = parsed.get("key")
+    return item
+
+
+LOOKUP_COLUMNS = (
+    "id", "hemnet_id", "address", "address_unit", "geographic_area",
+    "sold_date", "price", "asked_price", "square_meters", "rooms",
+)
+
+
+def sales_at(engine, address, fuzzy=False, sold_only=True, limit=None):
+    """hemnet_items rows at the building of ``address``, newest first.
+
+    Without ``fuzzy`` this is an exact lookup on ``address_key``. With it,
+    rows whose key is trigram-similar (pg_trgm ``%``) and has the same
+    street number match too, best match first.
+    """
+    parsed = parse_address(address)
+    if not parsed:
+        return []
+    items = HemnetItem.__table__
+    columns = [items.c[name] for name in LOOKUP_COLUMNS]
+    if fuzzy:
+        similarity = func.similarity(items.c.address_key, parsed["key"])
+        query = select(columns + [similarity.label("similarity")]).where(
+            items.c.address_key.op("%")(parsed["key"]))
+        if parsed["number"]:
+            query = query.where(items.c.address_number == parsed["number"])
+        query = query.order_by(similarity.desc(), items.c.sold_date.desc())
+    else:
+        query = select(columns).where(items.c.address_key == parsed["key"]).order_by(
+            items.c.sold_date.desc())
+    if sold_only:
+        query = query.where(items.c.sold_date.isnot(None))
+    if limit:
+        query = query.limit(limit)
+    with engine.connect() as conn:
+        return [dict(row) for row in conn.execute(query)]
+
+
+def backfill(engine, batch_size=5000):
+    """Fill the address_* columns of rows stored before normalization."""
+    items = HemnetItem.__table__
+    query = select([items.c.id, items.c.address]).where(
+        items.c.address_key.is_(None) & items.c.address.isnot(None)
+        & (items.c.address != ""))
+    update = items.update().where(items.c.id == bindparam("row_id")).values(
+        address_street=bindparam("street"),
+        address_number=bindparam("number"),
+        address_unit=bindparam("unit"),
+        address_key=bindparam("key"),
+    )
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+    updated = 0
+    for start in range(0, len(rows), batch_size):
+        params = []
+        for row_id, address in rows[start:start + batch_size]:
+            parsed = parse_address(address)
+            if parsed:
+                params.append(dict(parsed, row_id=row_id))
+        if params:
+            with engine.begin() as conn:
+                conn.execute(update, params)
+            updated += len(params)
+    return updated
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="normalize addresses of existing rows")
+    lookup = sub.add_parser("lookup", help="sales at an address")
+    lookup.add_argument("address")
+    lookup.add_argument("--fuzzy", action="store_true")
+    lookup.add_argument("--all", action="store_true", help="include active listings")
+    lookup.add_argument("--limit", type=int)
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    if args.command == "backfill":
+        print("{} rows normalized".format(backfill(engine)))
+        return
+    for row in sales_at(engine, args.address, args.fuzzy, not args.all, args.limit):
+        print("{}\t{}\t{}\t{}\t{}".format(
+            row["sold_date"] or "-", row["hemnet_id"], row["price"],
+            row["address"], row["geographic_area"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""Detection of blocked responses, a circuit breaker and a persistent retry queue.
+
+A response is *blocked* when Hemnet (or its CDN) answers 403/429 or serves a
+challenge page instead of content. ``BlockGuardMiddleware`` (hemnet.middlewares)
+then
+
+* spaces requests further apart (doubling an extra delay per block, decaying
+  again on every normal response),
+* counts the block against the pool member, proxy, browser context and
+  user agent that sent it (``blocks/proxy/...`` etc. in the crawl stats),
+* opens a ``CircuitBreaker`` once the blocked share of recent responses
+  spikes: nothing is sent until the cool-down has passed, then a single probe
+  decides between closing it and a longer cool-down,
+* parks the request in ``crawl_retry_queue`` with exponential backoff. Due
+  entries are scheduled again while the spider runs (it stays open while
+  retries are pending), and the next run picks up whatever is left.
+
+Requests that still fail after Scrapy's own retries (timeouts, connection
+errors) are parked the same way::
+
+    python -m hemnet.blocking stats
+    python -m hemnet.blocking release hemnetspider   # retry all now
+"""
+import argparse
+import pickle
+import time
+from collections import deque
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from scrapy.exceptions import IgnoreRequest
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from .frontier import _to_dict, request_from_dict
+from .models import CrawlRetryEntry, create_hemnet_table, db_connect
+
+BLOCK_STATUSES = (403, 429)
+
+# Markers of challenge / interstitial pages served with status 200 or 503.
+CHALLENGE_MARKERS = (
+    b"cf-challenge",
+    b"challenge-platform",
+    b"cf-chl-",
+    b"Just a moment...",
+    b"Attention Required!",
+    b"px-captcha",
+    b"captcha-delivery",
+    b"g-recaptcha",
+)
+
+# Meta keys that belong to one download attempt and are not queued.
+_TRANSIENT_META = (
+    "proxy", "download_slot", "download_latency", "download_timeout",
+    "retry_times", "frontier_fingerprint", "_auth_proxy", "pool_member",
+)
+
+_POP = text("""
+    UPDATE crawl_retry_queue AS q
+    SET next_attempt_at = now() + make_interval(secs => :lease_secs), updated_at = now()
+    FROM (
+        SELECT spider, fingerprint FROM crawl_retry_queue
+        WHERE spider = :spider AND state = 'waiting' AND next_attempt_at <= now()
+        ORDER BY next_attempt_at
+        LIMIT :batch
+        FOR UPDATE SKIP LOCKED
+    ) AS due
+    WHERE q.spider = due.spider AND q.fingerprint = due.fingerprint
+    RETURNING q.fingerprint, q.request, q.attempts
+""")
+
+
+class RequestQueued(IgnoreRequest):
+    """The request was parked in the retry queue.
+
+    Defined here rather than in hemnet.middlewares so the spiders can import
+    it without importing the Twisted reactor before Scrapy installs its own.
+    """
+
+
+def block_reason(response):
+    """``status_403``, ``status_429`` or ``challenge`` for a blocked response, else None."""
+    if response.status in BLOCK_STATUSES:
+        return "status_{}".format(response.status)
+    if response.status in (200, 503):
+        content_type = response.headers.get("Content-Type", b"") or b""
+        if b"html" in content_type.lower():
+            head = response.body[:20000]
+            if any(marker in head for marker in CHALLENGE_MARKERS):
+                return "challenge"
+    return None
+
+
+def proxy_label(proxy):
+    """``scheme://host:port`` of a proxy URL, without its credentials."""
+    if not proxy:
+        return None
+    parsed = urlparse(proxy)
+    label = "{}://{}".format(parsed.scheme, parsed.hostname)
+    return label + (":{}".format(parsed.port) if parsed.port else "")
+
+
+def block_source(request):
+    """The pool member, proxy, browser context and user agent a request was sent with."""
+    user_agent = request.headers.get("User-Agent")
+    if isinstance(user_agent, bytes):
+        user_agent = user_agent.decode("latin-1")
+    context_proxy = (request.meta.get("playwright_context_kwargs") or {}).get("proxy") or {}
+    return {
+        "member": request.meta.get("pool_member"),
+        "proxy": proxy_label(request.meta.get("proxy") or context_proxy.get("server")),
+        "context": request.meta.get("playwright_context"),
+        "user_agent": user_agent,
+    }
+
+
+class CircuitBreaker(object):
+    """Stops sending while the share of blocked responses is too high.
+
+    ``closed``: requests flow and the last ``window`` results are tracked.
+    ``open``: nothing is sent for ``cooldown`` seconds. ``half-open``: one
+    probe is let through; a normal response closes the breaker, a block opens
+    it again with twice the cool-down (up to ``max_cooldown``).
+    """
+
+    def __init__(self, window=50, min_samples=10, open_ratio=0.3,
+                 cooldown=300.0, max_cooldown=3600.0):
+        self.results = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.open_ratio = open_ratio
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = "closed"
+        self.open_until = 0.0
+        self.probing = False
+
+    def ratio(self):
+        return sum(self.results) / len(self.results) if self.results else 0.0
+
+    def _open(self, now):
+        self.state = "open"
+        self.open_until = now + self.cooldown
+        self.probing = False
+        self.results.clear()
+
+    def record(self, blocked, now=None):
+        """Count one response; True if this opened the breaker."""
+        now = time.monotonic() if now is None else now
+        if self.state == "half-open":
+            if blocked:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open(now)
+                return True
+            self.state = "closed"
+            self.cooldown = self.base_cooldown
+            self.probing = False
+            return False
+        if self.state == "open":
+            return False
+        self.results.append(bool(blocked))
+        if len(self.results) >= self.min_samples and self.ratio() >= self.open_ratio:
+            self._open(now)
+            return True
+        return False
+
+    def probe_failed(self):
+        """The probe ended without a response; let the next request probe."""
+        self.probing = False
+
+    def wait(self, now=None):
+        """Seconds a request has to wait before it may be sent (0: send it)."""
+        now = time.monotonic() if now is None else now
+        if self.state == "closed":
+            return 0.0
+        if self.state == "open":
+            if now < self.open_until:
+                return self.open_until - now
+            self.state = "half-open"
+        if self.probing:
+            return 5.0
+        self.probing = True
+        return 0.0
+
+
+class RetryQueue(object):
+    """Requests parked in crawl_retry_queue until their next attempt is due."""
+
+    def __init__(self, engine, fingerprint, base_secs=600, max_secs=86400,
+                 max_attempts=5, lease_secs=1800):
+        self.engine = engine
+        self.fingerprint = fingerprint
+        self.base_secs = base_secs
+        self.max_secs = max_secs
+        self.max_attempts = max_attempts
+        self.lease_secs = lease_secs
+
+    def backoff(self, attempts):
+        """Seconds before attempt ``attempts + 1``: base, 2 * base, 4 * base..."""
+        return min(self.base_secs * 2 ** max(attempts - 1, 0), self.max_secs)
+
+    def push(self, request, spider, reason, blocked_by=None):
+        """Park a request; returns its attempt count, or None once it gave up."""
+        attempts = request.meta.get("retry_queue_attempts", 0) + 1
+        state = "waiting" if attempts <= self.max_attempts else "failed"
+        request = request.replace(dont_filter=True, meta=dict(request.meta))
+        for key in _TRANSIENT_META:
+            request.meta.pop(key, None)
+        request.meta["retry_queue_attempts"] = attempts
+        row = {
+            "spider": spider.name,
+            "fingerprint": self.fingerprint(request),
+            "url": request.url,
+            "request": pickle.dumps(_to_dict(request, spider), protocol=4),
+            "reason": reason,
+            "blocked_by": blocked_by,
+            "attempts": attempts,
+            "state": state,
+            # Database time, like _POP: the host's clock and zone may differ.
+            "next_attempt_at": func.now() + timedelta(seconds=self.backoff(attempts)),
+            "created_at": func.now(),
+            "updated_at": func.now(),
+        }
+        stmt = insert(CrawlRetryEntry.__table__).values(**row)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["spider", "fingerprint"],
+            set_={name: stmt.excluded[name] for name in (
+                "request", "reason", "blocked_by", "attempts", "state",
+                "next_attempt_at", "updated_at")},
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+        return attempts if state == "waiting" else None
+
+    def pop_due(self, spider, batch=16):
+        """Lease due requests for another attempt.
+
+        The rows stay in the table (leased for ``lease_secs``) until
+        :meth:`done` removes them, so a crash doesn't lose them.
+        """
+        with self.engine.begin() as conn:
+            rows = conn.execute(_POP, {"spider": spider.name, "batch": batch,
+                                       "lease_secs": self.lease_secs}).fetchall()
+        requests = []
+        for fingerprint, data, attempts in rows:
+            request = request_from_dict(pickle.loads(data), spider=spider)
+            request.meta["retry_queue_attempts"] = attempts
+            request.meta["retry_queue_fingerprint"] = fingerprint
+            requests.append(request)
+        return requests
+
+    def done(self, request, spider):
+        fingerprint = request.meta.get("retry_queue_fingerprint")
+        if fingerprint is None:
+            return
+        table = CrawlRetryEntry.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.delete().where(
+                (table.c.spider == spider.name) & (table.c.fingerprint == fingerprint)))
+
+    def pending(self, spider, within_secs):
+        """Number of waiting requests due within ``within_secs``."""
+        table = CrawlRetryEntry.__table__
+        horizon = func.now() + timedelta(seconds=within_secs)
+        query = select([func.count()]).select_from(table).where(
+            (table.c.spider == spider.name) & (table.c.state == "waiting")
+            & (table.c.next_attempt_at <= horizon))
+        with self.engine.connect() as conn:
+            return conn.execute(query).scalar()
+
+
+def queue_stats(engine):
+    """{spider: {state: count}} plus the most common block reasons."""
+    query = text("SELECT spider, state, reason, count(*) FROM crawl_retry_queue "
+                 "GROUP BY spider, state, reason ORDER BY spider, state, count(*) DESC")
+    result = {}
+    with engine.connect() as conn:
+        for spider, state, reason, count in conn.execute(query):
+            result.setdefault(spider, {})["{}/{}".format(state, reason)] = count
+    return result
+
+
+def release(engine, spider, failed=False):
+    """Make a spider's queued requests due now (``failed``: also those that gave up)."""
+    table = CrawlRetryEntry.__table__
+    stmt = table.update().where(table.c.spider == spider)
+    if failed:
+        stmt = stmt.values(state="waiting", attempts=0, next_attempt_at=func.now())
+    else:
+        stmt = stmt.where(table.c.state == "waiting").values(next_attempt_at=func.now())
+    with engine.begin() as conn:
+        return conn.execute(stmt).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="queued requests per spider, state and reason")
+    now = sub.add_parser("release", help="make a spider's queued requests due now")
+    now.add_argument("spider")
+    now.add_argument("--failed", action="store_true",
+                     help="also requests that used up their attempts")
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    if args.command == "stats":
+        for spider, counts in queue_stats(engine).items():
+            print("{}\t{}".format(spider, "\t".join(
+                "{}={}".format(key, count) for key, count in counts.items())))
+    else:
+        print("{} requests released".format(release(engine, args.spider, args.failed)))
+
+
+if __name__ == "__main__":
+    main()
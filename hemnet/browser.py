@@ -0,0 +1,167 @@
+"""Long-lived browser service and persisted browser-context state.
+
+By default every crawl launches its own Chromium and starts from empty
+contexts, which costs seconds and hundreds of MB per scrapyd job and throws
+away the cookies the previous job earned. Instead, run one browser per host::
+
+    python -m hemnet.browser serve --port 9222
+
+and start jobs with ``HEMNET_BROWSER_URL=http://127.0.0.1:9222``: scrapy-playwright
+then connects over CDP (``PLAYWRIGHT_CDP_URL``) instead of launching, and on
+close only drops its own contexts, so the browser stays up for the next job.
+
+Independently of that, ``BrowserStateSaver`` (hemnet.extensions) writes the
+storage state (cookies, localStorage) of every context to
+``BROWSER_STATE_DIR/<context>.json`` periodically and when the spider closes,
+and new contexts are created from it, so the next job starts with the
+consents and session cookies of the last one::
+
+    python -m hemnet.browser status
+    python -m hemnet.browser states
+    python -m hemnet.browser clear          # start the next job with fresh contexts
+"""
+import argparse
+import json
+import os
+import re
+import time
+from pathlib import Path
+from urllib.error import URLError
+from urllib.request import urlopen
+
+DEFAULT_PORT = 9222
+
+# Saved states older than this are not restored (sessions expire anyway).
+MAX_STATE_AGE_SECS = 7 * 24 * 3600
+
+
+def state_path(state_dir, context_name):
+    safe_name = re.sub(r"[^a-zA-Z0-9_-]", "_", context_name)
+    return Path(state_dir) / "{}.json".format(safe_name)
+
+
+def stored_state(state_dir, context_name, max_age_secs=MAX_STATE_AGE_SECS):
+    """Path of a context's saved storage state if there is a recent one, else None."""
+    if not state_dir:
+        return None
+    path = state_path(state_dir, context_name)
+    try:
+        age = time.time() - path.stat().st_mtime
+    except OSError:
+        return None
+    return str(path) if age <= max_age_secs else None
+
+
+def with_stored_state(context_kwargs, state_dir, context_name):
+    """``context_kwargs`` restoring the saved state of ``context_name`` (if any)."""
+    kwargs = dict(context_kwargs or {})
+    kwargs.pop("storage_state", None)
+    path = stored_state(state_dir, context_name)
+    if path:
+        kwargs["storage_state"] = path
+    return kwargs
+
+
+def playwright_handler(crawler):
+    """The running scrapy-playwright download handler, or None."""
+    handlers = crawler.engine.downloader.handlers
+    for scheme in ("https", "http"):
+        handler = handlers._handlers.get(scheme)
+        if hasattr(handler, "context_wrappers"):
+            return handler
+    return None
+
+
+def handler_deferred(handler, coro):
+    """Run ``coro`` on the handler's event loop; a Deferred of its result."""
+    to_deferred = getattr(handler, "_deferred_from_coro", None)
+    if to_deferred is None:
+        from scrapy.utils.defer import deferred_from_coro as to_deferred
+    return to_deferred(coro)
+
+
+async def save_states(contexts, state_dir):
+    """Write the storage state of each ``{name: BrowserContext}``; returns the names saved."""
+    Path(state_dir).mkdir(parents=True, exist_ok=True)
+    saved = []
+    for name, context in contexts.items():
+        path = state_path(state_dir, name)
+        tmp = path.with_suffix(".tmp")
+        try:
+            await context.storage_state(path=str(tmp))
+        except Exception:
+            # Context closed or browser gone; keep the previous state.
+            continue
+        os.replace(str(tmp), str(path))
+        saved.append(name)
+    return saved
+
+
+def serve(port=DEFAULT_PORT, headless=True):
+    """Run a Chromium that crawler jobs connect to over CDP, until interrupted."""
+    from playwright.sync_api import sync_playwright
+
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=headless, args=[
+            "--remote-debugging-port={}".format(port),
+            "--remote-debugging-address=127.0.0.1",
+        ])
+        print("browser listening on http://127.0.0.1:{}".format(port), flush=True)
+        try:
+            while browser.is_connected():
+                time.sleep(5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if browser.is_connected():
+                browser.close()
+
+
+def status(url):
+    """The service's /json/version, or None if it doesn't answer."""
+    try:
+        with urlopen(url.rstrip("/") + "/json/version", timeout=5) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except (URLError, OSError, ValueError):
+        return None
+
+
+def main(argv=None):
+    from . import settings
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("serve", help="run the shared browser")
+    run.add_argument("--port", type=int, default=DEFAULT_PORT)
+    run.add_argument("--headed", action="store_true")
+    check = sub.add_parser("status", help="whether the browser service is up")
+    check.add_argument("--url", default=os.getenv("HEMNET_BROWSER_URL")
+                       or "http://127.0.0.1:{}".format(DEFAULT_PORT))
+    sub.add_parser("states", help="saved context states")
+    sub.add_parser("clear", help="delete saved context states")
+    args = parser.parse_args(argv)
+
+    state_dir = Path(settings.BROWSER_STATE_DIR)
+    if args.command == "serve":
+        serve(args.port, headless=not args.headed)
+    elif args.command == "status":
+        version = status(args.url)
+        if version is None:
+            raise SystemExit("no browser at {}".format(args.url))
+        print("{}\t{}".format(args.url, version.get("Browser")))
+    elif args.command == "states":
+        for path in sorted(state_dir.glob("*.json")):
+            if path.name == "sessions.json":  # hemnet.sessions metadata
+                continue
+            cookies = len(json.loads(path.read_text(encoding="utf-8")).get("cookies", []))
+            age = (time.time() - path.stat().st_mtime) / 3600
+            print("{}\t{} cookies\t{:.1f} h old".format(path.stem, cookies, age))
+    else:
+        paths = list(state_dir.glob("*.json"))
+        for path in paths:
+            path.unlink()
+        print("{} states deleted".format(len(paths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""Incremental Parquet export of the analytic columns.
+
+Each run appends the rows with an ``id`` above the last exported one to a
+hive-style dataset, one directory per month::
+
+    exports/hemnet_items/month=2016-03/part-000000001234-000000005678.parquet
+
+Concurrent writers (shards, a shared frontier) commit ids out of order, so a
+row can appear below the watermark after it moved on. Ids skipped within the
+last ``gap_window`` ids are remembered as gaps and looked up again on every
+run; each row is still exported exactly once.
+
+JSON, text and binary columns are never selected. Needs ``pyarrow``::
+
+    python -m hemnet.export exports/
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    String,
+    select,
+)
+
+from .models import HemnetCompItem, HemnetItem
+from .partitions import as_date
+
+# Table -> (model, column the files are partitioned by).
+EXPORTS = {
+    "hemnet_items": (HemnetItem, "sold_date"),
+    "hemnet_comp_items": (HemnetCompItem, "collected_at"),
+}
+
+WATERMARK_FILE = "_watermarks.json"
+
+# Skipped ids further than this below the watermark are given up on: their
+# transaction rolled back or was never going to commit.
+GAP_WINDOW = 100000
+
+
+def _arrow_type(column):
+    import pyarrow as pa
+
+    kind = column.type
+    if isinstance(kind, (BigInteger, Integer)):
+        return pa.int64()
+    if isinstance(kind, Float):
+        return pa.float64()
+    if isinstance(kind, Boolean):
+        return pa.bool_()
+    if isinstance(kind, DateTime):
+        return pa.timestamp("us")
+    if isinstance(kind, Date):
+        return pa.date32()
+    if type(kind) is String:
+        return pa.string()
+    # Text, JSON and LargeBinary are cold data and stay in Postgres.
+    return None
+
+
+def export_columns(model):
+    """The (column, arrow type) pairs exported for a model."""
+    columns = []
+    for column in model.__table__.columns:
+        arrow_type = _arrow_type(column)
+        if arrow_type is not None:
+            columns.append((column, arrow_type))
+    return columns
+
+
+def load_watermarks(out_dir):
+    """{table: {"id": highest exported id, "gaps": [skipped ids]}}."""
+    path = Path(out_dir) / WATERMARK_FILE
+    if not path.exists():
+        return {}
+    watermarks = json.loads(path.read_text(encoding="utf-8"))
+    # Files written before gaps were tracked hold just the id.
+    return {table: mark if isinstance(mark, dict) else {"id": mark, "gaps": []}
+            for table, mark in watermarks.items()}
+
+
+def save_watermarks(out_dir, watermarks):
+    path = Path(out_dir) / WATERMARK_FILE
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(watermarks, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(str(tmp), str(path))
+
+
+def _month_key(value):
+    day = as_date(value)
+    return "{:%Y-%m}".format(day) if day else "undated"
+
+
+def _write_batch(table_dir, schema, names, rows, partition_index, compression):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(_month_key(row[partition_index]), []).append(row)
+
+    written = []
+    for month, month_rows in sorted(groups.items()):
+        arrays = [
+            pa.array([row[i] for row in month_rows], type=schema.field(i).type)
+            for i in range(len(names))
+        ]
+        month_dir = table_dir / "month={}".format(month)
+        month_dir.mkdir(parents=True, exist_ok=True)
+        # id is the first column of both tables.
+        ids = [row[0] for row in month_rows]
+        path = month_dir / "part-{:012d}-{:012d}.parquet".format(min(ids), max(ids))
+        pq.write_table(
+            pa.Table.from_arrays(arrays, schema=schema), str(path),
+            compression=compression,
+        )
+        written.append(path)
+    return written
+
+
+def export_table(engine, table, out_dir, watermarks, batch_size=50000,
+                 compression="zstd", gap_window=GAP_WINDOW):
+    """Append rows of ``table`` not exported yet; returns rows written.
+
+    First the remembered gaps that have committed since, then the rows above
+    the watermark.
+    """
+    import pyarrow as pa
+
+    model, partition_column = EXPORTS[table]
+    columns = export_columns(model)
+    names = [column.name for column, _ in columns]
+    schema = pa.schema([(name, arrow_type) for name, (_, arrow_type)
+                        in zip(names, columns)])
+    partition_index = names.index(partition_column)
+    id_column = model.__table__.c.id
+
+    mark = watermarks.setdefault(table, {"id": 0, "gaps": []})
+    selected = select([column for column, _ in columns]).order_by(id_column)
+    table_dir = Path(out_dir) / table
+    total = 0
+    with engine.connect() as conn:
+        for query, late in ((selected.where(id_column.in_(mark["gaps"])), True),
+                            (selected.where(id_column > mark["id"]), False)):
+            if late and not mark["gaps"]:
+                continue
+            result = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                _write_batch(table_dir, schema, names, rows, partition_index,
+                             compression)
+                total += len(rows)
+                # Advance only after the batch is on disk. A crash re-exports
+                # at most one batch, overwriting the same id-range file names.
+                _advance(mark, [row[0] for row in rows], late, gap_window)
+                save_watermarks(out_dir, watermarks)
+    return total
+
+
+def _advance(mark, ids, late, gap_window):
+    """Record a written batch of ascending ``ids`` in a table's watermark."""
+    exported = set(ids)
+    gaps = [i for i in mark["gaps"] if i not in exported]
+    if not late:
+        # Ids skipped between the old and the new watermark may still commit.
+        start = max(mark["id"], ids[-1] - gap_window) + 1
+        gaps.extend(i for i in range(start, ids[-1]) if i not in exported)
+        mark["id"] = ids[-1]
+    mark["gaps"] = sorted(i for i in gaps if i > mark["id"] - gap_window)
+
+
+def main(argv=None):
+    from .models import db_connect
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("out_dir", help="dataset root directory")
+    parser.add_argument("--table", choices=sorted(EXPORTS), action="append",
+                        help="table to export (default: all)")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument("--compression", default="zstd")
+    parser.add_argument("--gap-window", type=int, default=GAP_WINDOW,
+                        help="how many ids below the watermark to keep looking "
+                             "for rows committed late")
+    args = parser.parse_args(argv)
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise SystemExit("hemnet.export needs pyarrow: pip install pyarrow")
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    watermarks = load_watermarks(out_dir)
+    engine = db_connect()
+    for table in args.table or sorted(EXPORTS):
+        rows = export_table(engine, table, out_dir, watermarks,
+                            batch_size=args.batch_size,
+                            compression=args.compression,
+                            gap_window=args.gap_window)
+        mark = watermarks[table]
+        print("{}: {} rows (watermark id {}, {} gaps)".format(
+            table, rows, mark["id"], len(mark["gaps"])))
+
+
+if __name__ == "__main__":
+    main()
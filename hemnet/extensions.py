@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# Scrapy extensions, enabled through the EXTENSIONS setting.
+#
+# See: http://doc.scrapy.org/en/latest/topics/extensions.html
+
+import json
+import logging
+import time
+from pathlib import Path
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web import resource, server
+
+from .browser import handler_deferred, playwright_handler, save_states
+from .metrics import REGISTRY
+from .priority import classify
+
+logger = logging.getLogger(__name__)
+
+
+class StatsFile(object):
+    """Write the final crawl stats as JSON to STATS_FILE when the spider closes."""
+
+    def __init__(self, path, stats):
+        self.path = Path(path)
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('STATS_FILE')
+        if not path:
+            raise NotConfigured("STATS_FILE not set")
+        o = cls(path, crawler.stats)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def spider_closed(self, spider, reason):
+        stats = dict(self.stats.get_stats(spider))
+        stats.setdefault('finish_reason', reason)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(stats, default=str, indent=2),
+                             encoding='utf-8')
+
+
+class BrowserStateSaver(object):
+    """Save the storage state of every Playwright context to BROWSER_STATE_DIR.
+
+    Runs every BROWSER_STATE_SAVE_SECS and when the spider closes (before the
+    download handler closes the contexts); see hemnet.browser.
+    """
+
+    def __init__(self, crawler, state_dir, interval):
+        self.crawler = crawler
+        self.state_dir = state_dir
+        self.interval = interval
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('BROWSER_STATE_ENABLED') or not settings.get('BROWSER_STATE_DIR'):
+            raise NotConfigured("BROWSER_STATE_ENABLED is off")
+        o = cls(crawler, settings.get('BROWSER_STATE_DIR'),
+                settings.getfloat('BROWSER_STATE_SAVE_SECS', 300))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+    def save(self):
+        handler = playwright_handler(self.crawler)
+        if handler is None or not handler.context_wrappers:
+            return None
+        contexts = {name: wrapper.context for name, wrapper in handler.context_wrappers.items()}
+        d = handler_deferred(handler, save_states(contexts, self.state_dir))
+        d.addCallback(lambda saved: logger.debug("Saved browser state of %s", saved))
+        d.addErrback(lambda failure: logger.warning("Saving browser state failed: %s",
+                                                    failure.value))
+        return d
+
+    def spider_opened(self, spider):
+        self.loop = LoopingCall(self.save)
+        self.loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        return self.save()
+
+
+class _MetricsPage(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, exporter):
+        resource.Resource.__init__(self)
+        self.exporter = exporter
+
+    def render_GET(self, request):
+        self.exporter.refresh()
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4; charset=utf-8")
+        return REGISTRY.render().encode("utf-8")
+
+
+class MetricsExporter(object):
+    """Serve crawl metrics (hemnet.metrics) on METRICS_HOST:METRICS_PORT.
+
+    Counts requests, responses and items from the crawler signals and times
+    each item from its request's first scheduling to the DB commit (the
+    pipeline commits before ``item_scraped`` fires).
+    """
+
+    def __init__(self, crawler, host, port, interval):
+        self.crawler = crawler
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.listener = None
+        self.loop = None
+        self.last = None
+        self.scheduled = REGISTRY.counter(
+            "hemnet_requests_scheduled_total", "Requests scheduled.", ("page_type", "fetch"))
+        self.responses = REGISTRY.counter(
+            "hemnet_responses_total", "Responses received.", ("page_type", "fetch", "status"))
+        self.download = REGISTRY.histogram(
+            "hemnet_download_seconds", "Download time of a response.", ("page_type", "fetch"))
+        self.queue_wait = REGISTRY.histogram(
+            "hemnet_queue_wait_seconds", "From scheduling a request to the downloader.",
+            ("page_type",))
+        self.items = REGISTRY.counter(
+            "hemnet_items_total", "Items by pipeline outcome.", ("item_type", "outcome"))
+        self.item_total = REGISTRY.histogram(
+            "hemnet_item_seconds", "From first scheduling an item's request to its DB commit.",
+            ("item_type", "page_type"))
+        self.item_processing = REGISTRY.histogram(
+            "hemnet_item_processing_seconds",
+            "From an item's response to its DB commit (parsing and pipeline).", ("item_type",))
+        self.queues = REGISTRY.gauge(
+            "hemnet_queue_depth", "Requests, responses or items waiting, by queue.", ("queue",))
+        self.rates = REGISTRY.gauge(
+            "hemnet_per_second", "Items and pages per second over the last interval.", ("what",))
+        self.stats = REGISTRY.gauge(
+            "hemnet_scrapy_stat", "Numeric Scrapy crawl stats.", ("stat",))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.get('METRICS_PORT'):
+            raise NotConfigured("METRICS_PORT not set")
+        o = cls(crawler, settings.get('METRICS_HOST', '127.0.0.1'),
+                settings.getint('METRICS_PORT'), settings.getfloat('METRICS_INTERVAL', 10))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(o.request_reached_downloader,
+                                signal=signals.request_reached_downloader)
+        crawler.signals.connect(o.response_received, signal=signals.response_received)
+        crawler.signals.connect(o.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(o.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(o.item_error, signal=signals.item_error)
+        return o
+
+    def spider_opened(self, spider):
+        self.listener = reactor.listenTCP(self.port, server.Site(_MetricsPage(self)),
+                                          interface=self.host)
+        logger.info("Metrics on http://%s:%d/metrics", self.host, self.port)
+        self.loop = LoopingCall(self.update_rates)
+        self.loop.start(self.interval, now=True)
+
+    def spider_closed(self, spider):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        if self.listener is not None:
+            self.listener.stopListening()
+
+    @staticmethod
+    def _fetch(request):
+        return "browser" if request.meta.get("playwright") else "http"
+
+    def request_scheduled(self, request, spider):
+        now = time.time()
+        request.meta.setdefault("metrics_scheduled_at", now)
+        request.meta["metrics_queued_at"] = now
+        self.scheduled.inc(page_type=classify(request), fetch=self._fetch(request))
+
+    def request_reached_downloader(self, request, spider):
+        queued_at = request.meta.get("metrics_queued_at")
+        if queued_at is not None:
+            self.queue_wait.observe(time.time() - queued_at, page_type=classify(request))
+
+    def response_received(self, response, request, spider):
+        request.meta["metrics_received_at"] = time.time()
+        page_type, fetch = classify(request), self._fetch(request)
+        self.responses.inc(page_type=page_type, fetch=fetch, status=response.status)
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            self.download.observe(latency, page_type=page_type, fetch=fetch)
+
+    def item_scraped(self, item, response, spider):
+        item_type = type(item).__name__
+        self.items.inc(item_type=item_type, outcome="stored")
+        meta = getattr(response, "meta", None) or {}
+        now = time.time()
+        scheduled_at = meta.get("metrics_scheduled_at")
+        if scheduled_at is not None:
+            total = now - scheduled_at
+            self.item_total.observe(total, item_type=item_type,
+                                    page_type=meta.get("crawl_class", ""))
+            logger.debug("%s %s: %.2f s from scheduling to commit (download %.2f s)",
+                         item_type, item.get("hemnet_id"), total,
+                         meta.get("download_latency") or 0.0)
+        received_at = meta.get("metrics_received_at")
+        if received_at is not None:
+            self.item_processing.observe(now - received_at, item_type=item_type)
+
+    def item_dropped(self, item, response, exception, spider):
+        self.items.inc(item_type=type(item).__name__, outcome="dropped")
+
+    def item_error(self, item, response, spider, failure):
+        self.items.inc(item_type=type(item).__name__, outcome="error")
+
+    def update_rates(self):
+        stats = self.crawler.stats
+        now = time.monotonic()
+        counts = (stats.get_value("item_scraped_count", 0),
+                  stats.get_value("response_received_count", 0))
+        if self.last is not None:
+            elapsed = now - self.last[0]
+            if elapsed > 0:
+                self.rates.set((counts[0] - self.last[1][0]) / elapsed, what="items")
+                self.rates.set((counts[1] - self.last[1][1]) / elapsed, what="pages")
+        self.last = (now, counts)
+
+    def refresh(self):
+        """Queue depths and Scrapy stats as of now."""
+        engine = self.crawler.engine
+        slot = getattr(engine, "_slot", None) or getattr(engine, "slot", None)
+        scheduler = getattr(slot, "scheduler", None)
+        if scheduler is not None and hasattr(scheduler, "__len__"):
+            self.queues.set(len(scheduler), queue="scheduler")
+        downloader = getattr(engine, "downloader", None)
+        if downloader is not None:
+            self.queues.set(len(downloader.active), queue="downloading")
+            self.queues.set(sum(len(s.queue) for s in downloader.slots.values()),
+                            queue="download_slots")
+        scraper_slot = getattr(getattr(engine, "scraper", None), "slot", None)
+        if scraper_slot is not None:
+            self.queues.set(len(scraper_slot.queue) + len(scraper_slot.active),
+                            queue="parsing")
+            self.queues.set(scraper_slot.itemproc_size, queue="pipeline")
+        self.stats.clear()
+        for name, value in self.crawler.stats.get_stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.stats.set(value, stat=name)
@@ -0,0 +1,278 @@
+"""Crawl frontier shared by all workers of a crawl, stored in Postgres.
+
+``FrontierScheduler`` replaces Scrapy's in-memory scheduler. Every request a
+worker schedules is inserted into ``crawl_frontier`` keyed by (crawl, request
+fingerprint), so a request already known to any worker is dropped. Workers
+lease batches of pending requests, highest priority first, with
+``FOR UPDATE SKIP LOCKED``, so concurrent workers never lease the same row. A
+response marks its row done; a lease that is not completed in
+``FRONTIER_LEASE_SECS`` (worker died, download failed) expires and the
+request is leased again, up to ``FRONTIER_MAX_ATTEMPTS`` times. Priorities
+and daily quotas are those of hemnet.priority; requests over quota are set
+to state ``quota``; ``reset --state quota`` forgets them so that a later
+crawl enqueues them again.
+
+Enable with ``HEMNET_FRONTIER=1`` (or ``-s SCHEDULER=hemnet.frontier.FrontierScheduler``)
+on every scrapyd job; all jobs with the same ``FRONTIER_CRAWL`` (default: the
+spider name) cooperate on one crawl::
+
+    python -m hemnet.frontier stats
+    python -m hemnet.frontier reset hemnetspider    # start the crawl over
+"""
+import argparse
+import os
+import pickle
+import socket
+import time
+from collections import deque
+
+from scrapy import signals
+from scrapy.core.scheduler import BaseScheduler
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import CrawlFrontierEntry, create_hemnet_table, db_connect
+from .priority import open_quotas, prioritize
+
+try:
+    from scrapy.utils.request import request_from_dict
+except ImportError:  # Scrapy < 2.6
+    from scrapy.utils.reqser import request_from_dict
+
+_LEASE = text("""
+    UPDATE crawl_frontier AS f
+    SET state = 'leased', leased_by = :worker, attempts = f.attempts + 1,
+        lease_expires_at = now() + make_interval(secs => :lease_secs),
+        updated_at = now()
+    FROM (
+        SELECT crawl, fingerprint FROM crawl_frontier
+        WHERE crawl = :crawl
+          AND (state = 'pending' OR (state = 'leased' AND lease_expires_at < now()))
+          AND attempts < :max_attempts
+        ORDER BY priority DESC, created_at
+        LIMIT :batch
+        FOR UPDATE SKIP LOCKED
+    ) AS next
+    WHERE f.crawl = next.crawl AND f.fingerprint = next.fingerprint
+    RETURNING f.fingerprint, f.request
+""")
+
+# Expired leases that used up their attempts.
+_FAIL = text("""
+    UPDATE crawl_frontier SET state = 'failed', updated_at = now()
+    WHERE crawl = :crawl AND state = 'leased' AND lease_expires_at < now()
+      AND attempts >= :max_attempts
+""")
+
+_OPEN = text("""
+    SELECT count(*) FROM crawl_frontier
+    WHERE crawl = :crawl AND state IN ('pending', 'leased')
+      AND attempts < :max_attempts
+""")
+
+
+def _fingerprinter(crawler):
+    fingerprinter = getattr(crawler, "request_fingerprinter", None)
+    if fingerprinter is not None:
+        return lambda request: fingerprinter.fingerprint(request).hex()
+    from scrapy.utils.request import request_fingerprint
+    return request_fingerprint
+
+
+def _to_dict(request, spider):
+    if hasattr(request, "to_dict"):
+        return request.to_dict(spider=spider)
+    from scrapy.utils.reqser import request_to_dict
+    return request_to_dict(request, spider)
+
+
+class FrontierScheduler(BaseScheduler):
+    """Scrapy scheduler backed by the crawl_frontier table."""
+
+    def __init__(self, crawler, engine=None):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.engine = engine
+        self.crawl = settings.get("FRONTIER_CRAWL")
+        self.lease_secs = settings.getint("FRONTIER_LEASE_SECS", 300)
+        self.max_attempts = settings.getint("FRONTIER_MAX_ATTEMPTS", 3)
+        self.batch_size = settings.getint("FRONTIER_BATCH_SIZE", 16)
+        self.poll_secs = settings.getfloat("FRONTIER_POLL_SECS", 5.0)
+        self.worker = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.fingerprint = _fingerprinter(crawler)
+        self.quotas = open_quotas(settings)
+        self.spider = None
+        self.buffer = deque()
+        self._open_checked_at = 0.0
+        self._open_rows = 0
+        self._lease_after = 0.0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = cls(crawler)
+        crawler.signals.connect(scheduler.response_received,
+                                signal=signals.response_received)
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        self.crawl = self.crawl or spider.name
+        if self.engine is None:
+            self.engine = db_connect()
+            create_hemnet_table(self.engine)
+
+    def close(self, reason):
+        # Hand unstarted leases back instead of letting them time out.
+        fingerprints = [fp for fp, _ in self.buffer]
+        if fingerprints:
+            table = CrawlFrontierEntry.__table__
+            with self.engine.begin() as conn:
+                conn.execute(table.update().where(
+                    (table.c.crawl == self.crawl)
+                    & table.c.fingerprint.in_(fingerprints)
+                    & (table.c.leased_by == self.worker)
+                ).values(state="pending", attempts=table.c.attempts - 1,
+                         leased_by=None, lease_expires_at=None))
+        self.buffer.clear()
+        self.engine.dispose()
+
+    def enqueue_request(self, request):
+        prioritize(request)
+        fingerprint = self.fingerprint(request)
+        row = {
+            "crawl": self.crawl,
+            "fingerprint": fingerprint,
+            "url": request.url,
+            "request": pickle.dumps(_to_dict(request, self.spider), protocol=4),
+            "priority": request.priority,
+            "state": "pending",
+            "attempts": 0,
+            "created_at": func.now(),
+            "updated_at": func.now(),
+        }
+        stmt = insert(CrawlFrontierEntry.__table__).values(**row)
+        if request.dont_filter:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["crawl", "fingerprint"],
+                set_={"request": stmt.excluded.request, "priority": stmt.excluded.priority,
+                      "state": "pending", "attempts": 0, "updated_at": func.now()},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=["crawl", "fingerprint"])
+        with self.engine.begin() as conn:
+            added = conn.execute(stmt).rowcount == 1
+        self.stats.inc_value("frontier/enqueued" if added else "frontier/duplicate",
+                             spider=self.spider)
+        return added
+
+    def _lease(self):
+        with self.engine.begin() as conn:
+            failed = conn.execute(_FAIL, {"crawl": self.crawl,
+                                          "max_attempts": self.max_attempts}).rowcount
+            rows = conn.execute(_LEASE, {
+                "crawl": self.crawl,
+                "worker": self.worker,
+                "lease_secs": self.lease_secs,
+                "max_attempts": self.max_attempts,
+                "batch": self.batch_size,
+            }).fetchall()
+        if failed:
+            self.stats.inc_value("frontier/failed", failed, spider=self.spider)
+        self.stats.inc_value("frontier/leased", len(rows), spider=self.spider)
+        self.buffer.extend((row[0], row[1]) for row in rows)
+        if not rows:
+            # The engine asks for requests on every tick; don't poll the
+            # table that often while the frontier is empty.
+            self._lease_after = time.monotonic() + 1.0
+
+    def next_request(self):
+        while True:
+            if not self.buffer and time.monotonic() >= self._lease_after:
+                self._lease()
+            if not self.buffer:
+                return None
+            fingerprint, data = self.buffer.popleft()
+            request = request_from_dict(pickle.loads(data), spider=self.spider)
+            crawl_class = request.meta.get("crawl_class")
+            if self.quotas is None or self.quotas.allow(crawl_class):
+                request.meta["frontier_fingerprint"] = fingerprint
+                return request
+            self.stats.inc_value("quota/dropped/{}".format(crawl_class), spider=self.spider)
+            self._set_state(fingerprint, "quota")
+
+    def has_pending_requests(self):
+        if self.buffer:
+            return True
+        # Rows leased by other workers count too: their responses may still add
+        # requests, so this worker stays open until the whole crawl is done.
+        now = time.monotonic()
+        if now - self._open_checked_at >= self.poll_secs:
+            with self.engine.connect() as conn:
+                self._open_rows = conn.execute(_OPEN, {
+                    "crawl": self.crawl, "max_attempts": self.max_attempts,
+                }).scalar()
+            self._open_checked_at = now
+        return self._open_rows > 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def response_received(self, response, request, spider):
+        fingerprint = request.meta.get("frontier_fingerprint")
+        if fingerprint is None:
+            return
+        self._set_state(fingerprint, "done")
+        self._open_checked_at = 0.0
+
+    def _set_state(self, fingerprint, state):
+        table = CrawlFrontierEntry.__table__
+        with self.engine.begin() as conn:
+            conn.execute(table.update().where(
+                (table.c.crawl == self.crawl) & (table.c.fingerprint == fingerprint)
+            ).values(state=state, lease_expires_at=None, updated_at=func.now()))
+
+
+def frontier_stats(engine):
+    """{crawl: {state: count}} for all crawls."""
+    query = text("SELECT crawl, state, count(*) FROM crawl_frontier GROUP BY crawl, state "
+                 "ORDER BY crawl, state")
+    result = {}
+    with engine.connect() as conn:
+        for crawl, state, count in conn.execute(query):
+            result.setdefault(crawl, {})[state] = count
+    return result
+
+
+def reset(engine, crawl, states=None):
+    """Delete a crawl's rows (or only those in ``states``); returns the count."""
+    table = CrawlFrontierEntry.__table__
+    stmt = table.delete().where(table.c.crawl == crawl)
+    if states:
+        stmt = stmt.where(table.c.state.in_(list(states)))
+    with engine.begin() as conn:
+        return conn.execute(stmt).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="request counts per crawl and state")
+    clear = sub.add_parser("reset", help="forget a crawl so it can run again")
+    clear.add_argument("crawl")
+    clear.add_argument("--state", action="append",
+                       help="only rows in this state (e.g. done, failed, quota)")
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    if args.command == "stats":
+        for crawl, states in frontier_stats(engine).items():
+            print("{}\t{}".format(crawl, "\t".join(
+                "{}={}".format(state, count) for state, count in states.items())))
+    else:
+        print("{} rows deleted".format(reset(engine, args.crawl, args.state)))
+
+
+if __name__ == "__main__":
+    main()
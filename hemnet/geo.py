@@ -0,0 +1,172 @@
+"""In-memory grid index over listing coordinates.
+
+Points are bucketed into roughly ``cell_m`` sized lat/lon cells and sorted by
+cell, so a radius query only looks at the cells overlapping the circle (one
+``searchsorted`` per cell row) before the exact haversine check::
+
+    index = GeoIndex.from_database(db_connect(), "hemnet_items")
+    ids, meters = index.radius(57.69, 11.95, 500, type="bostadsratt", rooms=(2, 3))
+    ids, meters = index.nearest(57.69, 11.95, k=10)
+
+``from_snapshot`` builds the same index from a :mod:`hemnet.snapshot`.
+"""
+import math
+
+import numpy as np
+from sqlalchemy import select
+
+from .models import HemnetCompItem, HemnetItem
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180.0
+
+# Table -> (model, latitude, longitude, type, rooms) column names.
+GEO_SOURCES = {
+    "hemnet_items": (HemnetItem, "latitude", "longitude", "type", "rooms"),
+    "hemnet_comp_items": (HemnetCompItem, "lattitude", "longitude", "item_type", "rooms"),
+}
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters; broadcasts over NumPy arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GeoIndex(object):
+    """Grid index of (id, lat, lon) points with optional type and rooms."""
+
+    def __init__(self, ids, lat, lon, types=None, rooms=None, cell_m=500):
+        ids = np.asarray(ids, dtype=np.int64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        keep = ~(np.isnan(lat) | np.isnan(lon))
+
+        if types is None:
+            type_codes = np.full(len(ids), -1, dtype=np.int32)
+            self.type_values = []
+        else:
+            self.type_values, type_codes = np.unique(
+                np.array([t or "" for t in types], dtype=object).astype(str),
+                return_inverse=True,
+            )
+            self.type_values = list(self.type_values)
+        rooms = (np.full(len(ids), np.nan) if rooms is None
+                 else np.asarray(rooms, dtype=np.float64))
+
+        ids, lat, lon = ids[keep], lat[keep], lon[keep]
+        type_codes, rooms = np.asarray(type_codes)[keep], rooms[keep]
+
+        self.cell_m = float(cell_m)
+        self.lat_step = self.cell_m / METERS_PER_DEGREE
+        max_lat = float(np.max(np.abs(lat))) if len(lat) else 0.0
+        # Wide enough that a cell is at least cell_m across at every latitude.
+        self.lon_step = self.lat_step / max(math.cos(math.radians(max_lat)), 1e-6)
+        self.lat0 = float(lat.min()) if len(lat) else 0.0
+        self.lon0 = float(lon.min()) if len(lon) else 0.0
+        self.ncols = (int((lon.max() - self.lon0) / self.lon_step) + 1) if len(lon) else 1
+
+        keys = self._keys(lat, lon)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ids = ids[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+        self.type_codes = type_codes[order]
+        self.rooms = rooms[order]
+
+    @classmethod
+    def from_database(cls, engine, table="hemnet_items", cell_m=500):
+        model, lat_name, lon_name, type_name, rooms_name = GEO_SOURCES[table]
+        t = model.__table__
+        query = select([t.c.id, t.c[lat_name], t.c[lon_name],
+                        t.c[type_name], t.c[rooms_name]]).where(
+            t.c[lat_name].isnot(None) & t.c[lon_name].isnot(None))
+        with engine.connect() as conn:
+            rows = conn.execution_options(stream_results=True).execute(query).fetchall()
+        if not rows:
+            return cls([], [], [], [], [], cell_m=cell_m)
+        ids, lat, lon, types, rooms = zip(*rows)
+        rooms = [np.nan if r is None else r for r in rooms]
+        return cls(ids, lat, lon, types, rooms, cell_m=cell_m)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, cell_m=500):
+        return cls(
+            snapshot["id"], snapshot["latitude"], snapshot["longitude"],
+            snapshot.decode("type", snapshot["type"]), snapshot["rooms"],
+            cell_m=cell_m,
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, lat, lon):
+        row = np.floor((lat - self.lat0) / self.lat_step).astype(np.int64)
+        col = np.floor((lon - self.lon0) / self.lon_step).astype(np.int64)
+        return row, col
+
+    def _keys(self, lat, lon):
+        row, col = self._cell(lat, lon)
+        return row * self.ncols + col
+
+    def _candidates(self, lat, lon, radius_m):
+        dlat = radius_m / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+        row_lo, col_lo = self._cell(lat - dlat, lon - dlon)
+        row_hi, col_hi = self._cell(lat + dlat, lon + dlon)
+        col_lo = max(int(col_lo), 0)
+        col_hi = min(int(col_hi), self.ncols - 1)
+        if col_lo > col_hi:
+            return np.empty(0, dtype=np.int64)
+        rows = np.arange(max(int(row_lo), 0), int(row_hi) + 1)
+        if not len(rows):
+            return np.empty(0, dtype=np.int64)
+        starts = np.searchsorted(self.keys, rows * self.ncols + col_lo, "left")
+        ends = np.searchsorted(self.keys, rows * self.ncols + col_hi, "right")
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+    def _filter(self, positions, type=None, rooms=None):
+        if type is not None:
+            types = [type] if isinstance(type, str) else list(type)
+            codes = [self.type_values.index(t) for t in types if t in self.type_values]
+            positions = positions[np.isin(self.type_codes[positions], codes)]
+        if rooms is not None:
+            if isinstance(rooms, tuple):
+                low, high = rooms
+                values = self.rooms[positions]
+                keep = ~np.isnan(values)
+                if low is not None:
+                    keep &= values >= low
+                if high is not None:
+                    keep &= values <= high
+                positions = positions[keep]
+            else:
+                positions = positions[self.rooms[positions] == rooms]
+        return positions
+
+    def radius(self, lat, lon, radius_m, type=None, rooms=None):
+        """Ids and distances of points within ``radius_m``, nearest first.
+
+        ``type`` is a type name or list of names, ``rooms`` an exact value
+        or an inclusive ``(low, high)`` range with ``None`` for open ends.
+        """
+        positions = self._filter(self._candidates(lat, lon, radius_m), type, rooms)
+        meters = haversine_m(lat, lon, self.lat[positions], self.lon[positions])
+        inside = meters <= radius_m
+        positions, meters = positions[inside], meters[inside]
+        order = np.argsort(meters, kind="stable")
+        return self.ids[positions[order]], meters[order]
+
+    def nearest(self, lat, lon, k=10, type=None, rooms=None, max_radius_m=50000):
+        """The ``k`` nearest points (after filters) within ``max_radius_m``."""
+        radius_m = self.cell_m
+        while True:
+            ids, meters = self.radius(lat, lon, radius_m, type, rooms)
+            # Everything within radius_m is found, so the k closest of them
+            # are the true k nearest once there are at least k.
+            if len(ids) >= k or radius_m >= max_radius_m:
+                return ids[:k], meters[:k]
+            radius_m = min(radius_m * 2, max_radius_m)
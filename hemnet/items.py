@@ -40,6 +40,10 @@ class HemnetItem(scrapy.Item):
     biarea = scrapy.Field()
 
     address = scrapy.Field()
+    address_street = scrapy.Field()
+    address_number = scrapy.Field()
+    address_unit = scrapy.Field()
+    address_key = scrapy.Field()
     geographic_area = scrapy.Field()
     latitude = scrapy.Field()
     longitude = scrapy.Field()
@@ -57,6 +61,8 @@ class HemnetItem(scrapy.Item):
     is_bidding_ongoing = scrapy.Field()
     bidding_started = scrapy.Field()
     published_at = scrapy.Field()
+    # Watch mode only: epoch seconds when a poll first saw the listing.
+    detected_at = scrapy.Field()
     times_viewed = scrapy.Field()
     verified_bidding = scrapy.Field()
     listing_broker_url = scrapy.Field()
@@ -0,0 +1,327 @@
+"""Link sold hemnet_items rows to the active listings they were sold from.
+
+A sold record has its own id and rarely more than a street address,
+coordinates, area and rooms in common with its active listing. Candidates
+come from three blocking indexes instead of comparing every pair:
+
+* the building key of :func:`hemnet.address.address_key`,
+* a ~150 m coordinate grid cell (and its neighbours) with the same rooms,
+* the prev-page links in ``hemnet_comp_items`` (``salda_id`` -> ``hemnet_id``).
+
+Blocks larger than ``max_block`` are skipped. Each candidate pair gets a
+log-odds score from address, unit, distance, area, rooms, post code and type
+agreement, ``confidence`` is its logistic, and pairs are then assigned one to
+one, best first, into ``hemnet_listing_links``::
+
+    python -m hemnet.linkage link [--min-confidence 0.8]
+"""
+import argparse
+import math
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select
+
+from .address import parse_address, type_key
+from .geo import METERS_PER_DEGREE, haversine_m
+from .models import HemnetCompItem, HemnetItem, HemnetListingLink
+from .partitions import as_date
+
+CELL_M = 150.0
+# Sweden lies between ~55 and ~69 degrees north; one longitude step covers
+# about CELL_M at 62 degrees.
+_LAT_STEP = CELL_M / METERS_PER_DEGREE
+_LON_STEP = _LAT_STEP / math.cos(math.radians(62.0))
+
+# Log-odds contributions; the prior makes an unsupported pair very unlikely.
+WEIGHTS = {
+    "prior": -6.0,
+    "prev_page": 9.0,
+    "same_address": 6.0,
+    "other_address": -3.0,
+    "same_unit": 1.5,
+    "other_unit": -2.0,
+    "within_50m": 3.0,
+    "within_150m": 1.5,
+    "beyond_500m": -5.0,
+    "same_area": 2.0,
+    "close_area": 1.0,
+    "other_area": -3.0,
+    "same_rooms": 1.0,
+    "other_rooms": -2.5,
+    "same_post_code": 1.0,
+    "other_post_code": -2.0,
+    "other_type": -2.0,
+}
+
+COLUMNS = (
+    "id", "hemnet_id", "sold_date", "address", "post_code", "square_meters",
+    "rooms", "latitude", "longitude", "type", "asked_price", "price",
+    "published_at", "collected_at",
+)
+
+
+class Records(object):
+    """Column arrays of one side (active or sold) of hemnet_items."""
+
+    def __init__(self, rows, codes):
+        n = len(rows)
+        self.id = np.array([r["id"] for r in rows], dtype=np.int64)
+        self.hemnet_id = [r["hemnet_id"] for r in rows]
+        self.rows = rows
+        self.area = np.array([r["square_meters"] or np.nan for r in rows], dtype=np.float64)
+        self.rooms = np.array([np.nan if r["rooms"] is None else r["rooms"] for r in rows],
+                              dtype=np.float64)
+        self.lat = np.array([np.nan if r["latitude"] is None else r["latitude"] for r in rows],
+                            dtype=np.float64)
+        self.lon = np.array([np.nan if r["longitude"] is None else r["longitude"] for r in rows],
+                            dtype=np.float64)
+        self.key = np.full(n, -1, dtype=np.int64)
+        self.unit = np.full(n, -1, dtype=np.int64)
+        self.post_code = np.full(n, -1, dtype=np.int64)
+        self.type = np.full(n, -1, dtype=np.int64)
+        for i, row in enumerate(rows):
+            parsed = parse_address(row["address"])
+            if parsed and parsed["number"]:
+                self.key[i] = codes.setdefault(("key", parsed["key"]), len(codes))
+                if parsed["unit"]:
+                    self.unit[i] = codes.setdefault(("unit", parsed["unit"]), len(codes))
+            post_code = (row["post_code"] or "").replace(" ", "")
+            if post_code:
+                self.post_code[i] = codes.setdefault(("post", post_code), len(codes))
+            kind = type_key(row["type"])
+            if kind:
+                self.type[i] = codes.setdefault(("type", kind), len(codes))
+        self.listed = np.array(
+            [as_date(r["published_at"]) or as_date(r["collected_at"]) or np.datetime64("NaT")
+             for r in rows], dtype="datetime64[D]")
+        self.sold = np.array([as_date(r["sold_date"]) or np.datetime64("NaT") for r in rows],
+                             dtype="datetime64[D]")
+
+    def __len__(self):
+        return len(self.id)
+
+    def cells(self):
+        row = np.floor(self.lat / _LAT_STEP)
+        col = np.floor(self.lon / _LON_STEP)
+        return row, col
+
+
+def load_records(engine, batch_size=50000):
+    """(active, sold) records, one per hemnet_id, the latest row winning."""
+    table = HemnetItem.__table__
+    query = select([table.c[name] for name in COLUMNS]).order_by(table.c.id)
+    active, sold = {}, {}
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                row = dict(row)
+                side = sold if row["sold_date"] else active
+                side[row["hemnet_id"] or -row["id"]] = row
+    codes = {}
+    return Records(list(active.values()), codes), Records(list(sold.values()), codes)
+
+
+def load_prev_page_links(engine):
+    """{sold hemnet_id: set of active hemnet_ids} from hemnet_comp_items."""
+    comp = HemnetCompItem.__table__
+    query = select([comp.c.salda_id, comp.c.hemnet_id]).where(
+        comp.c.salda_id.isnot(None) & comp.c.hemnet_id.isnot(None)).distinct()
+    links = {}
+    with engine.connect() as conn:
+        for salda_id, hemnet_id in conn.execute(query):
+            links.setdefault(salda_id, set()).add(hemnet_id)
+    return links
+
+
+def _index(values, mask):
+    index = {}
+    for position in np.flatnonzero(mask):
+        index.setdefault(values[position], []).append(position)
+    return index
+
+
+def candidate_pairs(active, sold, prev_page=None, max_block=200):
+    """(sold positions, active positions) of all distinct blocked pairs."""
+    sold_parts, active_parts = [], []
+    if not len(active) or not len(sold):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    def add(sold_position, found):
+        if found and len(found) <= max_block:
+            sold_parts.append(np.full(len(found), sold_position, dtype=np.int64))
+            active_parts.append(np.asarray(found, dtype=np.int64))
+
+    by_key = _index(active.key, active.key >= 0)
+    for position in np.flatnonzero(sold.key >= 0):
+        add(position, by_key.get(sold.key[position]))
+
+    a_row, a_col = active.cells()
+    located = ~np.isnan(a_row) & ~np.isnan(active.rooms)
+    cells = list(zip(a_row[located].astype(np.int64).tolist(),
+                     a_col[located].astype(np.int64).tolist(),
+                     active.rooms[located].tolist()))
+    by_cell = {}
+    for position, cell in zip(np.flatnonzero(located), cells):
+        by_cell.setdefault(cell, []).append(position)
+    s_row, s_col = sold.cells()
+    for position in np.flatnonzero(~np.isnan(s_row) & ~np.isnan(sold.rooms)):
+        row, col, rooms = int(s_row[position]), int(s_col[position]), sold.rooms[position]
+        found = []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                found.extend(by_cell.get((row + d_row, col + d_col, rooms), ()))
+        add(position, found)
+
+    if prev_page:
+        by_hemnet_id = {h: p for p, h in enumerate(active.hemnet_id) if h is not None}
+        for position, hemnet_id in enumerate(sold.hemnet_id):
+            targets = prev_page.get(hemnet_id, ())
+            add(position, [by_hemnet_id[t] for t in targets if t in by_hemnet_id])
+
+    if not sold_parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pairs = np.unique(np.concatenate(sold_parts) * len(active) + np.concatenate(active_parts))
+    return pairs // len(active), pairs % len(active)
+
+
+def score_pairs(active, sold, s, a, prev_page=None):
+    """Log-odds score, distance and positive-evidence masks of candidate pairs."""
+    w = WEIGHTS
+    score = np.full(len(s), w["prior"])
+    evidence = {}
+
+    def apply(mask, name):
+        score[mask] += w[name]
+        if w[name] > 0:
+            evidence[name] = mask
+
+    if prev_page:
+        linked = np.array([active.hemnet_id[j] in prev_page.get(sold.hemnet_id[i], ())
+                           for i, j in zip(s.tolist(), a.tolist())], dtype=bool)
+        apply(linked, "prev_page")
+
+    both = (sold.key[s] >= 0) & (active.key[a] >= 0)
+    apply(both & (sold.key[s] == active.key[a]), "same_address")
+    apply(both & (sold.key[s] != active.key[a]), "other_address")
+    both = (sold.unit[s] >= 0) & (active.unit[a] >= 0)
+    apply(both & (sold.unit[s] == active.unit[a]), "same_unit")
+    apply(both & (sold.unit[s] != active.unit[a]), "other_unit")
+
+    distance = haversine_m(sold.lat[s], sold.lon[s], active.lat[a], active.lon[a])
+    known = ~np.isnan(distance)
+    apply(known & (distance <= 50), "within_50m")
+    apply(known & (distance > 50) & (distance <= 150), "within_150m")
+    apply(known & (distance > 500), "beyond_500m")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        area_diff = np.abs(np.log(sold.area[s] / active.area[a]))
+    known = np.isfinite(area_diff)
+    apply(known & (area_diff <= 0.03), "same_area")
+    apply(known & (area_diff > 0.03) & (area_diff <= 0.1), "close_area")
+    apply(known & (area_diff > 0.25), "other_area")
+
+    rooms_diff = np.abs(sold.rooms[s] - active.rooms[a])
+    known = ~np.isnan(rooms_diff)
+    apply(known & (rooms_diff < 0.5), "same_rooms")
+    apply(known & (rooms_diff >= 1), "other_rooms")
+
+    both = (sold.post_code[s] >= 0) & (active.post_code[a] >= 0)
+    apply(both & (sold.post_code[s] == active.post_code[a]), "same_post_code")
+    apply(both & (sold.post_code[s] != active.post_code[a]), "other_post_code")
+    both = (sold.type[s] >= 0) & (active.type[a] >= 0)
+    apply(both & (sold.type[s] != active.type[a]), "other_type")
+
+    return score, distance, evidence
+
+
+def link(active, sold, prev_page=None, min_confidence=0.8, max_days=730,
+         max_block=200):
+    """One-to-one links as dicts ready for hemnet_listing_links."""
+    s, a = candidate_pairs(active, sold, prev_page, max_block)
+    # A sale has to come after the listing went up, and not years later.
+    # NaT does not survive a cast to float (it becomes INT64_MIN, not NaN),
+    # so unknown dates are found on the timedelta itself.
+    delta = sold.sold[s] - active.listed[a]
+    unknown = np.isnat(delta)
+    days = np.where(unknown, np.nan, delta.astype(np.int64).astype(np.float64))
+    plausible = unknown | ((days >= -7) & (days <= max_days))
+    s, a, days = s[plausible], a[plausible], days[plausible]
+
+    score, distance, evidence = score_pairs(active, sold, s, a, prev_page)
+    confidence = 1.0 / (1.0 + np.exp(-score))
+    now = datetime.now()
+    links = []
+    used_sold, used_active = set(), set()
+    for i in np.argsort(-confidence, kind="stable"):
+        if confidence[i] < min_confidence:
+            break
+        si, ai = int(s[i]), int(a[i])
+        if si in used_sold or ai in used_active:
+            continue
+        used_sold.add(si)
+        used_active.add(ai)
+        sold_row, active_row = sold.rows[si], active.rows[ai]
+        links.append({
+            "sold_item_id": sold_row["id"],
+            "active_item_id": active_row["id"],
+            "sold_hemnet_id": sold_row["hemnet_id"],
+            "active_hemnet_id": active_row["hemnet_id"],
+            "confidence": float(confidence[i]),
+            "evidence": ",".join(name for name, mask in evidence.items() if mask[i]),
+            "distance_m": None if np.isnan(distance[i]) else float(distance[i]),
+            "asked_price": active_row["asked_price"],
+            "sold_price": sold_row["price"],
+            "sold_date": as_date(sold_row["sold_date"]),
+            "days_listed": None if np.isnan(days[i]) else int(days[i]),
+            "linked_at": now,
+        })
+    return links
+
+
+def relink(engine, min_confidence=0.8, log=print, batch_size=5000, **params):
+    """Recompute hemnet_listing_links from all of hemnet_items."""
+    started = time.perf_counter()
+    active, sold = load_records(engine)
+    prev_page = load_prev_page_links(engine)
+    if log:
+        log("loaded {} active and {} sold records in {:.1f} s".format(
+            len(active), len(sold), time.perf_counter() - started))
+    links = link(active, sold, prev_page, min_confidence, **params)
+    if log:
+        log("{} links in {:.1f} s".format(len(links), time.perf_counter() - started))
+    table = HemnetListingLink.__table__
+    with engine.begin() as conn:
+        conn.execute(table.delete())
+        for start in range(0, len(links), batch_size):
+            conn.execute(table.insert(), links[start:start + batch_size])
+    return len(links)
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["link"])
+    parser.add_argument("--min-confidence", type=float, default=0.8)
+    parser.add_argument("--max-days", type=int, default=730,
+                        help="longest plausible time from listing to sale")
+    parser.add_argument("--max-block", type=int, default=200,
+                        help="skip blocking keys shared by more active listings")
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    written = relink(engine, args.min_confidence, max_days=args.max_days,
+                     max_block=args.max_block)
+    print("{} links written".format(written))
+
+
+if __name__ == "__main__":
+    main()
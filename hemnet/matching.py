@@ -0,0 +1,260 @@
+"""Match listings against all houm_users preferences at once.
+
+Range preferences are kept as one bounds array per field (``-inf`` / ``inf``
+where a user has no bound), so a listing is checked against every user with
+a few vectorised comparisons. List preferences (housing forms, tenures,
+municipalities, regions, districts) become inverted indexes from value to
+user positions, plus a mask of users that accept any value::
+
+    matcher = PreferenceMatcher.from_database(engine)
+    matcher.match(item)        # -> [(user_id, score), ...], best first
+
+A user with a bound on a field never matches a listing that lacks that field.
+``prefer_new_construction`` / ``prefer_upcoming`` only raise the score.
+
+Bulk re-match after preferences change::
+
+    python -m hemnet.matching rematch [--user-id 12 ...]
+"""
+import argparse
+import re
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import HemnetItem, HoumMatch, HoumUser
+
+# Item field -> (user min column, user max column).
+RANGE_FIELDS = {
+    "price": ("min_price", "max_price"),
+    "rooms": ("min_rooms", "max_rooms"),
+    "square_meters": ("min_area", "max_area"),
+    "year": ("min_year", "max_year"),
+    "monthly_fee": (None, "max_monthly_fee"),
+    "coastline_distance_meters": (None, "max_coast_distance_m"),
+    "closest_water_distance_meters": (None, "max_water_distance_m"),
+}
+
+# User list column -> item fields whose values it may match.
+LIST_FIELDS = {
+    "housing_forms": ("housing_form", "type"),
+    "tenure": ("tenure",),
+    "municipalities": ("municipality_name",),
+    "regions": ("region_name", "county_name"),
+    "districts": ("districts",),
+}
+
+SCORE_FIELDS = {
+    "prefer_new_construction": "is_new_construction",
+    "prefer_upcoming": "is_upcoming",
+}
+
+_YEAR_RE = re.compile(r"\d{4}")
+
+
+def _norm(value):
+    return value.strip().lower() if isinstance(value, str) else None
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _number(field, value):
+    if value is None or value == "":
+        return None
+    if field == "year":
+        # Construction year can be a range like '2008-2009'; use the first.
+        match = _YEAR_RE.search(str(value))
+        return float(match.group()) if match else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PreferenceMatcher(object):
+    """Vectorised preference index over a set of houm_users rows."""
+
+    def __init__(self, users):
+        self.user_ids = np.array([u["id"] for u in users], dtype=np.int64)
+        n = len(users)
+
+        self.low = {}
+        self.high = {}
+        self.bounded = {}
+        for field, (low_col, high_col) in RANGE_FIELDS.items():
+            low = np.array([u.get(low_col) if low_col else None for u in users],
+                           dtype=np.float64)
+            high = np.array([u.get(high_col) for u in users], dtype=np.float64)
+            self.bounded[field] = ~(np.isnan(low) & np.isnan(high))
+            self.low[field] = np.where(np.isnan(low), -np.inf, low)
+            self.high[field] = np.where(np.isnan(high), np.inf, high)
+        # Fields nobody has a bound on are skipped when matching.
+        self.range_fields = [f for f in RANGE_FIELDS if self.bounded[f].any()]
+
+        self.postings = {}
+        self.any_value = {}
+        for column in LIST_FIELDS:
+            postings = {}
+            any_value = np.ones(n, dtype=bool)
+            for position, user in enumerate(users):
+                values = {_norm(v) for v in _as_list(user.get(column))} - {None, ""}
+                if values:
+                    any_value[position] = False
+                for value in values:
+                    postings.setdefault(value, []).append(position)
+            self.postings[column] = {
+                value: np.array(positions, dtype=np.int64)
+                for value, positions in postings.items()
+            }
+            self.any_value[column] = any_value
+
+        self.prefers = {
+            column: np.array([bool(u.get(column)) for u in users], dtype=bool)
+            for column in SCORE_FIELDS
+        }
+
+    @classmethod
+    def from_database(cls, engine, user_ids=None):
+        table = HoumUser.__table__
+        query = select([table])
+        if user_ids:
+            query = query.where(table.c.id.in_(list(user_ids)))
+        with engine.connect() as conn:
+            users = [dict(row) for row in conn.execute(query)]
+        return cls(users)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def positions(self, item):
+        """Positions of the users whose hard preferences accept ``item``."""
+        allowed = None
+        for column, fields in LIST_FIELDS.items():
+            values = set()
+            for field in fields:
+                values.update(_norm(v) for v in _as_list(item.get(field)))
+            column_allowed = self.any_value[column].copy()
+            postings = self.postings[column]
+            for value in values:
+                found = postings.get(value)
+                if found is not None:
+                    column_allowed[found] = True
+            allowed = column_allowed if allowed is None else allowed & column_allowed
+        positions = (np.flatnonzero(allowed) if allowed is not None
+                     else np.arange(len(self)))
+
+        # Range checks only gather the users that survived the list filters.
+        for field in self.range_fields:
+            if not len(positions):
+                break
+            value = _number(field, item.get(field))
+            if value is None:
+                positions = positions[~self.bounded[field][positions]]
+            else:
+                keep = ((self.low[field][positions] <= value)
+                        & (value <= self.high[field][positions]))
+                positions = positions[keep]
+        return positions
+
+    def match(self, item):
+        """(user_id, score) pairs accepting ``item``, highest score first."""
+        positions = self.positions(item)
+        if not len(positions):
+            return []
+        scores = np.zeros(len(positions), dtype=np.int64)
+        for column, field in SCORE_FIELDS.items():
+            if item.get(field):
+                scores += self.prefers[column][positions]
+        if scores.any():
+            order = np.argsort(-scores, kind="stable")
+            positions, scores = positions[order], scores[order]
+        return list(zip(self.user_ids[positions].tolist(), scores.tolist()))
+
+
+def match_rows(matcher, item, now=None):
+    """houm_matches rows for one item."""
+    now = now or datetime.now()
+    return [
+        {"user_id": user_id, "hemnet_id": item.get("hemnet_id"),
+         "score": score, "matched_at": now}
+        for user_id, score in matcher.match(item)
+    ]
+
+
+def upsert_matches(session, rows):
+    """Insert houm_matches rows, refreshing score and time of existing ones."""
+    if not rows:
+        return
+    stmt = insert(HoumMatch.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "hemnet_id"],
+        set_={"score": stmt.excluded.score, "matched_at": stmt.excluded.matched_at},
+    )
+    session.execute(stmt, rows)
+
+
+def rematch(engine, user_ids=None, batch_size=5000):
+    """Recompute houm_matches against all active listings.
+
+    With ``user_ids`` only those users' matches are replaced.
+    """
+    matcher = PreferenceMatcher.from_database(engine, user_ids)
+    items = HemnetItem.__table__
+    fields = {"hemnet_id"} | set(RANGE_FIELDS) | set(SCORE_FIELDS.values())
+    for item_fields in LIST_FIELDS.values():
+        fields.update(item_fields)
+    # A listing is stored once per crawl; match its latest observation.
+    query = (
+        select([items.c[f] for f in sorted(fields)])
+        .where(items.c.sold_date.is_(None))
+        .distinct(items.c.hemnet_id)
+        .order_by(items.c.hemnet_id, items.c.id.desc())
+    )
+    matches = HoumMatch.__table__
+
+    now = datetime.now()
+    written = 0
+    with engine.begin() as conn:
+        delete = matches.delete()
+        if user_ids:
+            delete = delete.where(matches.c.user_id.in_(list(user_ids)))
+        conn.execute(delete)
+        if not len(matcher):
+            return 0
+        rows = []
+        for item in conn.execution_options(stream_results=True).execute(query):
+            rows.extend(match_rows(matcher, dict(item), now))
+            if len(rows) >= batch_size:
+                conn.execute(matches.insert(), rows)
+                written += len(rows)
+                rows = []
+        if rows:
+            conn.execute(matches.insert(), rows)
+            written += len(rows)
+    return written
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["rematch"])
+    parser.add_argument("--user-id", type=int, action="append",
+                        help="only re-match these users (default: all)")
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    print("{} matches written".format(rematch(engine, args.user_id)))
+
+
+if __name__ == "__main__":
+    main()
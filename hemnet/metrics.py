@@ -0,0 +1,169 @@
+"""Live crawl metrics in the Prometheus text format.
+
+``MetricsExporter`` (hemnet.extensions) serves ``REGISTRY`` on
+``http://127.0.0.1:<METRICS_PORT>/metrics`` while a crawl runs: requests and
+responses by page type (the request class of hemnet.priority), status and
+fetch (``browser`` or ``http``), download and parse-callback times, pipeline
+image-download and DB-commit times, queue depths, items and pages per second,
+every numeric Scrapy stat, and per item the time from scheduling its request
+to the DB commit. Enable it with ``HEMNET_METRICS_PORT``::
+
+    HEMNET_METRICS_PORT=9410 scrapy crawl hemnetspider
+    curl -s 127.0.0.1:9410/metrics
+
+Code outside the crawler (the pipeline) records into ``REGISTRY`` with
+``timer``; that costs next to nothing while nothing is exported.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers sub-millisecond parsing up to slow browser fetches.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, 60.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for name, key, extra, value in self.samples():
+            lines.append("{}{} {}".format(name, _labels(self.labelnames, key, extra),
+                                          _number(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total))
+                           for key, (counts, total) in self.values.items())
+        samples = []
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + "_bucket", key, (("le", _number(bound)),), count))
+            samples.append((self.name + "_sum", key, (), total))
+            samples.append((self.name + "_count", key, (), counts[-1]))
+        return samples
+
+
+class Registry(object):
+    """Metrics by name; ``counter``/``gauge``/``histogram`` create them on first use."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+IMAGE_DOWNLOAD = REGISTRY.histogram(
+    "hemnet_pipeline_image_download_seconds", "Image downloads in the pipeline.", ("kind",))
+DB_COMMIT = REGISTRY.histogram(
+    "hemnet_pipeline_db_commit_seconds", "Pipeline DB writes up to the commit.", ("item_type",))
+CALLBACK = REGISTRY.histogram(
+    "hemnet_parse_seconds", "Time spent in spider callbacks.", ("callback",))
+
+
+@contextmanager
+def timer(histogram, **labels):
+    """Observe the seconds spent in the ``with`` block."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
@@ -1,6 +1,23 @@
+import logging
+import time
 from random import choice
 from scrapy import signals
-from scrapy.exceptions import NotConfigured
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.threads import deferToThread
+
+from .blocking import CircuitBreaker, RequestQueued, RetryQueue, block_reason, block_source
+from .browser import handler_deferred, playwright_handler, state_path, with_stored_state
+from .frontier import _fingerprinter
+from .metrics import CALLBACK
+from .pool import ProxyPool
+from .ratelimit import TOTAL, DEFAULT_BUDGETS, open_buckets, request_class
+from .sessions import (
+    DEFAULT_CONSENT_SELECTORS, Session, SessionIndex, close_context, load_cookies,
+    load_jar, rotation_reason, save_jar, warm_context, warm_http,
+)
 
 
 class RotateUserAgentMiddleware(object):
@@ -8,6 +25,7 @@ class RotateUserAgentMiddleware(object):
     def __init__(self, user_agents):
         self.enabled = False
         self.user_agents = user_agents
+        self.session_agents = {}
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -27,5 +45,499 @@ class RotateUserAgentMiddleware(object):
     def process_request(self, request, spider):
         if not self.enabled or not self.user_agents:
             return
+        # Pool members keep one user agent per session.
+        if 'pool_member' in request.meta:
+            return
+
+        jar = request.meta.get('cookiejar')
+        if jar is not None:
+            # Same for a cookie session (hemnet.sessions): one browser, one agent.
+            request.headers['user-agent'] = self.session_agents.setdefault(
+                jar, choice(self.user_agents))
+            return
+        request.headers['user-agent'] = choice(self.user_agents)
+
+
+class SharedRateLimitMiddleware(object):
+    """Hold each request until the shared rate budget has room for it.
+
+    The request class is ``request.meta['rate_class']`` or derived from the
+    URL; every request also counts against the ``total`` bucket.
+    """
+    def __init__(self, buckets, stats):
+        self.buckets = buckets
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        backend = crawler.settings.get('RATE_LIMIT_BACKEND')
+        if not backend:
+            raise NotConfigured("RATE_LIMIT_BACKEND not set")
+
+        buckets = open_buckets(backend)
+        # Existing buckets keep their (possibly live-tuned) budget.
+        buckets.configure(crawler.settings.getdict('RATE_LIMIT_BUDGETS') or DEFAULT_BUDGETS,
+                          overwrite=False)
+        return cls(buckets, crawler.stats)
+
+    def process_request(self, request, spider):
+        name = request.meta.get('rate_class') or request_class(request.url)
+        d = deferToThread(self.buckets.reserve, (TOTAL, name))
+        d.addCallback(self._hold, name, spider)
+        return d
+
+    def _hold(self, wait, name, spider):
+        self.stats.inc_value('ratelimit/{}'.format(name), spider=spider)
+        if wait <= 0:
+            return None
+        self.stats.inc_value('ratelimit/delayed', spider=spider)
+        self.stats.inc_value('ratelimit/wait_seconds', wait, spider=spider)
+        return deferLater(reactor, wait, lambda: None)
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlockGuardMiddleware(object):
+    """Back off on 403s and challenge pages and park blocked requests for later."""
+    def __init__(self, crawler, queue, breaker):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.queue = queue
+        self.breaker = breaker
+        self.min_delay = settings.getfloat('BLOCK_BACKOFF_MIN', 5.0)
+        self.max_delay = settings.getfloat('BLOCK_BACKOFF_MAX', 300.0)
+        self.poll_secs = settings.getfloat('RETRY_QUEUE_POLL_SECS', 30.0)
+        self.idle_secs = settings.getfloat('RETRY_QUEUE_IDLE_SECS', 3600.0)
+        self.retry_times = settings.getint('RETRY_TIMES', 2)
+        self.delay = 0.0
+        self.next_send = 0.0
+        self.spider = None
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('BLOCK_GUARD_ENABLED'):
+            raise NotConfigured("BLOCK_GUARD_ENABLED is off")
+
+        from .models import db_connect, create_hemnet_table
+        engine = db_connect()
+        create_hemnet_table(engine)
+        queue = RetryQueue(
+            engine, _fingerprinter(crawler),
+            base_secs=settings.getfloat('RETRY_QUEUE_BASE_SECS', 600.0),
+            max_attempts=settings.getint('RETRY_QUEUE_MAX_ATTEMPTS', 5),
+        )
+        breaker = CircuitBreaker(
+            window=settings.getint('BLOCK_WINDOW', 50),
+            open_ratio=settings.getfloat('BLOCK_OPEN_RATIO', 0.3),
+            cooldown=settings.getfloat('BLOCK_COOLDOWN_SECS', 300.0),
+        )
+        o = cls(crawler, queue, breaker)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.spider_idle, signal=signals.spider_idle)
+        return o
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.loop = LoopingCall(self.requeue_due)
+        self.loop.start(self.poll_secs, now=True)
+
+    def spider_closed(self, spider):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def spider_idle(self, spider):
+        # Stay open for retries that come due soon, so blocked work recovers
+        # within the run; anything later is picked up by the next run.
+        if self.queue.pending(spider, self.idle_secs):
+            raise DontCloseSpider
+
+    def requeue_due(self):
+        for request in self.queue.pop_due(self.spider):
+            self.stats.inc_value('retry_queue/requeued', spider=self.spider)
+            try:
+                self.crawler.engine.crawl(request)
+            except TypeError:  # Scrapy < 2.6
+                self.crawler.engine.crawl(request, self.spider)
+
+    def process_request(self, request, spider):
+        now = time.monotonic()
+        wait = self.breaker.wait(now)
+        if wait > 0:
+            # Hold the request (and with it a concurrency slot), then check again.
+            return deferLater(reactor, min(wait, self.poll_secs),
+                              self.process_request, request, spider)
+        wait = max(0.0, self.next_send - now)
+        self.next_send = max(now, self.next_send) + self.delay
+        if wait > 0:
+            return deferLater(reactor, wait, lambda: None)
+        return None
+
+    def process_response(self, request, response, spider):
+        reason = block_reason(response)
+        if reason is None:
+            self.delay = self.delay * 0.9 if self.delay > self.min_delay / 10 else 0.0
+            self.breaker.record(False)
+            self.queue.done(request, spider)
+            return response
+
+        self.delay = min(max(self.delay * 2, self.min_delay), self.max_delay)
+        source = block_source(request)
+        self.stats.inc_value('blocks/count', spider=spider)
+        self.stats.inc_value('blocks/reason/{}'.format(reason), spider=spider)
+        for kind, value in source.items():
+            if value:
+                self.stats.inc_value('blocks/{}/{}'.format(kind, value[:60]), spider=spider)
+        self.stats.max_value('blocks/max_delay', self.delay, spider=spider)
+        if self.breaker.record(True):
+            self.stats.inc_value('blocks/circuit_opened', spider=spider)
+            logger.warning("Circuit breaker open for %.0f s after %s on %s (%s)",
+                           self.breaker.cooldown, reason, request.url, source)
+        self._park(request, spider, reason, source)
+        raise RequestQueued(reason)
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            return None
+        if self.breaker.state == "half-open":
+            self.breaker.probe_failed()
+        # Only once Scrapy's RetryMiddleware has given up on it.
+        if request.meta.get('dont_retry'):
+            return None
+        if request.meta.get('retry_times', 0) >= request.meta.get('max_retry_times', self.retry_times):
+            self._park(request, spider, type(exception).__name__, None)
+        return None
+
+    def _park(self, request, spider, reason, source):
+        # Frontier requests are retried by the frontier's lease expiry.
+        if 'frontier_fingerprint' in request.meta:
+            return
+        attempts = self.queue.push(request, spider, reason, source)
+        if attempts is None:
+            self.stats.inc_value('retry_queue/gave_up', spider=spider)
+        else:
+            self.stats.inc_value('retry_queue/queued', spider=spider)
+
+
+class PoolMiddleware(object):
+    """Send each request through a healthy member of the proxy/context pool."""
+    def __init__(self, pool, stats, report_secs=60.0):
+        self.pool = pool
+        self.stats = stats
+        self.report_secs = report_secs
+        self.loop = None
+        self.spider = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        proxies = settings.getlist('POOL_PROXIES')
+        contexts = settings.getint('POOL_CONTEXTS', 1)
+        if not proxies and contexts <= 1:
+            raise NotConfigured("POOL_PROXIES empty and POOL_CONTEXTS <= 1")
+
+        context_kwargs = dict(settings.getdict('PLAYWRIGHT_CONTEXTS').get('default') or {})
+        pool = ProxyPool.build(
+            proxies, contexts, settings.getlist('USER_AGENT_CHOICES'), context_kwargs,
+            rest_secs=settings.getfloat('POOL_REST_SECS', 60.0),
+        )
+        for member in pool.members:
+            # Each member context restores its own saved state, not the default's.
+            if settings.getbool('BROWSER_STATE_ENABLED'):
+                member.context_kwargs = with_stored_state(
+                    member.context_kwargs, settings.get('BROWSER_STATE_DIR'), member.name)
+            else:
+                member.context_kwargs.pop('storage_state', None)
+        o = cls(pool, crawler.stats, settings.getfloat('POOL_REPORT_SECS', 60.0))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        # Signals rather than process_response/process_exception: later
+        # middlewares (BlockGuard, Retry) may end the chain before it gets here.
+        crawler.signals.connect(o.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(o.request_left_downloader,
+                                signal=signals.request_left_downloader)
+        return o
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        for name, health in self.pool.report().items():
+            logger.info("Pool member %s: %s", name, health['proxy'] or 'direct')
+        self.loop = LoopingCall(self.report)
+        self.loop.start(self.report_secs, now=False)
+
+    def spider_closed(self, spider):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.report()
+
+    def report(self):
+        for name, health in self.pool.report().items():
+            for key in ('success', 'latency', 'recent_blocks', 'score'):
+                self.stats.set_value('pool/{}/{}'.format(name, key), health[key],
+                                     spider=self.spider)
+            logger.debug("Pool member %s: %s", name, health)
+
+    def process_request(self, request, spider):
+        if 'pool_member' in request.meta:
+            return None
+        member = self.pool.choose()
+        request.meta['pool_member'] = member.name
+        request.meta['download_slot'] = member.name
+        if request.meta.get('playwright'):
+            # The proxy belongs to the browser context; meta['proxy'] would
+            # only add a Proxy-Authorization header to the page request.
+            request.meta['playwright_context'] = member.name
+            request.meta['playwright_context_kwargs'] = member.playwright_context_kwargs()
+        elif member.proxy:
+            request.meta['proxy'] = member.proxy
+        if member.user_agent:
+            request.headers['User-Agent'] = member.user_agent
+        self.pool.started(member)
+        self.stats.inc_value('pool/{}/requests'.format(member.name), spider=spider)
+        return None
+
+    def response_downloaded(self, response, request, spider):
+        member = self.pool.by_name.get(request.meta.get('pool_member'))
+        if member is None:
+            return
+        request.meta['pool_outcome'] = True
+        blocked = block_reason(response) is not None
+        self.pool.record(member, ok=not blocked and response.status < 500,
+                         latency=request.meta.get('download_latency'), blocked=blocked)
+        if blocked:
+            self.stats.inc_value('pool/{}/blocks'.format(member.name), spider=spider)
+
+    def request_left_downloader(self, request, spider):
+        member = self.pool.by_name.get(request.meta.get('pool_member'))
+        if member is None or request.meta.pop('pool_outcome', False):
+            return
+        # No response: timeout, connection error.
+        self.pool.record(member, ok=False)
+        self.stats.inc_value('pool/{}/failures'.format(member.name), spider=spider)
+
+
+class SessionMiddleware(object):
+    """Warm up, persist and rotate the session (browser context or cookie jar) of each request."""
+    def __init__(self, crawler, index):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.index = index
+        self.sessions = index.load()
+        self.state_dir = (settings.get('BROWSER_STATE_DIR')
+                          if settings.getbool('BROWSER_STATE_ENABLED') else None)
+        self.contexts = settings.getdict('PLAYWRIGHT_CONTEXTS')
+        self.warmup_url = settings.get('SESSION_WARMUP_URL', 'https://www.hemnet.se/')
+        self.consent_selectors = (settings.getlist('SESSION_CONSENT_SELECTORS')
+                                  or DEFAULT_CONSENT_SELECTORS)
+        self.policy = {
+            'max_age_secs': settings.getfloat('SESSION_MAX_AGE_SECS', 6 * 3600),
+            'expiry_margin_secs': settings.getfloat('SESSION_EXPIRY_MARGIN_SECS', 1800),
+            'max_block_rate': settings.getfloat('SESSION_MAX_BLOCK_RATE', 0.3),
+        }
+        self.save_secs = settings.getfloat('BROWSER_STATE_SAVE_SECS', 300)
+        self.http_sessions = set()
+        self.spider = None
+        self.loop = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('SESSIONS_ENABLED'):
+            raise NotConfigured("SESSIONS_ENABLED is off")
+
+        state_dir = (settings.get('BROWSER_STATE_DIR')
+                     if settings.getbool('BROWSER_STATE_ENABLED') else None)
+        o = cls(crawler, SessionIndex(state_dir))
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(o.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(o.request_left_downloader,
+                                signal=signals.request_left_downloader)
+        return o
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.loop = LoopingCall(self.save)
+        self.loop.start(self.save_secs, now=False)
+
+    def spider_closed(self, spider):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.save()
+        for name, session in self.sessions.items():
+            self.stats.set_value('sessions/{}/block_rate'.format(name),
+                                 round(session.block_rate(), 3), spider=spider)
+
+    def save(self):
+        if self.state_dir:
+            for name in self.http_sessions:
+                save_jar(self._jar(name).jar, self.state_dir, name)
+        self.index.save(self.sessions)
+
+    def _jar(self, name):
+        for middleware in self.crawler.engine.downloader.middleware.middlewares:
+            if hasattr(middleware, 'jars'):
+                return middleware.jars[name]
+        raise NotConfigured("CookiesMiddleware is not enabled")
+
+    def _session(self, name, browser):
+        session = self.sessions.get(name)
+        if session is None:
+            session = self.sessions[name] = Session(name)
+        if not session.loaded:
+            # First use in this process: pick up the saved state, if any.
+            session.loaded = True
+            if browser:
+                restored = state_path(self.state_dir, name).exists() if self.state_dir else False
+            else:
+                self.http_sessions.add(name)
+                restored = bool(self.state_dir) and load_jar(self._jar(name).jar,
+                                                             self.state_dir, name)
+            if not restored:
+                session.warmed_at = None
+        return session
+
+    def process_request(self, request, spider):
+        browser = bool(request.meta.get('playwright'))
+        if browser:
+            name = request.meta.setdefault('playwright_context', 'default')
+            kwargs = request.meta.get('playwright_context_kwargs') or self.contexts.get(name)
+            request.meta['playwright_context_kwargs'] = with_stored_state(
+                kwargs, self.state_dir, name)
+        else:
+            name = request.meta.setdefault('cookiejar', request.meta.get('pool_member', 'http'))
+        session = self._session(name, browser)
+
+        if session.rotating is None:
+            session.rotating = rotation_reason(session, time.time(), **self.policy)
+            if session.rotating:
+                self.stats.inc_value('sessions/rotated/{}'.format(session.rotating),
+                                     spider=spider)
+        if session.rotating or session.warmed_at is None:
+            if session.busy:
+                return deferLater(reactor, 1.0, self.process_request, request, spider)
+            d = self._prepare(session, browser, request)
+            d.addCallback(lambda _: self.process_request(request, spider))
+            return d
+
+        session.in_flight += 1
+        session.requests += 1
+        request.meta['session'] = name
+        self.stats.inc_value('sessions/{}/requests'.format(name), spider=spider)
+        return None
+
+    @inlineCallbacks
+    def _prepare(self, session, browser, request):
+        """Rotate (if due) and warm up ``session``; requests for it wait meanwhile."""
+        session.busy = True
+        try:
+            if session.rotating:
+                while session.in_flight:
+                    yield deferLater(reactor, 1.0, lambda: None)
+                yield self._discard(session, browser)
+                logger.info("Session %s rotated", session.name)
+            cookies = yield self._warm(session, browser, request)
+            self.stats.inc_value('sessions/warmed', spider=self.spider)
+        except Exception as e:
+            # Crawl on with a cold session rather than not at all.
+            logger.warning("Warming up session %s failed: %s", session.name, e)
+            self.stats.inc_value('sessions/warmup_failed', spider=self.spider)
+            session.rotating = None
+            cookies = []
+        finally:
+            session.busy = False
+        session.warmed(cookies)
+        self.index.save(self.sessions)
+
+    @inlineCallbacks
+    def _discard(self, session, browser):
+        if browser:
+            handler = playwright_handler(self.crawler)
+            if handler is not None:
+                yield handler_deferred(handler, close_context(handler, session.name))
+        else:
+            self._jar(session.name).jar.clear()
+        if self.state_dir:
+            path = state_path(self.state_dir, session.name)
+            if path.exists():
+                path.unlink()
+        session.reset()
+
+    @inlineCallbacks
+    def _warm(self, session, browser, request):
+        if browser:
+            handler = playwright_handler(self.crawler)
+            if handler is None:
+                return []
+            kwargs = with_stored_state(request.meta.get('playwright_context_kwargs'),
+                                       self.state_dir, session.name)
+            cookies = yield handler_deferred(handler, warm_context(
+                handler, session.name, kwargs, self.warmup_url, self.consent_selectors))
+        else:
+            user_agent = request.headers.get('User-Agent')
+            if isinstance(user_agent, bytes):
+                user_agent = user_agent.decode('latin-1')
+            cookies = yield deferToThread(warm_http, self.warmup_url, user_agent,
+                                          request.meta.get('proxy'))
+            load_cookies(self._jar(session.name).jar, cookies)
+        return cookies
+
+    def response_downloaded(self, response, request, spider):
+        session = self.sessions.get(request.meta.get('session'))
+        if session is None:
+            return
+        blocked = block_reason(response) is not None
+        session.record(blocked)
+        if blocked:
+            self.stats.inc_value('sessions/{}/blocks'.format(session.name), spider=spider)
+
+    def request_left_downloader(self, request, spider):
+        session = self.sessions.get(request.meta.pop('session', None))
+        if session is not None:
+            session.in_flight = max(session.in_flight - 1, 0)
+
+
+class CallbackTimerMiddleware(object):
+    """Spider middleware timing each callback (``hemnet_parse_seconds``, hemnet.metrics).
+
+    Only the time spent inside the callback's generator counts, not what
+    later middlewares and the engine do with its output.
+    """
+
+    @staticmethod
+    def _callback_name(response):
+        callback = response.request.callback if response is not None else None
+        return getattr(callback, "__name__", "parse")
+
+    def process_spider_output(self, response, result, spider=None):
+        elapsed = 0.0
+        results = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                value = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield value
+        CALLBACK.observe(elapsed, callback=self._callback_name(response))
 
-        request.headers['user-agent'] = choice(self.user_agents)
\ No newline at end of file
+    async def process_spider_output_async(self, response, result, spider=None):
+        elapsed = 0.0
+        results = result.__aiter__()
+        while True:
+            start = time.perf_counter()
+            try:
+                value = await results.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield value
+        CALLBACK.observe(elapsed, callback=self._callback_name(response))
@@ -13,9 +13,16 @@ from sqlalchemy import (
     Text,
     JSON,
     LargeBinary,
+    ForeignKey,
+    Index,
+    DDL,
+    event,
+    text,
 )
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.engine.url import URL
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import deferred, relationship
 
 from . import settings
 
@@ -35,6 +42,18 @@ def create_hemnet_table(engine):
 
 class HemnetItem(DeclarativeBase):
     __tablename__ = "hemnet_items"
+    # Composite indexes for the broker/date aggregates in queries.sql. The
+    # trigram indexes for LIKE '%...%' searches need pg_trgm and live in
+    # create.sql / migrations/003_query_indexes.sql.
+    __table_args__ = (
+        Index("ix_hemnet_items_broker_email_sold_date_price",
+              "broker_email", "sold_date", "price"),
+        Index("ix_hemnet_items_broker_name_email", "broker_name", "broker_email"),
+        Index("ix_hemnet_items_sold_date", "sold_date"),
+        Index("ix_hemnet_items_price", "price"),
+        Index("ix_hemnet_items_rooms", "rooms"),
+        Index("ix_hemnet_items_address_key", "address_key"),
+    )
 
     id = Column(BigInteger, primary_key=True, autoincrement=True)
 
@@ -44,7 +63,7 @@ class HemnetItem(DeclarativeBase):
 
     broker_name = Column(String, default='')
     broker_phone = Column(String, default='')
-    broker_email = Column(String, default='', index=True)
+    broker_email = Column(String, default='')
 
     broker_firm = Column(String, nullable=True)
     broker_firm_phone = Column(String, nullable=True)
@@ -68,6 +87,11 @@ class HemnetItem(DeclarativeBase):
     biarea = Column(Integer, nullable=True)
 
     address = Column(String, default='')
+    # Canonical form of `address` (see hemnet.address), set by AddressPipeline.
+    address_street = Column(String, nullable=True)
+    address_number = Column(String, nullable=True)
+    address_unit = Column(String, nullable=True)
+    address_key = Column(String, nullable=True)
     geographic_area = Column(String, default='')
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
@@ -75,7 +99,6 @@ class HemnetItem(DeclarativeBase):
 
     listing_url = Column(String, nullable=True)
     title = Column(String, nullable=True)
-    description = Column(Text, nullable=True)
     housing_form = Column(String, nullable=True)
     tenure = Column(String, nullable=True)
     days_on_hemnet = Column(Integer, nullable=True)
@@ -88,14 +111,49 @@ class HemnetItem(DeclarativeBase):
     bidding_started = Column(Boolean, nullable=True)
     published_at = Column(DateTime, nullable=True)
     times_viewed = Column(Integer, nullable=True)
-    verified_bidding = Column(JSON, nullable=True)
-    listing_broker_url = Column(String, nullable=True)
-    listing_broker_gallery_url = Column(String, nullable=True)
     post_code = Column(String, nullable=True)
     municipality_name = Column(String, nullable=True)
     region_name = Column(String, nullable=True)
     county_name = Column(String, nullable=True)
     districts = Column(JSON, nullable=True)
+    housing_cooperative_name = Column(String, nullable=True)
+    yearly_arrende_fee = Column(Integer, nullable=True)
+    yearly_leasehold_fee = Column(Integer, nullable=True)
+    land_area = Column(Float, nullable=True)
+    supplemental_area = Column(Float, nullable=True)
+    closest_water_distance_meters = Column(Integer, nullable=True)
+    coastline_distance_meters = Column(Integer, nullable=True)
+
+    # Cold side tables. Lazy relationships keep ORM queries on the hot table
+    # from ever reading description/JSON/image pages.
+    detail = relationship(
+        "HemnetItemDetail", uselist=False, lazy="select",
+        cascade="all, delete-orphan",
+    )
+    image = relationship(
+        "HemnetItemImage", uselist=False, lazy="select",
+        cascade="all, delete-orphan",
+    )
+
+
+class HemnetItemDetail(DeclarativeBase):
+    """Cold listing text and raw JSON payloads, one row per hemnet_items row."""
+    __tablename__ = "hemnet_item_details"
+    __table_args__ = (
+        Index("ix_hemnet_item_details_search_vector", "search_vector",
+              postgresql_using="gin"),
+    )
+
+    item_id = Column(
+        BigInteger,
+        ForeignKey("hemnet_items.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+    description = Column(Text, nullable=True)
+    verified_bidding = Column(JSON, nullable=True)
+    listing_broker_url = Column(String, nullable=True)
+    listing_broker_gallery_url = Column(String, nullable=True)
     labels = Column(JSON, nullable=True)
     relevant_amenities = Column(JSON, nullable=True)
     listing_collection_ids = Column(JSON, nullable=True)
@@ -115,29 +173,113 @@ class HemnetItem(DeclarativeBase):
     active_package = Column(JSON, nullable=True)
     seller_package_recommendation = Column(JSON, nullable=True)
     housing_cooperative = Column(JSON, nullable=True)
-    housing_cooperative_name = Column(String, nullable=True)
-    yearly_arrende_fee = Column(Integer, nullable=True)
-    yearly_leasehold_fee = Column(Integer, nullable=True)
-    land_area = Column(Float, nullable=True)
     formatted_land_area = Column(String, nullable=True)
     formatted_living_area = Column(String, nullable=True)
     formatted_supplemental_area = Column(String, nullable=True)
-    supplemental_area = Column(Float, nullable=True)
     formatted_floor = Column(String, nullable=True)
-    closest_water_distance_meters = Column(Integer, nullable=True)
-    coastline_distance_meters = Column(Integer, nullable=True)
-    raw_listing = Column(JSON, nullable=True)
-    raw_apollo_state = Column(JSON, nullable=True)
+    raw_listing = deferred(Column(JSON, nullable=True))
+    raw_apollo_state = deferred(Column(JSON, nullable=True))
     broker_raw = Column(JSON, nullable=True)
     broker_agency_raw = Column(JSON, nullable=True)
+    # Written by database triggers (create.sql / migrations/005, or
+    # SEARCH_VECTOR_DDL below), never by the ORM; see hemnet.search.
+    search_vector = deferred(Column(TSVECTOR, nullable=True))
+
+
+# The search_vector functions and triggers of create.sql / migrations/005, so
+# a schema made by create_all() is searchable too.
+SEARCH_VECTOR_DDL = (
+    """
+    CREATE OR REPLACE FUNCTION hemnet_item_search_vector(title TEXT, description TEXT)
+    RETURNS TSVECTOR LANGUAGE SQL IMMUTABLE AS $$
+        SELECT setweight(to_tsvector('swedish', coalesce(title, '')), 'A')
+            || setweight(to_tsvector('swedish', coalesce(description, '')), 'B')
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION hemnet_item_details_search() RETURNS TRIGGER
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.search_vector := hemnet_item_search_vector(
+            (SELECT title FROM hemnet_items WHERE id = NEW.item_id),
+            NEW.description
+        );
+        RETURN NEW;
+    END
+    $$
+    """,
+    """
+    CREATE OR REPLACE FUNCTION hemnet_items_title_search() RETURNS TRIGGER
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        UPDATE hemnet_item_details
+        SET search_vector = hemnet_item_search_vector(NEW.title, description)
+        WHERE item_id = NEW.id;
+        RETURN NULL;
+    END
+    $$
+    """,
+    """
+    CREATE TRIGGER hemnet_item_details_search
+        BEFORE INSERT OR UPDATE OF description ON hemnet_item_details
+        FOR EACH ROW EXECUTE FUNCTION hemnet_item_details_search()
+    """,
+    "DROP TRIGGER IF EXISTS hemnet_items_title_search ON hemnet_items",
+    """
+    CREATE TRIGGER hemnet_items_title_search
+        AFTER UPDATE OF title ON hemnet_items
+        FOR EACH ROW WHEN (OLD.title IS DISTINCT FROM NEW.title)
+        EXECUTE FUNCTION hemnet_items_title_search()
+    """,
+)
+
+for statement in SEARCH_VECTOR_DDL:
+    event.listen(HemnetItemDetail.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+
+class HemnetItemImage(DeclarativeBase):
+    """Downloaded main and floor plan images for a hemnet_items row."""
+    __tablename__ = "hemnet_item_images"
+
+    item_id = Column(
+        BigInteger,
+        ForeignKey("hemnet_items.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
     main_image_url = Column(String, nullable=True)
-    main_image_bytes = Column(LargeBinary, nullable=True)
+    main_image_bytes = deferred(Column(LargeBinary, nullable=True))
     main_image_mime = Column(String, nullable=True)
     floorplan_image_url = Column(String, nullable=True)
-    floorplan_image_bytes = Column(LargeBinary, nullable=True)
+    floorplan_image_bytes = deferred(Column(LargeBinary, nullable=True))
     floorplan_image_mime = Column(String, nullable=True)
 
 
+HOT_COLUMNS = frozenset(c.name for c in HemnetItem.__table__.columns)
+DETAIL_COLUMNS = frozenset(
+    c.name for c in HemnetItemDetail.__table__.columns
+    if c.name not in ("item_id", "search_vector")
+)
+IMAGE_COLUMNS = frozenset(
+    c.name for c in HemnetItemImage.__table__.columns if c.name != "item_id"
+)
+
+
+def build_hemnet_item(values):
+    """Build a HemnetItem with its cold rows from a flat scraped-item dict."""
+    hot = {k: v for k, v in values.items() if k in HOT_COLUMNS}
+    detail = {k: v for k, v in values.items() if k in DETAIL_COLUMNS}
+    image = {k: v for k, v in values.items() if k in IMAGE_COLUMNS}
+
+    row = HemnetItem(**hot)
+    if any(v is not None for v in detail.values()):
+        row.detail = HemnetItemDetail(**detail)
+    if any(v is not None for v in image.values()):
+        row.image = HemnetItemImage(**image)
+    return row
+
+
 class HemnetCompItem(DeclarativeBase):
     __tablename__ = "hemnet_comp_items"
 
@@ -185,3 +327,235 @@ class HemnetCompItem(DeclarativeBase):
     price_per_m2 = Column(Integer, nullable=True)
 
     collected_at = Column(Date, default=datetime.now())
+
+
+class _RollupMetrics(object):
+    """Additive metrics shared by the rollup tables; averages are sum / count."""
+    items = Column(Integer, nullable=False, default=0)
+    price_total = Column(BigInteger, nullable=False, default=0)
+    priced_items = Column(Integer, nullable=False, default=0)
+    asked_price_total = Column(BigInteger, nullable=False, default=0)
+    asked_priced_items = Column(Integer, nullable=False, default=0)
+    square_meters_total = Column(Float, nullable=False, default=0)
+    price_per_sqm_total = Column(Float, nullable=False, default=0)
+    price_per_sqm_items = Column(Integer, nullable=False, default=0)
+
+
+class HemnetBrokerRollup(_RollupMetrics, DeclarativeBase):
+    __tablename__ = "hemnet_broker_rollups"
+
+    broker_email = Column(String, primary_key=True)
+    broker_firm = Column(String, primary_key=True)
+    type = Column(String, primary_key=True)
+    week = Column(Date, primary_key=True)
+
+
+class HemnetAreaRollup(_RollupMetrics, DeclarativeBase):
+    __tablename__ = "hemnet_area_rollups"
+
+    municipality_name = Column(String, primary_key=True)
+    geographic_area = Column(String, primary_key=True)
+    type = Column(String, primary_key=True)
+    week = Column(Date, primary_key=True)
+
+
+class HemnetValuation(DeclarativeBase):
+    """Comparable-sales price estimate for an active hemnet_items row."""
+    __tablename__ = "hemnet_valuations"
+
+    item_id = Column(BigInteger, primary_key=True)
+    valued_at = Column(DateTime, default=datetime.now)
+    asked_price = Column(Integer, nullable=True)
+    price_per_sqm = Column(Float, nullable=True)
+    estimated_price = Column(Integer, nullable=True)
+    price_low = Column(Integer, nullable=True)
+    price_high = Column(Integer, nullable=True)
+    comparables = Column(Integer, nullable=False, default=0)
+    effective_comparables = Column(Float, nullable=True)
+
+
+class HoumUser(DeclarativeBase):
+    """Saved search preferences; NULL bounds and empty lists mean "any"."""
+    __tablename__ = "houm_users"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False)
+    name_key = Column(String, nullable=False, unique=True)
+    min_price = Column(Integer, nullable=True)
+    max_price = Column(Integer, nullable=True)
+    min_rooms = Column(Float, nullable=True)
+    max_rooms = Column(Float, nullable=True)
+    min_area = Column(Float, nullable=True)
+    max_area = Column(Float, nullable=True)
+    min_year = Column(Integer, nullable=True)
+    max_year = Column(Integer, nullable=True)
+    max_monthly_fee = Column(Integer, nullable=True)
+    housing_forms = Column(JSON, nullable=True)
+    tenure = Column(JSON, nullable=True)
+    municipalities = Column(JSON, nullable=True)
+    regions = Column(JSON, nullable=True)
+    districts = Column(JSON, nullable=True)
+    prefer_new_construction = Column(Boolean, nullable=True)
+    prefer_upcoming = Column(Boolean, nullable=True)
+    max_coast_distance_m = Column(Integer, nullable=True)
+    max_water_distance_m = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+
+
+class HoumFavorite(DeclarativeBase):
+    __tablename__ = "houm_favorites"
+
+    user_id = Column(
+        BigInteger,
+        ForeignKey("houm_users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    hemnet_id = Column(BigInteger, primary_key=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class HoumMatch(DeclarativeBase):
+    """A listing that satisfies a houm_users row's hard preferences."""
+    __tablename__ = "houm_matches"
+
+    user_id = Column(
+        BigInteger,
+        ForeignKey("houm_users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    hemnet_id = Column(BigInteger, primary_key=True)
+    score = Column(Integer, nullable=False, default=0)
+    matched_at = Column(DateTime, default=datetime.now)
+
+
+class HemnetItemVector(DeclarativeBase):
+    """Similarity vector of an active listing (float16, see hemnet.similarity)."""
+    __tablename__ = "hemnet_item_vectors"
+
+    hemnet_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    vector = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now)
+
+
+class HemnetItemLsh(DeclarativeBase):
+    """Locality-sensitive hash buckets of hemnet_item_vectors, one per band."""
+    __tablename__ = "hemnet_item_lsh"
+
+    band = Column(Integer, primary_key=True)
+    bucket = Column(BigInteger, primary_key=True)
+    hemnet_id = Column(BigInteger, primary_key=True, index=True)
+
+
+class HemnetListingChange(DeclarativeBase):
+    """One observation of an active listing, holding only the fields that changed.
+
+    Every ``KEYFRAME_EVERY``-th row of a listing (see hemnet.timeline) holds the
+    full tracked state instead, bounding how far back a reconstruction reads.
+    """
+    __tablename__ = "hemnet_listing_changes"
+    __table_args__ = (
+        Index("ix_hemnet_listing_changes_price_cuts", "observed_at",
+              postgresql_where=text("price_delta < 0")),
+    )
+
+    hemnet_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    observed_at = Column(DateTime, primary_key=True)
+    seq = Column(Integer, nullable=False)
+    keyframe = Column(Boolean, nullable=False, default=False)
+    changes = Column(JSON, nullable=False)
+    # Set only when asked_price changed: the new price and new - old.
+    asked_price = Column(Integer, nullable=True)
+    price_delta = Column(Integer, nullable=True)
+
+
+class HemnetListingLink(DeclarativeBase):
+    """A sold hemnet_items row linked to the active listing it came from."""
+    __tablename__ = "hemnet_listing_links"
+
+    sold_item_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    active_item_id = Column(BigInteger, nullable=False, unique=True)
+    sold_hemnet_id = Column(BigInteger, nullable=True)
+    active_hemnet_id = Column(BigInteger, nullable=True, index=True)
+    confidence = Column(Float, nullable=False)
+    evidence = Column(String, nullable=True)
+    distance_m = Column(Float, nullable=True)
+    asked_price = Column(Integer, nullable=True)
+    sold_price = Column(Integer, nullable=True)
+    sold_date = Column(Date, nullable=True)
+    days_listed = Column(Integer, nullable=True)
+    linked_at = Column(DateTime, default=datetime.now)
+
+
+class HemnetDetection(DeclarativeBase):
+    """When watch mode (hemnet.watch) found a new listing, and when it was stored."""
+    __tablename__ = "hemnet_detections"
+
+    hemnet_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    published_at = Column(DateTime, nullable=True)
+    detected_at = Column(DateTime, nullable=False, index=True)
+    stored_at = Column(DateTime, nullable=False)
+    detection_secs = Column(Float, nullable=True)
+
+
+class CrawlFrontierEntry(DeclarativeBase):
+    """A request of a shared crawl frontier (see hemnet.frontier)."""
+    __tablename__ = "crawl_frontier"
+    __table_args__ = (
+        Index("ix_crawl_frontier_next", "crawl", "priority", "created_at",
+              postgresql_where=text("state IN ('pending', 'leased')")),
+    )
+
+    crawl = Column(String, primary_key=True)
+    fingerprint = Column(String(64), primary_key=True)
+    url = Column(Text, nullable=False)
+    request = Column(LargeBinary, nullable=False)
+    priority = Column(Integer, nullable=False, default=0)
+    state = Column(String(16), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    leased_by = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+
+
+class CrawlRateBucket(DeclarativeBase):
+    """Shared token bucket of one request class (see hemnet.ratelimit)."""
+    __tablename__ = "crawl_rate_buckets"
+
+    name = Column(String, primary_key=True)
+    rate = Column(Float, nullable=False)
+    burst = Column(Float, nullable=False)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False,
+                        server_default=text("clock_timestamp()"))
+
+
+class CrawlRetryEntry(DeclarativeBase):
+    """A blocked or failed request waiting to be retried (see hemnet.blocking)."""
+    __tablename__ = "crawl_retry_queue"
+    __table_args__ = (
+        Index("ix_crawl_retry_queue_due", "spider", "next_attempt_at",
+              postgresql_where=text("state = 'waiting'")),
+    )
+
+    spider = Column(String, primary_key=True)
+    fingerprint = Column(String(64), primary_key=True)
+    url = Column(Text, nullable=False)
+    request = Column(LargeBinary, nullable=False)
+    reason = Column(String, nullable=True)
+    blocked_by = Column(JSON, nullable=True)
+    attempts = Column(Integer, nullable=False, default=1)
+    state = Column(String(16), nullable=False, default="waiting")
+    next_attempt_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now)
+
+
+class CrawlQuotaUsage(DeclarativeBase):
+    """Requests of one class sent on one day (see hemnet.priority)."""
+    __tablename__ = "crawl_quota_usage"
+
+    day = Column(Date, primary_key=True)
+    request_class = Column(String(16), primary_key=True)
+    used = Column(Integer, nullable=False, default=0)
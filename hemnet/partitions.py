@@ -0,0 +1,157 @@
+"""Monthly range partitions for the item tables.
+
+Partitioning is optional: convert an existing database with
+``migrations/002_partition_by_month.sql`` and set ``HEMNET_PARTITIONED=1`` so
+the pipeline creates the month partition a row belongs to before writing it.
+
+Old months can be detached (and moved to an archive schema) with::
+
+    python -m hemnet.partitions detach hemnet_items 2015-01-01 --archive-schema archive
+"""
+import argparse
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+# Partitioned table -> range partition key.
+PARTITION_KEYS = {
+    "hemnet_items": "sold_date",
+    "hemnet_comp_items": "collected_at",
+}
+
+_PARTITION_RE = re.compile(r"_(\d{4})_(\d{2})$")
+
+
+def as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, str):
+        try:
+            return date.fromisoformat(value[:10])
+        except ValueError:
+            return None
+    return None
+
+
+def month_bounds(day):
+    start = day.replace(day=1)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return start, end
+
+
+def partition_name(table, day):
+    return "{}_{:%Y_%m}".format(table, day)
+
+
+class PartitionManager(object):
+    """Creates and detaches monthly partitions of the item tables."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._known = set()
+
+    def prepare(self, row):
+        """Make sure the partition for an ORM row exists before it is flushed."""
+        table = row.__table__.name
+        column = PARTITION_KEYS.get(table)
+        if column is None:
+            return
+        value = as_date(getattr(row, column, None))
+        if value is None and column == "collected_at":
+            # Pin the date here so the row lands in the partition we created.
+            value = date.today()
+            setattr(row, column, value)
+        if value is not None:
+            self.ensure_partition(table, value)
+
+    def ensure_partition(self, table, day):
+        start, end = month_bounds(day)
+        name = partition_name(table, start)
+        if name in self._known:
+            return name
+        statement = text(
+            "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+            "FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, table, start.isoformat(), end.isoformat()
+            )
+        )
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(statement)
+        except DBAPIError:
+            # Another writer may have created it concurrently.
+            if name not in self.list_partitions(table):
+                raise
+        self._known.add(name)
+        return name
+
+    def list_partitions(self, table):
+        statement = text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table ORDER BY c.relname"
+        )
+        with self.engine.connect() as conn:
+            return [name for name, in conn.execute(statement, {"table": table})]
+
+    def detach_before(self, table, cutoff, archive_schema=None):
+        """Detach month partitions that end on or before ``cutoff``."""
+        if table not in PARTITION_KEYS:
+            raise ValueError("{} is not a partitioned table".format(table))
+        cutoff = as_date(cutoff)
+        detached = []
+        for name in self.list_partitions(table):
+            match = _PARTITION_RE.search(name)
+            if not match:
+                continue
+            start = date(int(match.group(1)), int(match.group(2)), 1)
+            if month_bounds(start)[1] > cutoff:
+                continue
+            with self.engine.begin() as conn:
+                conn.execute(text(
+                    "ALTER TABLE {} DETACH PARTITION {}".format(table, name)
+                ))
+                if archive_schema:
+                    conn.execute(text(
+                        "CREATE SCHEMA IF NOT EXISTS {}".format(archive_schema)
+                    ))
+                    conn.execute(text(
+                        "ALTER TABLE {} SET SCHEMA {}".format(name, archive_schema)
+                    ))
+            self._known.discard(name)
+            detached.append(name)
+        return detached
+
+
+def main(argv=None):
+    from .models import db_connect
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    ls = sub.add_parser("list", help="list partitions of a table")
+    ls.add_argument("table", choices=sorted(PARTITION_KEYS))
+    detach = sub.add_parser("detach", help="detach months ending before a date")
+    detach.add_argument("table", choices=sorted(PARTITION_KEYS))
+    detach.add_argument("cutoff", help="YYYY-MM-DD")
+    detach.add_argument("--archive-schema", default=None)
+    args = parser.parse_args(argv)
+
+    manager = PartitionManager(db_connect())
+    if args.command == "list":
+        names = manager.list_partitions(args.table)
+    else:
+        names = manager.detach_before(args.table, args.cutoff, args.archive_schema)
+    for name in names:
+        print(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,26 +7,79 @@
 
 import json
 import os
+import time
 from urllib.error import URLError
 from urllib.request import Request, urlopen
 
 from sqlalchemy.orm import sessionmaker
-from .models import db_connect, create_hemnet_table
-from .models import HemnetItem as HemnetDBItem
+from twisted.internet.threads import deferToThread
+from .address import normalize_item as normalize_address
+from .models import db_connect, create_hemnet_table, build_hemnet_item
 from .models import HemnetCompItem as HemnetCompDBItem
 from .items import HemnetItem
+from .matching import PreferenceMatcher, match_rows, upsert_matches
+from .metrics import DB_COMMIT, IMAGE_DOWNLOAD, timer
+from .partitions import PartitionManager
+from .ratelimit import TOTAL, DEFAULT_BUDGETS, open_buckets
+from .rollups import apply_item as apply_rollups
+from .similarity import index_item as index_similarity
+from .timeline import observe as record_observation
+from .watch import record_detection
+
+
+class AddressPipeline(object):
+    """Store the canonical street, number, unit and key of each address."""
+
+    def process_item(self, item, spider):
+        if isinstance(item, HemnetItem):
+            normalize_address(item)
+        return item
 
 
 class HemnetPipeline(object):
     def __init__(self):
         engine = db_connect()
         create_hemnet_table(engine)
+        self.engine = engine
         self.Session = sessionmaker(bind=engine)
         self.store_images = os.getenv("HEMNET_STORE_IMAGES", "1").lower() not in (
             "0",
             "false",
             "no",
         )
+        self.partitions = None
+        if os.getenv("HEMNET_PARTITIONED", "0").lower() in ("1", "true", "yes"):
+            self.partitions = PartitionManager(engine)
+        self.update_rollups = os.getenv("HEMNET_ROLLUPS", "1").lower() not in (
+            "0",
+            "false",
+            "no",
+        )
+        self.match_users = os.getenv("HEMNET_MATCH_USERS", "1").lower() not in (
+            "0",
+            "false",
+            "no",
+        )
+        self.match_refresh_secs = int(os.getenv("HEMNET_MATCH_REFRESH_SECS", "300"))
+        self._matcher = None
+        self._matcher_loaded_at = 0.0
+        self.index_similarity = os.getenv("HEMNET_SIMILARITY", "1").lower() not in (
+            "0",
+            "false",
+            "no",
+        )
+        self.record_changes = os.getenv("HEMNET_TIMELINE", "1").lower() not in (
+            "0",
+            "false",
+            "no",
+        )
+        # Image downloads bypass the downloader, so they take from the shared
+        # budget here (on a thread: waiting for a token must not block the
+        # reactor).
+        self.rate_limit = None
+        if os.getenv("HEMNET_RATE_LIMIT"):
+            self.rate_limit = open_buckets(os.getenv("HEMNET_RATE_LIMIT"))
+            self.rate_limit.configure(DEFAULT_BUDGETS, overwrite=False)
         self.max_image_bytes = int(os.getenv("HEMNET_MAX_IMAGE_BYTES", "10000000"))
         self.image_user_agent = os.getenv(
             "HEMNET_IMAGE_UA",
@@ -98,6 +151,8 @@ class HemnetPipeline(object):
     def _download_image(self, url):
         if not url:
             return None, None
+        if self.rate_limit is not None:
+            time.sleep(self.rate_limit.reserve((TOTAL, "image")))
         try:
             req = Request(
                 url,
@@ -127,30 +182,62 @@ class HemnetPipeline(object):
             return
         main_url, floor_url = self._select_image_urls(item)
         if main_url:
-            data, content_type = self._download_image(main_url)
+            with timer(IMAGE_DOWNLOAD, kind="main"):
+                data, content_type = self._download_image(main_url)
             if data:
                 item["main_image_url"] = main_url
                 item["main_image_bytes"] = data
                 item["main_image_mime"] = content_type
         if floor_url:
-            data, content_type = self._download_image(floor_url)
+            with timer(IMAGE_DOWNLOAD, kind="floorplan"):
+                data, content_type = self._download_image(floor_url)
             if data:
                 item["floorplan_image_url"] = floor_url
                 item["floorplan_image_bytes"] = data
                 item["floorplan_image_mime"] = content_type
 
+    def _user_matcher(self):
+        # Preferences change rarely; reload them every match_refresh_secs.
+        now = time.monotonic()
+        if self._matcher is None or now - self._matcher_loaded_at > self.match_refresh_secs:
+            self._matcher = PreferenceMatcher.from_database(self.engine)
+            self._matcher_loaded_at = now
+        return self._matcher
+
     def process_item(self, item, spider):
+        if isinstance(item, HemnetItem) and self.store_images:
+            # Rate-limit waits and downloads run off the reactor thread.
+            d = deferToThread(self._attach_images, item)
+            d.addCallback(lambda _: self._store(item))
+            return d
+        return self._store(item)
+
+    def _store(self, item):
         session = self.Session()
         if isinstance(item, HemnetItem):
-            if self.store_images:
-                self._attach_images(item)
-            deal = HemnetDBItem(**item)
+            deal = build_hemnet_item(item)
         else:
             deal = HemnetCompDBItem(**item)
+        if self.partitions is not None:
+            self.partitions.prepare(deal)
 
         try:
-            session.add(deal)
-            session.commit()
+            with timer(DB_COMMIT, item_type=type(item).__name__):
+                session.add(deal)
+                if self.update_rollups and isinstance(item, HemnetItem):
+                    # Flush first so collected_at has the value rebuild() will see.
+                    session.flush()
+                    apply_rollups(session, item, collected_at=deal.collected_at)
+                if isinstance(item, HemnetItem) and not item.get("sold_date"):
+                    if self.match_users:
+                        upsert_matches(session, match_rows(self._user_matcher(), item))
+                    if self.index_similarity:
+                        index_similarity(session, item)
+                    if self.record_changes:
+                        record_observation(session, item)
+                    if item.get("detected_at"):
+                        record_detection(session, item)
+                session.commit()
         except:
             session.rollback()
             raise
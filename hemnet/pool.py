@@ -0,0 +1,153 @@
+"""Pool of egress proxies and Playwright browser contexts, scored by health.
+
+A member is one (proxy, browser context) pair with a fixed user agent, so a
+session looks the same on every request. ``PoolMiddleware``
+(hemnet.middlewares) sends each request through a member and gives it its
+own download slot, so every member is paced by ``DOWNLOAD_DELAY`` on its own
+and total concurrency grows with the pool instead of staying at one request
+per domain.
+
+Members are scored on their success rate and latency (both moving averages)
+and their blocks of the last ``block_window`` seconds. A request goes to the
+better of two random healthy members, which spreads load while favouring
+good ones; an occasional random pick keeps every score up to date. A
+blocked member rests (takes no requests) for ``rest_secs``, doubling with
+each consecutive block. Per-member counters and scores are in
+the crawl stats under ``pool/<member>/``.
+
+Configure with ``HEMNET_PROXIES`` (comma-separated proxy URLs; none means
+direct) and ``HEMNET_POOL_CONTEXTS`` (browser contexts per proxy)::
+
+    HEMNET_PROXIES=http://user:pw@p1:8000,http://user:pw@p2:8000 \\
+    HEMNET_POOL_CONTEXTS=2 scrapy crawl hemnetspider
+"""
+import random
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+from .blocking import proxy_label
+
+
+class PoolMember(object):
+    """One proxy + browser context, with its health."""
+
+    def __init__(self, name, proxy=None, user_agent=None, context_kwargs=None):
+        self.name = name
+        self.proxy = proxy
+        self.user_agent = user_agent
+        self.context_kwargs = dict(context_kwargs or {})
+        self.success = 1.0
+        self.latency = 0.0
+        self.blocks = deque()
+        self.consecutive_blocks = 0
+        self.rested_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+
+    def playwright_context_kwargs(self):
+        kwargs = dict(self.context_kwargs)
+        if self.user_agent:
+            kwargs["user_agent"] = self.user_agent
+        if self.proxy:
+            parsed = urlparse(self.proxy)
+            proxy = {"server": proxy_label(self.proxy)}
+            if parsed.username:
+                proxy["username"] = parsed.username
+                proxy["password"] = parsed.password or ""
+            kwargs["proxy"] = proxy
+        return kwargs
+
+    def resting(self, now):
+        return now < self.rested_until
+
+
+class ProxyPool(object):
+    """Picks members for requests and keeps their scores up to date."""
+
+    def __init__(self, members, alpha=0.1, latency_ref=5.0, block_window=600.0,
+                 rest_secs=60.0, max_rest_secs=1800.0, explore=0.05):
+        if not members:
+            raise ValueError("a pool needs at least one member")
+        self.members = list(members)
+        self.by_name = {member.name: member for member in self.members}
+        self.alpha = alpha
+        self.latency_ref = latency_ref
+        self.block_window = block_window
+        self.rest_secs = rest_secs
+        self.max_rest_secs = max_rest_secs
+        self.explore = explore
+
+    @classmethod
+    def build(cls, proxies, contexts, user_agents, context_kwargs=None, **kwargs):
+        """``contexts`` members per proxy (``None`` in ``proxies``: direct)."""
+        members = []
+        for proxy in proxies or [None]:
+            for _ in range(max(contexts, 1)):
+                index = len(members)
+                user_agent = user_agents[index % len(user_agents)] if user_agents else None
+                members.append(PoolMember("pool-{}".format(index), proxy, user_agent,
+                                          context_kwargs))
+        return cls(members, **kwargs)
+
+    def _recent_blocks(self, member, now):
+        while member.blocks and member.blocks[0] < now - self.block_window:
+            member.blocks.popleft()
+        return len(member.blocks)
+
+    def score(self, member, now=None):
+        """Higher is healthier; 0 while resting."""
+        now = time.monotonic() if now is None else now
+        if member.resting(now):
+            return 0.0
+        return (member.success
+                / (1.0 + member.latency / self.latency_ref)
+                / (1.0 + self._recent_blocks(member, now))
+                / (1.0 + member.in_flight))
+
+    def choose(self, now=None):
+        """The better of two random healthy members (the soonest rested if none is)."""
+        now = time.monotonic() if now is None else now
+        healthy = [member for member in self.members if not member.resting(now)]
+        if not healthy:
+            return min(self.members, key=lambda member: member.rested_until)
+        if len(healthy) == 1 or random.random() < self.explore:
+            # Now and then any healthy member, so a slow one's score can recover.
+            return random.choice(healthy)
+        a, b = random.sample(healthy, 2)
+        return a if self.score(a, now) >= self.score(b, now) else b
+
+    def started(self, member):
+        member.in_flight += 1
+        member.requests += 1
+
+    def record(self, member, ok, latency=None, blocked=False, now=None):
+        """Update a member after its request finished."""
+        now = time.monotonic() if now is None else now
+        member.in_flight = max(member.in_flight - 1, 0)
+        member.success += self.alpha * ((1.0 if ok else 0.0) - member.success)
+        if latency is not None:
+            member.latency += self.alpha * (latency - member.latency)
+        if blocked:
+            member.blocks.append(now)
+            member.consecutive_blocks += 1
+            rest = self.rest_secs * 2 ** (member.consecutive_blocks - 1)
+            member.rested_until = now + min(rest, self.max_rest_secs)
+        elif ok:
+            member.consecutive_blocks = 0
+
+    def report(self, now=None):
+        """name -> dict of the member's health, for stats and logs."""
+        now = time.monotonic() if now is None else now
+        return {
+            member.name: {
+                "proxy": proxy_label(member.proxy),
+                "requests": member.requests,
+                "success": round(member.success, 3),
+                "latency": round(member.latency, 2),
+                "recent_blocks": self._recent_blocks(member, now),
+                "resting_secs": round(max(member.rested_until - now, 0.0)),
+                "score": round(self.score(member, now), 3),
+            }
+            for member in self.members
+        }
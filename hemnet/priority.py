@@ -0,0 +1,197 @@
+"""Request priorities by business value, and daily request quotas per class.
+
+Request classes, most valuable first:
+
+======  ============================================================
+new     active listing found by a ``published_since`` search
+hot     active listing with bidding going on or an open house coming
+active  any other active listing
+search  search result pages (deeper pages rank lower)
+sold    detail page of a sold listing (sold-price backfill)
+comp    the listing page behind a sale (``prev`` pages, comp spider)
+======  ============================================================
+
+The spiders set ``request.meta['crawl_class']`` where they know it; otherwise
+the URL decides. ``PriorityScheduler`` (and ``FrontierScheduler`` for shared
+crawls) hands out requests in that order. ``PRIORITY_QUOTAS`` caps how many
+requests of a class are sent per day across all workers (counted in
+crawl_quota_usage), so a limited budget is spent on the freshest data
+first. Requests over their quota are dropped (``quota/dropped/<class>`` in
+the stats) and picked up by the next day's crawl::
+
+    python -m hemnet.priority usage --days 7
+"""
+import argparse
+from datetime import date, timedelta
+from urllib.parse import urlparse
+
+from scrapy.core.scheduler import Scheduler
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import CrawlQuotaUsage
+
+CLASS_PRIORITY = {
+    "new": 500,
+    "hot": 400,
+    "active": 300,
+    "search": 200,
+    "sold": 100,
+    "comp": 0,
+}
+
+# Search pages lose one point per page of depth, but never drop into the
+# next class.
+_MAX_DEPTH_PENALTY = 99
+
+_TAKE = text("""
+    WITH old AS (
+        SELECT used FROM crawl_quota_usage
+        WHERE day = :day AND request_class = :request_class
+        FOR UPDATE
+    )
+    UPDATE crawl_quota_usage AS q
+    SET used = LEAST(:quota, old.used + :n)
+    FROM old
+    WHERE q.day = :day AND q.request_class = :request_class
+    RETURNING q.used - old.used
+""")
+
+
+def classify(request):
+    """The request class of a request (see the module docstring)."""
+    crawl_class = request.meta.get("crawl_class")
+    if crawl_class in CLASS_PRIORITY:
+        return crawl_class
+    path = urlparse(request.url).path.rstrip("/")
+    if path.endswith("/bostader"):
+        return "search"
+    if path.startswith("/salda/"):
+        return "sold"
+    return "active"
+
+
+def prioritize(request):
+    """Set the class and priority of a request once; returns its class."""
+    if request.meta.get("crawl_prioritized"):
+        # Retries and redirects keep the priority (and adjustments) they had.
+        return request.meta["crawl_class"]
+    crawl_class = classify(request)
+    priority = CLASS_PRIORITY[crawl_class]
+    if crawl_class == "search":
+        priority -= min(request.meta.get("depth", 0), _MAX_DEPTH_PENALTY)
+    request.meta["crawl_class"] = crawl_class
+    request.meta["crawl_prioritized"] = True
+    request.priority = priority
+    return crawl_class
+
+
+class DailyQuotas(object):
+    """Per-class daily request quotas shared by all workers.
+
+    Workers take ``chunk`` requests of a quota at a time, so at most
+    ``chunk - 1`` per class and worker go unused when a worker stops.
+    """
+
+    def __init__(self, engine, quotas, chunk=10):
+        self.engine = engine
+        self.quotas = {name: int(quota) for name, quota in quotas.items()
+                       if quota is not None}
+        self.chunk = chunk
+        self.left = {}
+
+    def _take(self, day, request_class, quota):
+        with self.engine.begin() as conn:
+            conn.execute(insert(CrawlQuotaUsage.__table__).values(
+                day=day, request_class=request_class, used=0,
+            ).on_conflict_do_nothing(index_elements=["day", "request_class"]))
+            return conn.execute(_TAKE, {
+                "day": day, "request_class": request_class,
+                "quota": quota, "n": self.chunk,
+            }).scalar() or 0
+
+    def allow(self, request_class, day=None):
+        """Count one request of ``request_class``; False once today's quota is used up."""
+        quota = self.quotas.get(request_class)
+        if quota is None:
+            return True
+        day = day or date.today()
+        left_day, left = self.left.get(request_class, (day, 0))
+        if left_day != day:
+            left = 0
+        if left == 0:
+            # -1: the quota is used up for today, don't ask again.
+            left = self._take(day, request_class, quota) or -1
+        if left < 0:
+            self.left[request_class] = (day, -1)
+            return False
+        self.left[request_class] = (day, left - 1)
+        return True
+
+
+def open_quotas(settings):
+    """DailyQuotas for the PRIORITY_QUOTAS setting, or None if there are none."""
+    quotas = {name: quota for name, quota in settings.getdict("PRIORITY_QUOTAS").items()
+              if quota is not None}
+    if not quotas:
+        return None
+    from .models import db_connect, create_hemnet_table
+    engine = db_connect()
+    create_hemnet_table(engine)
+    return DailyQuotas(engine, quotas)
+
+
+class PriorityScheduler(Scheduler):
+    """Scrapy's scheduler with request classes and daily quotas."""
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super().from_crawler(crawler)
+        scheduler.quotas = open_quotas(crawler.settings)
+        return scheduler
+
+    def enqueue_request(self, request):
+        prioritize(request)
+        return super().enqueue_request(request)
+
+    def next_request(self):
+        while True:
+            request = super().next_request()
+            if request is None or self.quotas is None:
+                return request
+            crawl_class = request.meta.get("crawl_class")
+            if self.quotas.allow(crawl_class):
+                return request
+            self.stats.inc_value("quota/dropped/{}".format(crawl_class), spider=self.spider)
+
+
+def usage(engine, days=7):
+    """(day, class, used) rows of the last ``days`` days."""
+    table = CrawlQuotaUsage.__table__
+    query = table.select().where(table.c.day > date.today() - timedelta(days=days)).order_by(
+        table.c.day.desc(), table.c.request_class)
+    with engine.connect() as conn:
+        return [(row.day, row.request_class, row.used) for row in conn.execute(query)]
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+    from . import settings
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    show = sub.add_parser("usage", help="requests counted against the quotas per day")
+    show.add_argument("--days", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    quotas = settings.PRIORITY_QUOTAS
+    for day, request_class, used in usage(engine, args.days):
+        quota = quotas.get(request_class)
+        print("{}\t{:8}{}".format(day, request_class, used if quota is None
+                                  else "{}/{}".format(used, quota)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Token buckets shared by every crawler process on every host.
+
+Each request class (``search``, ``detail``, ``image``) has a bucket, and all
+requests also draw from ``total``. A bucket refills at ``rate`` tokens per
+second up to ``burst``. Taking a token is one atomic UPDATE that may drive
+the bucket negative: the caller then sleeps ``-tokens / rate`` seconds. That
+reserves its slot instead of polling, so waiting workers are served in order
+and the combined rate never exceeds the budget.
+
+Backends: ``PostgresBuckets`` (the crawl database, default) and
+``SqliteBuckets`` (a file shared by the processes of one host, for local
+runs without the database)::
+
+    python -m hemnet.ratelimit show
+    python -m hemnet.ratelimit set detail 0.5 --burst 3
+"""
+import argparse
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import CrawlRateBucket, create_hemnet_table, db_connect
+
+TOTAL = "total"
+
+# Request class -> (tokens per second, burst).
+DEFAULT_BUDGETS = {
+    TOTAL: (0.5, 3),
+    "search": (0.2, 2),
+    "detail": (0.4, 3),
+    "image": (1.0, 5),
+}
+
+_TAKE = text("""
+    UPDATE crawl_rate_buckets
+    SET tokens = LEAST(burst, tokens + rate * EXTRACT(EPOCH FROM clock_timestamp() - updated_at)) - 1,
+        updated_at = clock_timestamp()
+    WHERE name = :name
+    RETURNING tokens, rate
+""")
+
+
+def request_class(url):
+    """search, detail or image for a hemnet URL."""
+    path = url.split("?", 1)[0].lower()
+    if path.endswith((".jpg", ".jpeg", ".png", ".webp", ".gif")) or "bilder." in path:
+        return "image"
+    if path.rstrip("/").endswith("/bostader"):
+        return "search"
+    return "detail"
+
+
+def _wait(tokens, rate):
+    return -tokens / rate if tokens < 0 and rate > 0 else 0.0
+
+
+class PostgresBuckets(object):
+    """Buckets in the crawl_rate_buckets table, timed by the database clock."""
+
+    def __init__(self, engine=None):
+        self.engine = engine or db_connect()
+        create_hemnet_table(self.engine)
+
+    def configure(self, budgets, overwrite=True):
+        """Create (or with ``overwrite`` re-rate) the buckets of ``budgets``."""
+        table = CrawlRateBucket.__table__
+        rows = [{"name": name, "rate": float(rate), "burst": float(burst),
+                 "tokens": float(burst)} for name, (rate, burst) in budgets.items()]
+        stmt = insert(table)
+        if overwrite:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["name"],
+                set_={"rate": stmt.excluded.rate, "burst": stmt.excluded.burst},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=["name"])
+        with self.engine.begin() as conn:
+            conn.execute(stmt, rows)
+
+    def reserve(self, names):
+        """Take one token from each bucket; seconds to wait before sending."""
+        wait = 0.0
+        with self.engine.begin() as conn:
+            # Always lock buckets in the same order, so workers can't deadlock.
+            for name in sorted(set(names)):
+                row = conn.execute(_TAKE, {"name": name}).fetchone()
+                if row is not None:
+                    wait = max(wait, _wait(row[0], row[1]))
+        return wait
+
+    def state(self):
+        table = CrawlRateBucket.__table__
+        with self.engine.connect() as conn:
+            return [dict(row) for row in conn.execute(
+                table.select().order_by(table.c.name))]
+
+
+class SqliteBuckets(object):
+    """Same buckets in a SQLite file, for the processes of a single host."""
+
+    def __init__(self, path):
+        # Used from Scrapy's thread pool, hence the lock.
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_rate_buckets ("
+            "name TEXT PRIMARY KEY, rate REAL NOT NULL, burst REAL NOT NULL, "
+            "tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def configure(self, budgets, overwrite=True):
+        now = time.time()
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        with self.lock:
+            self.conn.executemany(
+                verb + " INTO crawl_rate_buckets VALUES (?, ?, ?, ?, ?)",
+                [(name, float(rate), float(burst), float(burst), now)
+                 for name, (rate, burst) in budgets.items()],
+            )
+
+    def reserve(self, names):
+        with self.lock:
+            return self._reserve(names)
+
+    def _reserve(self, names):
+        wait = 0.0
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name in sorted(set(names)):
+                row = self.conn.execute(
+                    "SELECT rate, burst, tokens, updated_at FROM crawl_rate_buckets "
+                    "WHERE name = ?", (name,)).fetchone()
+                if row is None:
+                    continue
+                rate, burst, tokens, updated_at = row
+                now = time.time()
+                tokens = min(burst, tokens + rate * (now - updated_at)) - 1
+                self.conn.execute(
+                    "UPDATE crawl_rate_buckets SET tokens = ?, updated_at = ? "
+                    "WHERE name = ?", (tokens, now, name))
+                wait = max(wait, _wait(tokens, rate))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def state(self):
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM crawl_rate_buckets ORDER BY name")
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor]
+
+
+def open_buckets(backend):
+    """``postgres`` or ``sqlite:<path>``."""
+    if backend.startswith("sqlite:"):
+        return SqliteBuckets(backend[len("sqlite:"):])
+    if backend == "postgres":
+        return PostgresBuckets()
+    raise ValueError("unknown rate limit backend {!r}".format(backend))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", default="postgres", help="postgres or sqlite:<path>")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("show", help="current buckets")
+    change = sub.add_parser("set", help="set the budget of one request class")
+    change.add_argument("name", help="total, search, detail or image")
+    change.add_argument("rate", type=float, help="requests per second")
+    change.add_argument("--burst", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    buckets = open_buckets(args.backend)
+    if args.command == "set":
+        buckets.configure({args.name: (args.rate, args.burst)})
+    for row in buckets.state():
+        print("{name:8} rate={rate:.3f}/s burst={burst:g} tokens={tokens:.2f}".format(**row))
+
+
+if __name__ == "__main__":
+    main()
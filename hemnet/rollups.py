@@ -0,0 +1,133 @@
+"""Weekly broker and area rollups of hemnet_items.
+
+The pipeline adds each stored item to ``hemnet_broker_rollups`` and
+``hemnet_area_rollups`` in the same transaction as the item itself. After a
+backfill or manual edits of hemnet_items, rebuild them from scratch with::
+
+    python -m hemnet.rollups rebuild
+"""
+import argparse
+from datetime import date, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import HemnetAreaRollup, HemnetBrokerRollup
+from .partitions import as_date
+
+METRIC_COLUMNS = (
+    "items",
+    "price_total",
+    "priced_items",
+    "asked_price_total",
+    "asked_priced_items",
+    "square_meters_total",
+    "price_per_sqm_total",
+    "price_per_sqm_items",
+)
+
+# Rollup model -> item fields forming its key (besides week).
+ROLLUP_KEYS = (
+    (HemnetBrokerRollup, ("broker_email", "broker_firm", "type")),
+    (HemnetAreaRollup, ("municipality_name", "geographic_area", "type")),
+)
+
+
+def week_start(day):
+    """Monday of the week, matching Postgres ``date_trunc('week', ...)``."""
+    return day - timedelta(days=day.weekday())
+
+
+def item_metrics(values):
+    price = values.get("price")
+    asked_price = values.get("asked_price")
+    square_meters = values.get("square_meters")
+    price_per_sqm = values.get("price_per_square_meter")
+    return {
+        "items": 1,
+        "price_total": price or 0,
+        "priced_items": int(price is not None),
+        "asked_price_total": asked_price or 0,
+        "asked_priced_items": int(asked_price is not None),
+        "square_meters_total": square_meters or 0,
+        "price_per_sqm_total": price_per_sqm or 0,
+        "price_per_sqm_items": int(price_per_sqm is not None),
+    }
+
+
+def apply_item(session, values, collected_at=None):
+    """Add one scraped item to every rollup table using upserts.
+
+    Scraped items carry no ``collected_at``; pass the stored row's value so
+    the week matches what ``rebuild`` computes from the table.
+    """
+    day = (
+        as_date(values.get("sold_date"))
+        or as_date(collected_at)
+        or as_date(values.get("collected_at"))
+        or date.today()
+    )
+    metrics = item_metrics(values)
+    for model, key_fields in ROLLUP_KEYS:
+        table = model.__table__
+        row = {field: values.get(field) or "" for field in key_fields}
+        row["week"] = week_start(day)
+        row.update(metrics)
+        stmt = insert(table).values(**row)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=list(key_fields) + ["week"],
+            set_={c: table.c[c] + stmt.excluded[c] for c in METRIC_COLUMNS},
+        )
+        session.execute(stmt)
+
+
+_REBUILD_SELECT = """
+SELECT
+  {keys},
+  date_trunc('week', COALESCE(sold_date, collected_at, CURRENT_DATE))::date AS week,
+  COUNT(*),
+  COALESCE(SUM(price), 0),
+  COUNT(price),
+  COALESCE(SUM(asked_price), 0),
+  COUNT(asked_price),
+  COALESCE(SUM(square_meters), 0),
+  COALESCE(SUM(price_per_square_meter), 0),
+  COUNT(price_per_square_meter)
+FROM
+  hemnet_items
+GROUP BY
+  {group_by}
+"""
+
+
+def rebuild(engine):
+    """Recompute all rollup tables from hemnet_items in one transaction."""
+    with engine.begin() as conn:
+        for model, key_fields in ROLLUP_KEYS:
+            table = model.__tablename__
+            columns = ", ".join(list(key_fields) + ["week"] + list(METRIC_COLUMNS))
+            keys = ", ".join(
+                "COALESCE({0}, '') AS {0}".format(field) for field in key_fields
+            )
+            group_by = ", ".join(str(i) for i in range(1, len(key_fields) + 2))
+            conn.execute(text("TRUNCATE {}".format(table)))
+            conn.execute(text(
+                "INSERT INTO {} ({}) ".format(table, columns)
+                + _REBUILD_SELECT.format(keys=keys, group_by=group_by)
+            ))
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["rebuild"])
+    parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    rebuild(engine)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Swedish full-text search over listing titles and descriptions.
+
+``hemnet_item_details.search_vector`` holds the stemmed title (weight A) and
+description (weight B) and is kept current by database triggers, see
+``migrations/005_full_text_search.sql``. Queries use ``websearch_to_tsquery``
+syntax (``balkong "öppen spis" -bostadsrätt``), hit the GIN index and are
+ranked with ``ts_rank_cd``. Pages are keyset paginated on (rank, id), so
+deep pages cost the same as the first::
+
+    page = search(engine, "balkong sjöutsikt", municipality="Göteborg",
+                  type="bostadsratt", max_price=4000000)
+    more = search(engine, "balkong sjöutsikt", ..., after=page["next"])
+
+    python -m hemnet.search "balkong sjöutsikt" --municipality Göteborg
+"""
+import argparse
+
+from sqlalchemy import cast, func, literal, select, tuple_
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from .models import HemnetItem, HemnetItemDetail
+
+CONFIG = "swedish"
+
+RESULT_COLUMNS = (
+    "id",
+    "hemnet_id",
+    "title",
+    "address",
+    "municipality_name",
+    "type",
+    "price",
+    "asked_price",
+    "rooms",
+    "square_meters",
+    "sold_date",
+    "listing_url",
+)
+
+
+def search_query(text, municipality=None, type=None, min_price=None,
+                 max_price=None, sold=None, limit=20, after=None):
+    """Select statement for one page of ranked matches.
+
+    ``municipality`` and ``type`` take a value or a list of values, prices
+    are inclusive bounds on ``price`` or, for active listings, ``asked_price``.
+    ``sold`` limits to sold (True) or active (False) listings. ``after`` is
+    the ``(rank, id)`` of the last row of the previous page.
+    """
+    items = HemnetItem.__table__
+    details = HemnetItemDetail.__table__
+    query = func.websearch_to_tsquery(CONFIG, text)
+    # ts_rank_cd returns REAL; compared with the float8 cursor it is widened
+    # and no longer equals the value handed out, so ties at a page boundary
+    # would repeat or drop rows. Rank in float8 so the cursor round-trips.
+    rank = cast(func.ts_rank_cd(details.c.search_vector, query),
+                DOUBLE_PRECISION).label("rank")
+
+    inner = (
+        select([items.c[name] for name in RESULT_COLUMNS] + [rank])
+        .select_from(items.join(details, details.c.item_id == items.c.id))
+        .where(details.c.search_vector.op("@@")(query))
+    )
+    for column, value in (("municipality_name", municipality), ("type", type)):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            inner = inner.where(items.c[column].in_(list(value)))
+        else:
+            inner = inner.where(items.c[column] == value)
+    price = func.coalesce(items.c.price, items.c.asked_price)
+    if min_price is not None:
+        inner = inner.where(price >= min_price)
+    if max_price is not None:
+        inner = inner.where(price <= max_price)
+    if sold is not None:
+        inner = inner.where(
+            items.c.sold_date.isnot(None) if sold else items.c.sold_date.is_(None))
+
+    ranked = inner.alias("ranked")
+    page = select([ranked]).order_by(ranked.c.rank.desc(), ranked.c.id.desc())
+    if after is not None:
+        after_rank, after_id = after
+        page = page.where(tuple_(ranked.c.rank, ranked.c.id)
+                          < tuple_(literal(float(after_rank), DOUBLE_PRECISION),
+                                   literal(int(after_id))))
+    return page.limit(limit)
+
+
+def search(engine, text, limit=20, after=None, **filters):
+    """One page of matches: ``{"rows": [...], "next": (rank, id) or None}``."""
+    query = search_query(text, limit=limit, after=after, **filters)
+    with engine.connect() as conn:
+        rows = [dict(row) for row in conn.execute(query)]
+    following = None
+    if len(rows) == limit:
+        following = (rows[-1]["rank"], rows[-1]["id"])
+    return {"rows": rows, "next": following}
+
+
+def check_paging(engine, text, limit=2, **filters):
+    """Page through every match and compare with one unpaged query.
+
+    Returns ``(missing, repeated)`` lists of ids; both are empty when keyset
+    paging returns every row exactly once. A small ``limit`` puts page
+    boundaries inside runs of tied ranks.
+    """
+    with engine.connect() as conn:
+        expected = [row["id"] for row in conn.execute(
+            search_query(text, limit=None, **filters))]
+    seen = []
+    after = None
+    while True:
+        page = search(engine, text, limit=limit, after=after, **filters)
+        seen.extend(row["id"] for row in page["rows"])
+        after = page["next"]
+        if after is None:
+            break
+    counts = {}
+    for item_id in seen:
+        counts[item_id] = counts.get(item_id, 0) + 1
+    missing = [item_id for item_id in expected if item_id not in counts]
+    repeated = sorted(item_id for item_id, count in counts.items() if count > 1)
+    return missing, repeated
+
+
+def _cursor(value):
+    rank, _, item_id = value.partition(":")
+    return float(rank), int(item_id)
+
+
+def main(argv=None):
+    from .models import db_connect
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("text", help="websearch_to_tsquery syntax")
+    parser.add_argument("--municipality", action="append")
+    parser.add_argument("--type", action="append")
+    parser.add_argument("--min-price", type=int)
+    parser.add_argument("--max-price", type=int)
+    status = parser.add_mutually_exclusive_group()
+    status.add_argument("--sold", dest="sold", action="store_true", default=None)
+    status.add_argument("--active", dest="sold", action="store_false")
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--after", type=_cursor, help="RANK:ID from the previous page")
+    parser.add_argument("--check-paging", action="store_true",
+                        help="page through all matches --limit at a time and report "
+                             "rows that are missing or returned twice")
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    filters = dict(
+        municipality=args.municipality, type=args.type,
+        min_price=args.min_price, max_price=args.max_price, sold=args.sold,
+    )
+    if args.check_paging:
+        missing, repeated = check_paging(engine, args.text, limit=args.limit, **filters)
+        print("missing: {}\nrepeated: {}".format(missing, repeated))
+        if missing or repeated:
+            raise SystemExit(1)
+        return
+
+    page = search(engine, args.text, limit=args.limit, after=args.after, **filters)
+    for row in page["rows"]:
+        print("{:.4f}\t{}\t{}\t{}\t{}".format(
+            row["rank"], row["hemnet_id"], row["price"] or row["asked_price"],
+            row["address"], row["title"]))
+    if page["next"]:
+        print("next page: --after {!r}:{}".format(*page["next"]))
+
+
+if __name__ == "__main__":
+    main()
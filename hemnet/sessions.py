@@ -0,0 +1,230 @@
+"""Warmed-up, persisted and rotated crawl sessions.
+
+A session is one Playwright context (``playwright_context``) or, for requests
+without a browser, one Scrapy cookie jar (``cookiejar``), named after the
+context or pool member. ``SessionMiddleware`` (hemnet.middlewares)
+
+* warms a session up once before its first request: the context loads
+  ``SESSION_WARMUP_URL`` and accepts the cookie consent (a cookie jar gets the
+  cookies of a plain visit), so listing requests never come from a cookieless
+  first visit, which is what tends to get challenged;
+* restores saved state: contexts through ``storage_state`` (hemnet.browser),
+  cookie jars from the same JSON format in ``BROWSER_STATE_DIR``;
+* rotates a session before it goes stale: when it is older than
+  ``SESSION_MAX_AGE_SECS``, its Hemnet cookies expire within
+  ``SESSION_EXPIRY_MARGIN_SECS`` or more than ``SESSION_MAX_BLOCK_RATE`` of its
+  recent responses were blocked. The context is closed (or the jar cleared),
+  its saved state deleted, and a fresh one is warmed up;
+* counts requests and blocks per session, in the crawl stats
+  (``sessions/<name>/...``) and in ``sessions.json`` next to the saved states.
+"""
+import json
+import os
+import time
+from collections import deque
+from http.cookiejar import Cookie, CookieJar
+from pathlib import Path
+from urllib.request import HTTPCookieProcessor, ProxyHandler, Request, build_opener
+
+from .browser import state_path
+
+COOKIE_DOMAIN = "hemnet.se"
+
+DEFAULT_CONSENT_SELECTORS = (
+    "#onetrust-accept-btn-handler",
+    "button[data-testid='uc-accept-all-button']",
+    "button[data-testid='accept-all']",
+    "button[aria-label='Godkänn alla']",
+)
+
+_CLICK_FIRST = """selectors => {
+    for (const selector of selectors) {
+        const button = document.querySelector(selector);
+        if (button) { button.click(); return selector; }
+    }
+    return null;
+}"""
+
+
+class Session(object):
+    """Age, cookie expiry and block rate of one session."""
+
+    def __init__(self, name, created_at=None, warmed_at=None, expires_at=None,
+                 requests=0, blocks=0, window=50):
+        self.name = name
+        self.created_at = created_at or time.time()
+        self.warmed_at = warmed_at
+        self.expires_at = expires_at
+        self.requests = requests
+        self.blocks = blocks
+        self.recent = deque(maxlen=window)
+        self.in_flight = 0
+        self.rotating = None
+        self.busy = False
+        self.loaded = False
+
+    def block_rate(self):
+        return sum(self.recent) / len(self.recent) if self.recent else 0.0
+
+    def record(self, blocked):
+        self.recent.append(bool(blocked))
+        if blocked:
+            self.blocks += 1
+
+    def reset(self, now=None):
+        self.created_at = now or time.time()
+        self.warmed_at = self.expires_at = None
+        self.requests = self.blocks = 0
+        self.recent.clear()
+        self.rotating = None
+
+    def warmed(self, cookies, now=None):
+        self.warmed_at = now or time.time()
+        self.expires_at = cookie_expiry(cookies, now=self.warmed_at)
+
+    def to_dict(self):
+        return {
+            "created_at": self.created_at,
+            "warmed_at": self.warmed_at,
+            "expires_at": self.expires_at,
+            "requests": self.requests,
+            "blocks": self.blocks,
+        }
+
+
+def rotation_reason(session, now, max_age_secs, expiry_margin_secs, max_block_rate,
+                    min_samples=10):
+    """Why ``session`` should be replaced now (``age``, ``expiry``, ``blocks``), or None."""
+    if session.warmed_at is None:
+        return None
+    if now - session.created_at > max_age_secs:
+        return "age"
+    if session.expires_at and session.expires_at - now < expiry_margin_secs:
+        return "expiry"
+    if len(session.recent) >= min_samples and session.block_rate() > max_block_rate:
+        return "blocks"
+    return None
+
+
+class SessionIndex(object):
+    """The sessions.json file that keeps session metadata between runs."""
+
+    def __init__(self, state_dir):
+        self.path = Path(state_dir) / "sessions.json" if state_dir else None
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return {}
+        data = json.loads(self.path.read_text(encoding="utf-8"))
+        return {name: Session(name, **values) for name, values in data.items()}
+
+    def save(self, sessions):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({name: session.to_dict()
+                                   for name, session in sorted(sessions.items())},
+                                  indent=2), encoding="utf-8")
+        os.replace(str(tmp), str(self.path))
+
+
+def cookie_expiry(cookies, domain=COOKIE_DOMAIN, now=None, min_lifetime=3600):
+    """Earliest expiry (epoch seconds) of the persistent cookies of ``domain``.
+
+    Cookies that live less than ``min_lifetime`` (analytics throttles and the
+    like) are not session cookies and don't count.
+    """
+    now = time.time() if now is None else now
+    expiries = [cookie["expires"] for cookie in cookies
+                if cookie.get("expires", -1) >= now + min_lifetime
+                and cookie.get("domain", "").lstrip(".").endswith(domain)]
+    return min(expiries) if expiries else None
+
+
+def cookies_from_jar(jar):
+    """Cookies of an ``http.cookiejar.CookieJar`` in Playwright's storage-state format."""
+    return [{
+        "name": cookie.name,
+        "value": cookie.value,
+        "domain": cookie.domain,
+        "path": cookie.path,
+        "expires": cookie.expires if cookie.expires is not None else -1,
+        "httpOnly": cookie.has_nonstandard_attr("HttpOnly"),
+        "secure": cookie.secure,
+        "sameSite": "Lax",
+    } for cookie in jar]
+
+
+def load_cookies(jar, cookies):
+    """Add storage-state cookies to an ``http.cookiejar.CookieJar``."""
+    for cookie in cookies:
+        domain = cookie["domain"]
+        expires = cookie.get("expires", -1)
+        jar.set_cookie(Cookie(
+            0, cookie["name"], cookie["value"], None, False,
+            domain, True, domain.startswith("."),
+            cookie.get("path", "/"), True, cookie.get("secure", False),
+            int(expires) if expires and expires > 0 else None, not expires or expires <= 0,
+            None, None, {"HttpOnly": None} if cookie.get("httpOnly") else {},
+        ))
+
+
+def save_jar(jar, state_dir, name):
+    path = state_path(state_dir, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"cookies": cookies_from_jar(jar), "origins": []}),
+                   encoding="utf-8")
+    os.replace(str(tmp), str(path))
+
+
+def load_jar(jar, state_dir, name):
+    """Restore a saved cookie jar; False if there is none."""
+    path = state_path(state_dir, name)
+    try:
+        cookies = json.loads(path.read_text(encoding="utf-8")).get("cookies", [])
+    except (OSError, ValueError):
+        return False
+    load_cookies(jar, cookies)
+    return True
+
+
+def warm_http(url, user_agent=None, proxy=None, timeout=30):
+    """Visit ``url`` without a browser; the cookies it set, as storage-state dicts."""
+    jar = CookieJar()
+    handlers = [HTTPCookieProcessor(jar)]
+    if proxy:
+        handlers.append(ProxyHandler({"http": proxy, "https": proxy}))
+    headers = {"Accept-Language": "sv-SE,sv;q=0.9,en;q=0.8"}
+    if user_agent:
+        headers["User-Agent"] = user_agent
+    with build_opener(*handlers).open(Request(url, headers=headers), timeout=timeout) as response:
+        response.read()
+    return cookies_from_jar(jar)
+
+
+async def warm_context(handler, name, context_kwargs, url, consent_selectors,
+                       settle_ms=1500):
+    """Open ``url`` in context ``name`` (created if needed) and accept the consent."""
+    wrapper = handler.context_wrappers.get(name)
+    if wrapper is None:
+        async with handler.context_launch_lock:
+            wrapper = handler.context_wrappers.get(name)
+            if wrapper is None:
+                wrapper = await handler._create_browser_context(
+                    name=name, context_kwargs=context_kwargs)
+    page = await wrapper.context.new_page()
+    try:
+        await page.goto(url, wait_until="domcontentloaded")
+        await page.evaluate(_CLICK_FIRST, list(consent_selectors))
+        await page.wait_for_timeout(settle_ms)
+    finally:
+        await page.close()
+    return await wrapper.context.cookies()
+
+
+async def close_context(handler, name):
+    wrapper = handler.context_wrappers.get(name)
+    if wrapper is not None:
+        await wrapper.context.close()
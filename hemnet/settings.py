@@ -11,6 +11,8 @@
 import os
 from pathlib import Path
 
+from .browser import with_stored_state
+
 
 def _load_env_file(path):
     if not path or not path.exists():
@@ -77,6 +79,10 @@ DEFAULT_REQUEST_HEADERS = {
 #SPIDER_MIDDLEWARES = {
 #    'hemnet.middlewares.MyCustomSpiderMiddleware': 543,
 #}
+SPIDER_MIDDLEWARES = {
+    # Closest to the spider, so it times the callbacks alone (hemnet/metrics.py).
+    'hemnet.middlewares.CallbackTimerMiddleware': 990,
+}
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
@@ -86,16 +92,75 @@ DEFAULT_REQUEST_HEADERS = {
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    # Dumps the final stats to STATS_FILE when set (used by hemnet.shards).
+    'hemnet.extensions.StatsFile': 500,
+    # Saves Playwright context cookies/localStorage for the next job.
+    'hemnet.extensions.BrowserStateSaver': 510,
+    # Prometheus-format metrics on METRICS_PORT (hemnet/metrics.py).
+    'hemnet.extensions.MetricsExporter': 520,
+}
+
+# Local metrics endpoint; unset leaves the exporter off.
+METRICS_PORT = int(os.getenv("HEMNET_METRICS_PORT", "0")) or None
+METRICS_HOST = os.getenv("HEMNET_METRICS_HOST", "127.0.0.1")
+METRICS_INTERVAL = 10
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+   'hemnet.pipelines.AddressPipeline': 200,
    'hemnet.pipelines.HemnetPipeline': 300,
 }
 
+# Requests go out by class: new listings, hot listings, search pages, sold
+# backfill, comps (hemnet/priority.py).
+SCHEDULER = 'hemnet.priority.PriorityScheduler'
+# Requests per class and day across all workers, e.g. HEMNET_QUOTAS="sold=5000,comp=2000".
+PRIORITY_QUOTAS = {
+    name.strip(): int(quota)
+    for name, _, quota in (item.partition("=")
+                           for item in os.getenv("HEMNET_QUOTAS", "").split(",") if item.strip())
+}
+
+# Shared Postgres crawl frontier for multi-node crawls (hemnet/frontier.py).
+# Jobs with the same FRONTIER_CRAWL (default: spider name) share one frontier.
+if os.getenv("HEMNET_FRONTIER", "0").lower() in ("1", "true", "yes"):
+    SCHEDULER = 'hemnet.frontier.FrontierScheduler'
+FRONTIER_CRAWL = os.getenv("HEMNET_FRONTIER_CRAWL")
+FRONTIER_LEASE_SECS = int(os.getenv("HEMNET_FRONTIER_LEASE_SECS", "300"))
+FRONTIER_MAX_ATTEMPTS = 3
+FRONTIER_BATCH_SIZE = 16
+
+# Request budget shared by every spider and worker (hemnet/ratelimit.py):
+# "postgres" or "sqlite:<path>"; unset leaves only the per-process throttling.
+RATE_LIMIT_BACKEND = os.getenv("HEMNET_RATE_LIMIT") or None
+# Request class -> (requests per second, burst); seeds buckets that don't exist yet.
+RATE_LIMIT_BUDGETS = {
+    'total': (0.5, 3),
+    'search': (0.2, 2),
+    'detail': (0.4, 3),
+    'image': (1.0, 5),
+}
+
+# Block handling (hemnet/blocking.py): extra delay on 403/429/challenge pages,
+# a circuit breaker and a persistent retry queue for blocked/failed requests.
+BLOCK_GUARD_ENABLED = os.getenv("HEMNET_BLOCK_GUARD", "1").lower() not in ("0", "false", "no")
+BLOCK_BACKOFF_MIN = 5
+BLOCK_BACKOFF_MAX = 300
+BLOCK_WINDOW = 50
+BLOCK_OPEN_RATIO = 0.3
+BLOCK_COOLDOWN_SECS = 300
+RETRY_QUEUE_BASE_SECS = 600
+RETRY_QUEUE_MAX_ATTEMPTS = 5
+RETRY_QUEUE_IDLE_SECS = 3600
+
+# Health-scored pool of proxies x browser contexts (hemnet/pool.py). Each member
+# is its own download slot, so concurrency grows with the pool.
+POOL_PROXIES = [p.strip() for p in os.getenv("HEMNET_PROXIES", "").split(",") if p.strip()]
+POOL_CONTEXTS = int(os.getenv("HEMNET_POOL_CONTEXTS", "1"))
+POOL_REST_SECS = 60
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
 # NOTE: AutoThrottle will honour the standard settings for concurrency and delay
@@ -137,8 +202,41 @@ PLAYWRIGHT_CONTEXTS = {
     }
 }
 
+# Saved browser-context state (cookies, localStorage), restored into new
+# contexts and written back by hemnet.extensions.BrowserStateSaver.
+BROWSER_STATE_ENABLED = os.getenv("HEMNET_BROWSER_STATE", "1").lower() not in ("0", "false", "no")
+BROWSER_STATE_DIR = os.getenv(
+    "HEMNET_BROWSER_STATE_DIR",
+    str(Path(__file__).resolve().parents[1] / "crawls" / "browser-state"),
+)
+BROWSER_STATE_SAVE_SECS = 300
+if BROWSER_STATE_ENABLED:
+    PLAYWRIGHT_CONTEXTS = {
+        name: with_stored_state(kwargs, BROWSER_STATE_DIR, name)
+        for name, kwargs in PLAYWRIGHT_CONTEXTS.items()
+    }
+
+# Sessions (hemnet/sessions.py): warm each browser context / cookie jar up once,
+# keep its state between runs and rotate it before it expires or gets blocked.
+SESSIONS_ENABLED = os.getenv("HEMNET_SESSIONS", "1").lower() not in ("0", "false", "no")
+SESSION_WARMUP_URL = 'https://www.hemnet.se/'
+SESSION_MAX_AGE_SECS = 6 * 3600
+SESSION_EXPIRY_MARGIN_SECS = 1800
+SESSION_MAX_BLOCK_RATE = 0.3
+
+# Connect to a long-lived browser (python -m hemnet.browser serve) instead of
+# launching one per job.
+if os.getenv("HEMNET_BROWSER_URL"):
+    PLAYWRIGHT_CDP_URL = os.getenv("HEMNET_BROWSER_URL")
+
 DOWNLOADER_MIDDLEWARES = {
+    # Before the proxy and user-agent middlewares, which use what it picks.
+    'hemnet.middlewares.PoolMiddleware': 100,
+    'hemnet.middlewares.SessionMiddleware': 105,
     'hemnet.middlewares.RotateUserAgentMiddleware': 110,
+    'hemnet.middlewares.SharedRateLimitMiddleware': 120,
+    # Above RetryMiddleware (550), so blocks are parked instead of retried at once.
+    'hemnet.middlewares.BlockGuardMiddleware': 560,
     'scrapy.downloadermiddlewares.httpproxy.HttpProxyMiddleware': 110
 }
 
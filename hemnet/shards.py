@@ -0,0 +1,224 @@
+"""Run one crawl as N disjoint shards in parallel local processes.
+
+Each shard is a separate ``scrapy crawl`` process (so each gets its own core
+and its own Chromium) started with ``-a shard=i -a shards=N``:
+
+* ``hemnetspider`` crawls every N-th search partition of ``url_queries``,
+* ``hemnetcompspider`` takes the sold ids with ``salda_id % N == i``.
+
+Search partitions overlap (``rooms=None`` covers all rooms), so shards share a
+SQLite seen-id store and only the first shard to claim a listing fetches it.
+The store starts empty on every run, and a listing whose fetch fails is
+released so another partition can still pick it up.
+Each process dumps its final stats, and the launcher merges them::
+
+    python -m hemnet.shards hemnetspider -n 4 -a sold_age=1m
+    python -m hemnet.shards hemnetcompspider -n 2 --out crawls/comp
+
+Logs, per-shard stats and the merged ``stats.json`` end up in ``--out``.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parents[1]
+
+# Stats each shard sets to its own current value (set_value); merged as the
+# mean of the shards instead of summed. Per-minute rates are set_value too,
+# but the rates of parallel shards do add up.
+GAUGE_STATS = (
+    "pool/*/success",
+    "pool/*/latency",
+    "pool/*/recent_blocks",
+    "pool/*/score",
+    "sessions/*/block_rate",
+    "watch/interval_secs",
+    "memusage/startup",
+    "memdebug/*",
+)
+
+
+def _is_gauge(key):
+    return any(fnmatch.fnmatchcase(key, pattern) for pattern in GAUGE_STATS)
+
+
+def shard_slice(values, shard, shards):
+    """Every ``shards``-th value starting at ``shard``; disjoint and balanced."""
+    if not shards or shards <= 1:
+        return list(values)
+    return list(values)[shard::shards]
+
+
+def owns(key, shard, shards):
+    """Whether integer ``key`` belongs to ``shard`` of ``shards``."""
+    if not shards or shards <= 1:
+        return True
+    return int(key) % shards == shard
+
+
+class SeenStore(object):
+    """Set of claimed keys shared by the processes of one machine.
+
+    Backed by a SQLite file in WAL mode; ``claim`` is an atomic
+    insert-if-absent, so exactly one process wins each key.
+    """
+
+    def __init__(self, path, namespace="default"):
+        self.namespace = namespace
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+
+    def claim(self, key):
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO seen (namespace, key) VALUES (?, ?)",
+            (self.namespace, str(key)),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, key):
+        self.conn.execute(
+            "DELETE FROM seen WHERE namespace = ? AND key = ?",
+            (self.namespace, str(key)),
+        )
+
+    def __contains__(self, key):
+        return self.conn.execute(
+            "SELECT 1 FROM seen WHERE namespace = ? AND key = ?",
+            (self.namespace, str(key)),
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute(
+            "SELECT count(*) FROM seen WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def merge_stats(all_stats):
+    """Combine the final Scrapy stats of several shards.
+
+    Counters are summed, gauges (``GAUGE_STATS``) averaged, ``start_time``
+    and ``*_min`` values are the smallest, ``finish_time``, elapsed time and
+    ``*max*`` values the largest, and other values are collected into a
+    sorted list of the distinct ones.
+    """
+    merged = {}
+    gauges = {}
+    other = {}
+    for stats in all_stats:
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                if key == "start_time":
+                    merged[key] = min(merged.get(key, value), value)
+                elif key == "finish_time":
+                    merged[key] = max(merged.get(key, value), value)
+                else:
+                    other.setdefault(key, set()).add(str(value))
+            elif "max" in key or key == "elapsed_time_seconds":
+                merged[key] = max(merged.get(key, value), value)
+            elif key.endswith("_min"):
+                merged[key] = min(merged.get(key, value), value)
+            elif _is_gauge(key):
+                gauges.setdefault(key, []).append(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    for key, values in gauges.items():
+        merged[key] = sum(values) / len(values)
+    for key, values in other.items():
+        merged[key] = sorted(values)
+    merged["shards"] = len(all_stats)
+    return dict(sorted(merged.items()))
+
+
+def run(spider, shards, spider_args=(), settings=(), out_dir=None):
+    """Start ``shards`` crawler processes, wait for all and merge their stats.
+
+    Returns ``(exit codes, merged stats)``.
+    """
+    out = Path(out_dir or PROJECT_DIR / "crawls" / spider).resolve()
+    out.mkdir(parents=True, exist_ok=True)
+    seen = out / "seen.sqlite"
+    # Claims only dedupe within one run; last run's would skip every listing.
+    for suffix in ("", "-wal", "-shm"):
+        path = Path(str(seen) + suffix)
+        if path.exists():
+            path.unlink()
+    processes = []
+    for shard in range(shards):
+        command = [
+            sys.executable, "-m", "scrapy", "crawl", spider,
+            "-a", "shard={}".format(shard),
+            "-a", "shards={}".format(shards),
+            "-a", "seen_store={}".format(seen),
+            "-s", "STATS_FILE={}".format(out / "stats-{}.json".format(shard)),
+            "-s", "LOG_FILE={}".format(out / "shard-{}.log".format(shard)),
+        ]
+        if os.getenv("HEMNET_METRICS_PORT"):
+            # One metrics endpoint per shard: base port + shard.
+            command += ["-s", "METRICS_PORT={}".format(
+                int(os.getenv("HEMNET_METRICS_PORT")) + shard)]
+        for arg in spider_args:
+            command += ["-a", arg]
+        for setting in settings:
+            command += ["-s", setting]
+        processes.append(subprocess.Popen(command, cwd=str(PROJECT_DIR)))
+
+    try:
+        codes = [process.wait() for process in processes]
+    except KeyboardInterrupt:
+        # A second Ctrl-C makes Scrapy stop without finishing in-flight requests.
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        codes = [process.wait() for process in processes]
+
+    all_stats = []
+    for shard in range(shards):
+        path = out / "stats-{}.json".format(shard)
+        if path.exists():
+            all_stats.append(json.loads(path.read_text(encoding="utf-8")))
+    merged = merge_stats(all_stats)
+    merged["exit_codes"] = codes
+    (out / "stats.json").write_text(json.dumps(merged, indent=2), encoding="utf-8")
+    return codes, merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("spider", help="hemnetspider or hemnetcompspider")
+    parser.add_argument("-n", "--shards", type=int, default=4)
+    parser.add_argument("-a", dest="spider_args", action="append", default=[],
+                        metavar="NAME=VALUE", help="spider argument for every shard")
+    parser.add_argument("-s", dest="settings", action="append", default=[],
+                        metavar="NAME=VALUE", help="Scrapy setting for every shard")
+    parser.add_argument("--out", help="directory for logs and stats "
+                        "(default: crawls/<spider>)")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    codes, merged = run(args.spider, args.shards, args.spider_args,
+                        args.settings, args.out)
+    for key in ("item_scraped_count", "downloader/request_count",
+                "downloader/response_status_count/200",
+                "downloader/response_status_count/403", "log_count/ERROR"):
+        print("{:40} {}".format(key, merged.get(key, 0)))
+    print("{} shards finished in {:.0f} s, exit codes {}".format(
+        len(codes), time.time() - started, codes))
+    sys.exit(max(codes) if codes else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+""""More like this" index over active listings.
+
+Each listing becomes one L2-normalised vector: hashed term counts of its
+title, description, labels and amenities, plus a small block of scaled
+numeric features (price, area, rooms, fee, position). Vectors are stored in
+``hemnet_item_vectors`` and bucketed by random-hyperplane LSH into
+``hemnet_item_lsh``, so a query only reranks listings sharing a bucket with
+the seed listings instead of scanning the table::
+
+    similar_listings(engine, [hemnet_id, ...], n=20)
+    similar_to_favorites(engine, user_id, n=20)
+
+The pipeline indexes active listings as they are stored; backfill with::
+
+    python -m hemnet.similarity reindex
+"""
+import argparse
+import math
+import re
+import zlib
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import (
+    HemnetItem,
+    HemnetItemDetail,
+    HemnetItemLsh,
+    HemnetItemVector,
+    HoumFavorite,
+)
+
+TEXT_DIM = 256
+TEXT_FIELDS = ("title", "description", "labels", "relevant_amenities")
+
+# Item field -> transform to roughly unit scale around typical values.
+NUMERIC_FEATURES = (
+    ("price", lambda v: (math.log(v) - 15.0) / 0.7 if v and v > 0 else None),
+    ("square_meters", lambda v: (math.log(v) - 4.2) / 0.5 if v and v > 0 else None),
+    ("rooms", lambda v: (v - 3.0) / 1.5),
+    ("monthly_fee", lambda v: (v - 4000.0) / 2000.0),
+    ("latitude", lambda v: (v - 60.0) * 4.0),
+    ("longitude", lambda v: (v - 15.0) * 2.0),
+)
+NUMERIC_WEIGHT = 0.5
+DIM = TEXT_DIM + len(NUMERIC_FEATURES)
+
+BANDS = 16
+BITS_PER_BAND = 10
+# RandomState streams are frozen across NumPy versions, so stored buckets
+# stay valid when NumPy is upgraded.
+_HYPERPLANES = np.random.RandomState(20240601).standard_normal(
+    (BANDS * BITS_PER_BAND, DIM)
+)
+_BIT_WEIGHTS = 1 << np.arange(BITS_PER_BAND, dtype=np.int64)
+
+_TOKEN_RE = re.compile(r"\w{3,}", re.UNICODE)
+
+
+def _strings(value):
+    """All string leaves of a (JSON) value."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for child in value.values():
+            for text in _strings(child):
+                yield text
+    elif isinstance(value, (list, tuple)):
+        for child in value:
+            for text in _strings(child):
+                yield text
+
+
+def item_vector(item):
+    """Normalised float32 vector for a listing dict, or None without content."""
+    vector = np.zeros(DIM, dtype=np.float32)
+    counts = {}
+    for field in TEXT_FIELDS:
+        for text in _strings(item.get(field)):
+            for token in _TOKEN_RE.findall(text.lower()):
+                if token.isdigit():
+                    continue
+                slot = zlib.crc32(token.encode("utf-8")) % TEXT_DIM
+                counts[slot] = counts.get(slot, 0) + 1
+    for slot, count in counts.items():
+        vector[slot] = 1.0 + math.log(count)
+    text_norm = np.linalg.norm(vector[:TEXT_DIM])
+    if text_norm:
+        vector[:TEXT_DIM] /= text_norm
+
+    for offset, (field, scale) in enumerate(NUMERIC_FEATURES):
+        value = item.get(field)
+        if value is None:
+            continue
+        try:
+            scaled = scale(float(value))
+        except (TypeError, ValueError):
+            continue
+        if scaled is not None:
+            vector[TEXT_DIM + offset] = NUMERIC_WEIGHT * max(-3.0, min(3.0, scaled))
+
+    norm = np.linalg.norm(vector)
+    if not norm:
+        return None
+    return vector / norm
+
+
+def lsh_buckets(vector):
+    """One bucket id per band from the signs of the hyperplane projections."""
+    bits = (_HYPERPLANES @ vector > 0).reshape(BANDS, BITS_PER_BAND)
+    return (bits * _BIT_WEIGHTS).sum(axis=1).tolist()
+
+
+def encode(vector):
+    return vector.astype(np.float16).tobytes()
+
+
+def decode(data):
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+
+def index_item(session, item):
+    """Store (or replace) the vector and LSH buckets of one listing."""
+    hemnet_id = item.get("hemnet_id")
+    vector = item_vector(item)
+    if hemnet_id is None or vector is None:
+        return False
+    vectors = HemnetItemVector.__table__
+    lsh = HemnetItemLsh.__table__
+    stmt = insert(vectors).values(
+        hemnet_id=hemnet_id, vector=encode(vector), updated_at=datetime.now()
+    )
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=["hemnet_id"],
+        set_={"vector": stmt.excluded.vector, "updated_at": stmt.excluded.updated_at},
+    ))
+    session.execute(lsh.delete().where(lsh.c.hemnet_id == hemnet_id))
+    session.execute(lsh.insert(), [
+        {"band": band, "bucket": bucket, "hemnet_id": hemnet_id}
+        for band, bucket in enumerate(lsh_buckets(vector))
+    ])
+    return True
+
+
+def similar_listings(engine, hemnet_ids, n=20, exclude=None):
+    """Top ``n`` (hemnet_id, cosine) pairs most similar to the seed listings.
+
+    The seeds' vectors are averaged; candidates are the listings sharing an
+    LSH bucket with any seed, reranked by exact cosine similarity.
+    """
+    seeds = set(hemnet_ids)
+    if not seeds:
+        return []
+    exclude = seeds | set(exclude or ())
+    vectors = HemnetItemVector.__table__
+    lsh = HemnetItemLsh.__table__
+    with engine.connect() as conn:
+        seed_rows = conn.execute(select([vectors.c.vector]).where(
+            vectors.c.hemnet_id.in_(list(seeds)))).fetchall()
+        if not seed_rows:
+            return []
+        seed_vectors = [decode(row[0]) for row in seed_rows]
+        keys = {(band, bucket) for v in seed_vectors
+                for band, bucket in enumerate(lsh_buckets(v))}
+        candidates = {
+            row[0] for row in conn.execute(
+                select([lsh.c.hemnet_id]).distinct().where(
+                    tuple_(lsh.c.band, lsh.c.bucket).in_(list(keys))))
+        } - exclude
+        if not candidates:
+            return []
+        rows = conn.execute(select([vectors.c.hemnet_id, vectors.c.vector]).where(
+            vectors.c.hemnet_id.in_(list(candidates)))).fetchall()
+
+    query = np.mean(seed_vectors, axis=0)
+    query /= np.linalg.norm(query) or 1.0
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    matrix = np.vstack([decode(row[1]) for row in rows])
+    scores = matrix @ query
+    top = np.argsort(-scores, kind="stable")[:n]
+    return list(zip(ids[top].tolist(), scores[top].astype(float).tolist()))
+
+
+def similar_to_favorites(engine, user_id, n=20):
+    """Listings most like a houm_users row's favorites, favorites excluded."""
+    favorites = HoumFavorite.__table__
+    with engine.connect() as conn:
+        ids = [row[0] for row in conn.execute(select([favorites.c.hemnet_id]).where(
+            favorites.c.user_id == user_id))]
+    return similar_listings(engine, ids, n=n)
+
+
+def reindex(engine, batch_size=1000):
+    """Rebuild vectors and buckets for all active listings."""
+    items = HemnetItem.__table__
+    details = HemnetItemDetail.__table__
+    columns = [items.c.hemnet_id, items.c.title]
+    columns += [items.c[field] for field, _ in NUMERIC_FEATURES]
+    columns += [details.c.description, details.c.labels, details.c.relevant_amenities]
+    query = (
+        select(columns)
+        .select_from(items.outerjoin(details, details.c.item_id == items.c.id))
+        .where(items.c.sold_date.is_(None))
+        # One row per listing, its latest observation.
+        .distinct(items.c.hemnet_id)
+        .order_by(items.c.hemnet_id, items.c.id.desc())
+    )
+    indexed = 0
+    with engine.begin() as conn:
+        conn.execute(HemnetItemLsh.__table__.delete())
+        conn.execute(HemnetItemVector.__table__.delete())
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                indexed += index_item(conn, dict(row))
+    return indexed
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("reindex", help="rebuild the index from active listings")
+    like = sub.add_parser("similar", help="listings similar to hemnet ids")
+    like.add_argument("hemnet_id", type=int, nargs="+")
+    like.add_argument("-n", type=int, default=20)
+    favorites = sub.add_parser("favorites", help="listings similar to a user's favorites")
+    favorites.add_argument("user_id", type=int)
+    favorites.add_argument("-n", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    if args.command == "reindex":
+        print("{} listings indexed".format(reindex(engine)))
+        return
+    if args.command == "similar":
+        results = similar_listings(engine, args.hemnet_id, n=args.n)
+    else:
+        results = similar_to_favorites(engine, args.user_id, n=args.n)
+    for hemnet_id, score in results:
+        print("{}\t{:.3f}".format(hemnet_id, score))
+
+
+if __name__ == "__main__":
+    main()
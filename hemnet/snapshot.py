@@ -0,0 +1,295 @@
+"""Memory-mapped NumPy snapshot of the numeric hemnet_items columns.
+
+Build it once (or on a schedule) and answer ad-hoc questions in process::
+
+    python -m hemnet.snapshot build snapshot/
+
+    snap = Snapshot.load("snapshot/")
+    mask = snap.mask(rooms=(2, 3), sold_date=("2012-01-01", None),
+                     geographic_area__contains="Guldheden")
+    snap.quantile("price_per_square_meter", 0.5, mask)
+    snap.group_by("broker_email", "price", agg="sum", mask=mask)
+
+Numbers are float64 with NaN for NULL (``id`` and ``hemnet_id`` are int64,
+-1 for NULL), dates are ``datetime64[D]`` with NaT,
+and strings are dictionary encoded as int32 codes (-1 for NULL).
+Substring filters therefore only scan the dictionary, not every row.
+"""
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy import select
+
+from .models import HemnetItem
+from .partitions import as_date
+
+NUMERIC_COLUMNS = (
+    "price",
+    "asked_price",
+    "price_per_square_meter",
+    "square_meters",
+    "rooms",
+    "monthly_fee",
+    "latitude",
+    "longitude",
+)
+DATE_COLUMNS = ("sold_date", "collected_at")
+DICTIONARY_COLUMNS = (
+    "geographic_area",
+    "municipality_name",
+    "broker_email",
+    "broker_firm",
+    "type",
+)
+
+META_FILE = "meta.json"
+DICTIONARY_FILE = "dictionaries.json"
+
+
+def _to_datetime64(value):
+    day = as_date(value)
+    return np.datetime64(day, "D") if day else np.datetime64("NaT", "D")
+
+
+class Snapshot(object):
+    """Column arrays of hemnet_items plus the string dictionaries."""
+
+    def __init__(self, columns, dictionaries, meta):
+        self.columns = columns
+        self.dictionaries = dictionaries
+        self.meta = meta
+        self._lookups = {}
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        path = Path(path)
+        meta = json.loads((path / META_FILE).read_text(encoding="utf-8"))
+        dictionaries = json.loads((path / DICTIONARY_FILE).read_text(encoding="utf-8"))
+        mode = "r" if mmap else None
+        columns = {
+            name: np.load(str(path / "{}.npy".format(name)), mmap_mode=mode)
+            for name in meta["columns"]
+        }
+        return cls(columns, dictionaries, meta)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def code(self, column, value):
+        """Code of an exact dictionary value, or -2 (matches nothing)."""
+        lookup = self._lookups.get(column)
+        if lookup is None:
+            lookup = {v: i for i, v in enumerate(self.dictionaries[column])}
+            self._lookups[column] = lookup
+        return lookup.get(value, -2)
+
+    def codes_containing(self, column, substring, case=False):
+        """Codes whose dictionary value contains ``substring`` (SQL LIKE '%x%')."""
+        if not case:
+            substring = substring.lower()
+        values = self.dictionaries[column]
+        return np.array(
+            [i for i, v in enumerate(values)
+             if substring in (v if case else v.lower())],
+            dtype=np.int32,
+        )
+
+    def decode(self, column, codes):
+        values = self.dictionaries[column]
+        return [values[c] if c >= 0 else None for c in np.asarray(codes).tolist()]
+
+    def _condition(self, name, value):
+        if name.endswith("__contains"):
+            column = name[:-len("__contains")]
+            return np.isin(self.columns[column], self.codes_containing(column, value))
+        data = self.columns[name]
+        if name in DICTIONARY_COLUMNS:
+            if isinstance(value, (list, tuple, set, frozenset)):
+                return np.isin(data, [self.code(name, v) for v in value])
+            return data == self.code(name, value)
+        if isinstance(value, tuple):
+            low, high = value
+            if name in DATE_COLUMNS:
+                low = _to_datetime64(low) if low is not None else None
+                high = _to_datetime64(high) if high is not None else None
+            mask = np.ones(len(data), dtype=bool)
+            if low is not None:
+                mask &= data >= low
+            if high is not None:
+                mask &= data <= high
+            return mask
+        if name in DATE_COLUMNS:
+            value = _to_datetime64(value)
+        return data == value
+
+    def mask(self, **conditions):
+        """Row mask for all conditions combined with AND.
+
+        ``col=(low, high)`` is an inclusive range (``None`` for open ends),
+        ``col=value`` equality, ``col=[a, b]`` membership for dictionary
+        columns and ``col__contains="text"`` a case-insensitive substring.
+        """
+        result = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            result &= self._condition(name, value)
+        return result
+
+    def values(self, column, mask=None):
+        data = np.asarray(self.columns[column])
+        if mask is not None:
+            data = data[mask]
+        return data[~np.isnan(data)]
+
+    def quantile(self, column, q, mask=None):
+        data = self.values(column, mask)
+        if not len(data):
+            return float("nan")
+        return np.quantile(data, q)
+
+    def group_by(self, key, column, agg="mean", mask=None, q=0.5):
+        """Aggregate ``column`` per value of the dictionary column ``key``.
+
+        ``agg`` is one of count, sum, mean, median or quantile (with ``q``).
+        Returns a dict of decoded key -> value, NULL values of ``column``
+        ignored.
+        """
+        codes = np.asarray(self.columns[key])
+        data = np.asarray(self.columns[column], dtype=np.float64)
+        selected = ~np.isnan(data) & (codes >= 0)
+        if mask is not None:
+            selected &= mask
+        codes = codes[selected]
+        data = data[selected]
+        if not len(codes):
+            return {}
+
+        if agg in ("count", "sum", "mean"):
+            size = len(self.dictionaries[key])
+            counts = np.bincount(codes, minlength=size)
+            present = np.flatnonzero(counts)
+            if agg == "count":
+                result = counts[present]
+            else:
+                sums = np.bincount(codes, weights=data, minlength=size)[present]
+                result = sums if agg == "sum" else sums / counts[present]
+            return dict(zip(self.decode(key, present), result.tolist()))
+
+        if agg == "median":
+            q = 0.5
+        elif agg != "quantile":
+            raise ValueError("unknown aggregate {!r}".format(agg))
+        # Sort by (code, value) once and interpolate inside each group run.
+        order = np.lexsort((data, codes))
+        codes = codes[order]
+        data = data[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+        ends = np.concatenate((starts[1:], [len(codes)]))
+        position = starts + q * (ends - starts - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        result = data[low] + (data[high] - data[low]) * (position - low)
+        return dict(zip(self.decode(key, codes[starts]), result.tolist()))
+
+
+def build_snapshot(engine, path, batch_size=50000):
+    """Write a fresh snapshot of hemnet_items to ``path`` and return it."""
+    path = Path(path)
+    table = HemnetItem.__table__
+    names = ("id", "hemnet_id") + NUMERIC_COLUMNS + DATE_COLUMNS + DICTIONARY_COLUMNS
+    query = select([table.c[name] for name in names]).order_by(table.c.id)
+
+    chunks = {name: [] for name in names}
+    dictionaries = {name: {} for name in DICTIONARY_COLUMNS}
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            for name, values in zip(names, columns):
+                if name == "id":
+                    array = np.array(values, dtype=np.int64)
+                elif name == "hemnet_id":
+                    array = np.array([-1 if v is None else v for v in values],
+                                     dtype=np.int64)
+                elif name in NUMERIC_COLUMNS:
+                    array = np.array(
+                        [np.nan if v is None else v for v in values],
+                        dtype=np.float64,
+                    )
+                elif name in DATE_COLUMNS:
+                    array = np.array(
+                        [_to_datetime64(v) for v in values],
+                        dtype="datetime64[D]",
+                    )
+                else:
+                    lookup = dictionaries[name]
+                    array = np.array(
+                        [-1 if v is None else lookup.setdefault(v, len(lookup))
+                         for v in values],
+                        dtype=np.int32,
+                    )
+                chunks[name].append(array)
+
+    dtypes = {"id": np.int64, "hemnet_id": np.int64}
+    dtypes.update((name, np.float64) for name in NUMERIC_COLUMNS)
+    dtypes.update((name, "datetime64[D]") for name in DATE_COLUMNS)
+    dtypes.update((name, np.int32) for name in DICTIONARY_COLUMNS)
+
+    # Write next to the target and swap, so readers never see a partial snapshot.
+    tmp = path.with_name(path.name + ".tmp")
+    if tmp.exists():
+        shutil.rmtree(str(tmp))
+    tmp.mkdir(parents=True)
+    rows = 0
+    for name in names:
+        array = (np.concatenate(chunks[name]) if chunks[name]
+                 else np.empty(0, dtype=dtypes[name]))
+        rows = len(array)
+        np.save(str(tmp / "{}.npy".format(name)), array)
+    (tmp / DICTIONARY_FILE).write_text(json.dumps(
+        {name: list(lookup) for name, lookup in dictionaries.items()},
+        ensure_ascii=False,
+    ), encoding="utf-8")
+    (tmp / META_FILE).write_text(json.dumps({
+        "rows": rows,
+        "columns": list(names),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }), encoding="utf-8")
+
+    if path.exists():
+        old = path.with_name(path.name + ".old")
+        if old.exists():
+            shutil.rmtree(str(old))
+        os.replace(str(path), str(old))
+        os.replace(str(tmp), str(path))
+        shutil.rmtree(str(old))
+    else:
+        os.replace(str(tmp), str(path))
+    return Snapshot.load(path)
+
+
+def main(argv=None):
+    from .models import db_connect
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("path", help="snapshot directory")
+    parser.add_argument("--batch-size", type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    snapshot = build_snapshot(db_connect(), args.path, args.batch_size)
+    print("{} rows -> {}".format(len(snapshot), args.path))
+
+
+if __name__ == "__main__":
+    main()
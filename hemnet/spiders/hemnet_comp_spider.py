@@ -9,6 +9,8 @@ from twisted.internet.error import TimeoutError, TCPTimedOutError
 
 from sqlalchemy.orm import sessionmaker
 
+from hemnet.blocking import RequestQueued
+from hemnet.shards import owns
 from hemnet.models import (
     HemnetItem as HemnetSQL,
     HemnetCompItem as HemnetCompSQL,
@@ -21,9 +23,14 @@ class HemnetSpider(scrapy.Spider):
     name = 'hemnetcompspider'
     rotate_user_agent = True
 
-    def __init__(self, use_browser='1', *args, **kwargs):
+    def __init__(self, use_browser='1', shard='0', shards='1', seen_store=None,
+                 *args, **kwargs):
         super(HemnetSpider, self).__init__(*args, **kwargs)
         self.use_browser = str(use_browser).lower() in ('1', 'true', 'yes', 'y')
+        # Shards split the sold ids by salda_id % shards; they never overlap,
+        # so seen_store (passed by python -m hemnet.shards) is not needed.
+        self.shard = int(shard)
+        self.shards = int(shards)
         self.playwright_page_methods = [
             PageMethod("wait_for_load_state", "networkidle"),
             PageMethod("wait_for_timeout", 1000),
@@ -34,6 +41,8 @@ class HemnetSpider(scrapy.Spider):
 
     def _make_request(self, url, callback, errback=None, meta=None):
         meta = dict(meta or {})
+        # Everything this spider fetches is comps backfill (hemnet.priority).
+        meta.setdefault("crawl_class", "comp")
         if self.use_browser:
             meta.setdefault("playwright", True)
             meta.setdefault("playwright_context", "default")
@@ -48,6 +57,8 @@ class HemnetSpider(scrapy.Spider):
         if failure.check(HttpError):
             response = failure.value.response
             self._write_err(response.status, response.url)
+        elif failure.check(RequestQueued):
+            self._write_err('Queued {}'.format(failure.value), failure.request.url)
         elif failure.check(TimeoutError, TCPTimedOutError):
             request = failure.request
             self._write_err('TimeoutError', request.url)
@@ -58,8 +69,10 @@ class HemnetSpider(scrapy.Spider):
     def start_requests(self):
         session = self.session
         salda_items = session.query(HemnetSQL.hemnet_id, HemnetSQL.url).all()
-        comp_ids = [i for i, in session.query(HemnetCompSQL.salda_id).all()]
+        comp_ids = set(i for i, in session.query(HemnetCompSQL.salda_id).all())
         for salda_id, url in salda_items:
+            if salda_id is None or not owns(salda_id, self.shard, self.shards):
+                continue
             if salda_id not in comp_ids:
                 yield self._make_request(url, self.parse_salda,
                                          errback=self.download_err_back,
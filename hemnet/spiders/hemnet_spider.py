@@ -2,6 +2,7 @@
 
 import re
 import json
+import time
 from pathlib import Path
 from datetime import datetime
 import scrapy
@@ -10,13 +11,17 @@ from urllib.parse import urlparse, urljoin, urlencode
 
 from itertools import product
 
-from scrapy import Selector
+from scrapy import Selector, signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.spidermiddlewares.httperror import HttpError
 from scrapy_playwright.page import PageMethod
 from twisted.internet.error import TimeoutError, TCPTimedOutError
 from sqlalchemy.orm import sessionmaker
 
 from hemnet.items import HemnetItem, HemnetCompItem
+from hemnet.blocking import RequestQueued
+from hemnet.shards import SeenStore, shard_slice
+from hemnet.watch import KNOWN_STOP, PollInterval, detection_secs, newest_first
 from hemnet.models import (
     HemnetItem as HemnetSQL,
     db_connect,
@@ -25,6 +30,9 @@ from hemnet.models import (
 
 
 BASE_URL = 'https://www.hemnet.se/bostader?published_since=3d&location_ids%5B%5D=17744'
+SEARCH_URL = 'https://www.hemnet.se/salda/bostader?'
+# Watch-mode polls go out before everything else (see hemnet.priority).
+WATCH_PRIORITY = 1000
 
 location_ids = [17744]
 item_types = ['radhus', 'bostadsratt', 'villa']
@@ -75,6 +83,11 @@ def start_urls(sold_age):
     return [BASE_URL]
 
 
+def partition_urls(sold_age):
+    """One search URL per partition of the search space (see url_queries)."""
+    return [SEARCH_URL + query for query in url_queries(sold_age)]
+
+
 def extract_listing_urls(response):
     selectors = [
         '#search-results li > div > a::attr("href")',
@@ -103,6 +116,18 @@ def extract_listing_urls(response):
     return list(dict.fromkeys(urls))
 
 
+# Search cards of listings with bidding going on or an open house coming up.
+HOT_MARKERS = ('budgivning pågår', 'visning')
+
+
+def is_hot_listing(response, href):
+    """True if the search card linking to ``href`` shows bidding or a viewing."""
+    card = response.xpath('//a[@href=$href]/ancestor::*[self::li or self::article][1]',
+                          href=href)
+    text = ' '.join(card.xpath('.//text()').getall()).lower()
+    return any(marker in text for marker in HOT_MARKERS)
+
+
 def _extract_next_data(response):
     script = response.css('script#__NEXT_DATA__::text').get()
     if not script:
@@ -227,10 +252,23 @@ class HemnetSpider(scrapy.Spider):
     name = 'hemnetspider'
     rotate_user_agent = True
 
-    def __init__(self, sold_age='1m', use_browser='1', *args, **kwargs):
+    def __init__(self, sold_age='1m', use_browser='1', partitioned='0',
+                 shard='0', shards='1', seen_store=None, watch='0',
+                 watch_min='60', watch_max='900', *args, **kwargs):
         super(HemnetSpider, self).__init__(*args, **kwargs)
         self.sold_age = sold_age
         self.use_browser = str(use_browser).lower() in ('1', 'true', 'yes', 'y')
+        # Sharded runs (python -m hemnet.shards) always crawl the partitions.
+        self.shard = int(shard)
+        self.shards = int(shards)
+        self.partitioned = (self.shards > 1
+                            or str(partitioned).lower() in ('1', 'true', 'yes', 'y'))
+        self.seen = SeenStore(seen_store, self.name) if seen_store else None
+        # Watch mode (hemnet.watch): poll the newest listings until stopped.
+        self.watch = str(watch).lower() in ('1', 'true', 'yes', 'y')
+        self.poll_interval = PollInterval(float(watch_min), float(watch_max))
+        self.known = set()
+        self._next_poll = None
         self.playwright_page_methods = [
             PageMethod("wait_for_load_state", "networkidle"),
             PageMethod("wait_for_timeout", 1000),
@@ -239,6 +277,14 @@ class HemnetSpider(scrapy.Spider):
         create_hemnet_table(engine)
         self.session = sessionmaker(bind=engine)()
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(HemnetSpider, cls).from_crawler(crawler, *args, **kwargs)
+        if spider.watch:
+            crawler.signals.connect(spider._watch_idle, signal=signals.spider_idle)
+            crawler.signals.connect(spider._watch_closed, signal=signals.spider_closed)
+        return spider
+
     def _make_request(self, url, callback, errback=None, meta=None):
         meta = dict(meta or {})
         if self.use_browser:
@@ -248,10 +294,76 @@ class HemnetSpider(scrapy.Spider):
         return scrapy.Request(url, callback, errback=errback, meta=meta)
 
     def start_requests(self):
-        for url in start_urls(self.sold_age):
+        if self.watch:
+            yield self._poll_request()
+            return
+        if self.partitioned:
+            urls = shard_slice(partition_urls(self.sold_age), self.shard, self.shards)
+        else:
+            urls = start_urls(self.sold_age)
+        for url in urls:
             yield self._make_request(url, self.parse,
                                      errback=self.download_err_back)
 
+    def _poll_request(self, url=None, found=0):
+        request = self._make_request(url or newest_first(BASE_URL), self.parse,
+                                     errback=self._watch_err_back,
+                                     meta={'watch_found': found,
+                                           'crawl_class': 'search',
+                                           'crawl_prioritized': True})
+        return request.replace(priority=WATCH_PRIORITY, dont_filter=True)
+
+    def _poll(self):
+        self._next_poll = None
+        self.crawler.stats.inc_value('watch/polls', spider=self)
+        self.crawler.engine.crawl(self._poll_request())
+
+    def _poll_done(self, found):
+        secs = self.poll_interval.update(found)
+        self.crawler.stats.set_value('watch/interval_secs', secs, spider=self)
+        self.logger.info('Watch poll found %d new listings, next in %.0f s', found, secs)
+        # End the read transaction between polls instead of holding it open.
+        self.session.close()
+        if self._next_poll is not None and self._next_poll.active():
+            # A parked poll page came back from the retry queue; one chain is enough.
+            return
+        # Imported here: the spider loader imports this module before Scrapy
+        # installs its reactor.
+        from twisted.internet import reactor
+        self._next_poll = reactor.callLater(secs, self._poll)
+
+    def _watch_idle(self, spider):
+        if spider is self:
+            raise DontCloseSpider
+
+    def _watch_closed(self, spider):
+        if self._next_poll is not None and self._next_poll.active():
+            self._next_poll.cancel()
+
+    def _watch_err_back(self, failure):
+        self.download_err_back(failure)
+        self._poll_done(failure.request.meta.get('watch_found', 0))
+
+    def _known(self, hemnet_id):
+        if hemnet_id in self.known:
+            return True
+        q = self.session.query(HemnetSQL)\
+            .filter(HemnetSQL.hemnet_id == hemnet_id)
+        if self.session.query(q.exists()).scalar():
+            self.known.add(hemnet_id)
+            return True
+        return False
+
+    def _claim(self, hemnet_id):
+        """False if another shard already took this listing."""
+        return self.seen is None or self.seen.claim(hemnet_id)
+
+    def _release(self, hemnet_id):
+        """Forget a listing whose fetch failed, so a later poll or shard retries it."""
+        self.known.discard(hemnet_id)
+        if self.seen is not None:
+            self.seen.release(hemnet_id)
+
     def _write_err(self, code, url):
         with open(self.name + '_err.txt', 'a') as f:
             f.write('{}: {}\n'.format(code, url))
@@ -271,31 +383,62 @@ class HemnetSpider(scrapy.Spider):
         if failure.check(HttpError):
             response = failure.value.response
             self._write_err(response.status, response.url)
+        elif failure.check(RequestQueued):
+            # Blocked; hemnet.blocking retries it later.
+            self._write_err('Queued {}'.format(failure.value), failure.request.url)
         elif failure.check(TimeoutError, TCPTimedOutError):
             request = failure.request
             self._write_err('TimeoutError', request.url)
         else:
             request = failure.request
             self._write_err('Other', request.url)
+        # Queued requests come back later and keep their claim.
+        hemnet_id = failure.request.meta.get('hemnet_id')
+        if hemnet_id is not None and not failure.check(RequestQueued):
+            self._release(hemnet_id)
+
+    @staticmethod
+    def _listing_meta(response, href):
+        """Request class of a listing found on a search page (hemnet.priority)."""
+        if 'published_since' in response.url:
+            return {'crawl_class': 'new'}
+        if is_hot_listing(response, href):
+            return {'crawl_class': 'hot'}
+        return None
 
     def parse(self, response):
         urls = extract_listing_urls(response)
-        for url in urls:
-            url = urljoin(response.url, url)
+        watching = 'watch_found' in response.meta
+        found = known = 0
+        for href in urls:
+            url = urljoin(response.url, href)
             try:
                 hemnet_id = get_hemnet_id(url)
             except Exception:
                 self._write_err('BadUrl', url)
                 continue
-            session = self.session
-            q = session.query(HemnetSQL)\
-                .filter(HemnetSQL.hemnet_id == hemnet_id)
-            if not session.query(q.exists()).scalar():
+            if self._known(hemnet_id):
+                known += 1
+            elif self._claim(hemnet_id):
+                meta = self._listing_meta(response, href) or {}
+                meta['hemnet_id'] = hemnet_id
+                if watching:
+                    self.known.add(hemnet_id)
+                    meta['detected_at'] = time.time()
+                    found += 1
                 yield self._make_request(url, self.parse_detail_page,
-                                         errback=self.download_err_back)
+                                         errback=self.download_err_back,
+                                         meta=meta)
 
         next_href = response.css('a.next_page::attr("href")').extract_first()
-        if next_href:
+        if watching:
+            # Newest first: once a page is mostly known, so is the rest.
+            found += response.meta['watch_found']
+            if next_href and known < min(KNOWN_STOP, len(urls)):
+                yield self._poll_request(urljoin(response.url, next_href), found)
+            else:
+                self._poll_done(found)
+        elif next_href:
             next_url = urljoin(response.url, next_href)
             yield self._make_request(next_url, self.parse,
                                      errback=self.download_err_back)
@@ -550,6 +693,10 @@ class HemnetSpider(scrapy.Spider):
         lat, lon = extract_coords(response)
         item['latitude'] = lat
         item['longitude'] = lon
+        detected_at = response.meta.get('detected_at')
+        if detected_at:
+            item['detected_at'] = detected_at
+            self._detected(item)
         yield item
 
         prev_page_url = response.css('link[rel=prev]::attr(href)')\
@@ -558,9 +705,21 @@ class HemnetSpider(scrapy.Spider):
         if prev_page_url:
             yield self._make_request(prev_page_url, self.parse_prev_page,
                                      meta={'lat': lat, 'lon': lon,
-                                           'salda_id': props.get('id')},
+                                           'salda_id': props.get('id'),
+                                           'crawl_class': 'comp'},
                                      errback=self.download_err_back)
 
+    def _detected(self, item):
+        stats = self.crawler.stats
+        stats.inc_value('watch/new_listings', spider=self)
+        secs = detection_secs(item.get('published_at'),
+                              datetime.fromtimestamp(item['detected_at']))
+        if secs is not None:
+            stats.max_value('watch/detection_secs_max', secs, spider=self)
+            stats.min_value('watch/detection_secs_min', secs, spider=self)
+            self.logger.info('Listing %s detected %.0f s after publication',
+                             item.get('hemnet_id'), secs)
+
     def parse_prev_page(self, response):
         try:
             layer_data = self._get_layer_data(response)
@@ -0,0 +1,190 @@
+"""Append-only change history of active listings.
+
+Every time the pipeline stores an active listing, its tracked fields
+(``TRACKED_FIELDS``) are compared with the listing's last known state and
+only the changed ones are appended to ``hemnet_listing_changes``. The first
+observation, and every ``KEYFRAME_EVERY``-th after it, stores the full state
+instead, so reconstructing a listing reads at most ``KEYFRAME_EVERY`` rows.
+Unchanged observations write nothing::
+
+    state_at(engine, hemnet_id, datetime(2024, 5, 1))
+    history(engine, hemnet_id)          # [(observed_at, state), ...]
+    price_cuts(engine, municipality="Göteborg", since=date.today() - timedelta(days=7))
+
+    python -m hemnet.timeline state 21345678 --at 2024-05-01
+    python -m hemnet.timeline price-cuts --municipality Göteborg --days 7
+"""
+import argparse
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import HemnetItem, HemnetListingChange
+
+TRACKED_FIELDS = (
+    "asked_price",
+    "price_change",
+    "times_viewed",
+    "days_on_hemnet",
+    "is_bidding_ongoing",
+    "bidding_started",
+    "is_upcoming",
+    "upcoming_open_houses",
+)
+KEYFRAME_EVERY = 32
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def tracked_state(item):
+    """The tracked fields of an item, as they round-trip through JSON."""
+    return {field: json.loads(_canonical(item.get(field))) for field in TRACKED_FIELDS}
+
+
+def diff(old, new):
+    """Fields of ``new`` whose value differs from (or is missing in) ``old``."""
+    return {
+        field: value for field, value in new.items()
+        if field not in old or _canonical(old[field]) != _canonical(value)
+    }
+
+
+def _replay(rows):
+    state = {}
+    for row in rows:
+        if row["keyframe"]:
+            state = dict(row["changes"])
+        else:
+            state.update(row["changes"])
+    return state
+
+
+def _since_keyframe(hemnet_id, at=None):
+    """Rows of a listing from its last keyframe (at or before ``at``) on."""
+    t = HemnetListingChange.__table__
+    keyframe = select([func.max(t.c.seq)]).where(
+        (t.c.hemnet_id == hemnet_id) & t.c.keyframe)
+    query = select([t.c.observed_at, t.c.seq, t.c.keyframe, t.c.changes]).where(
+        t.c.hemnet_id == hemnet_id)
+    if at is not None:
+        keyframe = keyframe.where(t.c.observed_at <= at)
+        query = query.where(t.c.observed_at <= at)
+    return query.where(t.c.seq >= keyframe.as_scalar()).order_by(t.c.seq)
+
+
+def observe(session, item, observed_at=None):
+    """Record one observation of ``item``; returns the stored changes.
+
+    An empty dict means nothing changed and no row was written.
+    """
+    hemnet_id = item.get("hemnet_id")
+    if hemnet_id is None:
+        return {}
+    observed_at = observed_at or datetime.now()
+    rows = [dict(row) for row in session.execute(_since_keyframe(hemnet_id))]
+    state = _replay(rows)
+    new = tracked_state(item)
+    changes = diff(state, new)
+    if rows and not changes:
+        return {}
+
+    seq = rows[-1]["seq"] + 1 if rows else 0
+    keyframe = seq % KEYFRAME_EVERY == 0
+    old_price, new_price = state.get("asked_price"), new["asked_price"]
+    price_changed = "asked_price" in changes and new_price is not None
+    stmt = insert(HemnetListingChange.__table__).values(
+        hemnet_id=hemnet_id,
+        observed_at=observed_at,
+        seq=seq,
+        keyframe=keyframe,
+        changes=new if keyframe else changes,
+        asked_price=new_price if price_changed else None,
+        price_delta=(new_price - old_price
+                     if price_changed and old_price is not None else None),
+    )
+    session.execute(stmt.on_conflict_do_nothing(
+        index_elements=["hemnet_id", "observed_at"]))
+    return changes
+
+
+def state_at(engine, hemnet_id, at=None):
+    """Tracked state of a listing at time ``at`` (default: latest), or None."""
+    with engine.connect() as conn:
+        rows = [dict(row) for row in conn.execute(_since_keyframe(hemnet_id, at))]
+    return _replay(rows) if rows else None
+
+
+def history(engine, hemnet_id):
+    """Full tracked state after every stored observation, oldest first."""
+    t = HemnetListingChange.__table__
+    query = select([t.c.observed_at, t.c.keyframe, t.c.changes]).where(
+        t.c.hemnet_id == hemnet_id).order_by(t.c.seq)
+    states = []
+    state = {}
+    with engine.connect() as conn:
+        for row in conn.execute(query):
+            state = dict(row["changes"]) if row["keyframe"] else dict(state, **row["changes"])
+            states.append((row["observed_at"], state))
+    return states
+
+
+def price_cuts(engine, municipality=None, since=None, until=None, limit=None):
+    """Asked-price reductions, newest first, optionally for one municipality."""
+    t = HemnetListingChange.__table__
+    items = HemnetItem.__table__
+    query = select([t.c.hemnet_id, t.c.observed_at, t.c.asked_price,
+                    t.c.price_delta]).where(t.c.price_delta < 0)
+    if since is not None:
+        query = query.where(t.c.observed_at >= since)
+    if until is not None:
+        query = query.where(t.c.observed_at < until)
+    if municipality is not None:
+        query = query.where(t.c.hemnet_id.in_(
+            select([items.c.hemnet_id]).where(items.c.municipality_name == municipality)))
+    query = query.order_by(t.c.observed_at.desc())
+    if limit:
+        query = query.limit(limit)
+    with engine.connect() as conn:
+        return [dict(row) for row in conn.execute(query)]
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    state = sub.add_parser("state", help="tracked state of a listing")
+    state.add_argument("hemnet_id", type=int)
+    state.add_argument("--at", type=datetime.fromisoformat,
+                       help="ISO date/time (default: latest)")
+    changes = sub.add_parser("history", help="every stored state of a listing")
+    changes.add_argument("hemnet_id", type=int)
+    cuts = sub.add_parser("price-cuts", help="recent asked-price reductions")
+    cuts.add_argument("--municipality")
+    cuts.add_argument("--days", type=int, default=7)
+    cuts.add_argument("--limit", type=int)
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    if args.command == "state":
+        print(json.dumps(state_at(engine, args.hemnet_id, args.at),
+                         ensure_ascii=False, indent=2))
+    elif args.command == "history":
+        for observed_at, values in history(engine, args.hemnet_id):
+            print("{}\t{}".format(observed_at.isoformat(timespec="seconds"),
+                                  json.dumps(values, ensure_ascii=False)))
+    else:
+        since = datetime.now() - timedelta(days=args.days)
+        for row in price_cuts(engine, args.municipality, since, limit=args.limit):
+            print("{}\t{}\t{}\t{}".format(
+                row["observed_at"].isoformat(timespec="seconds"), row["hemnet_id"],
+                row["asked_price"], row["price_delta"]))
+
+
+if __name__ == "__main__":
+    main()
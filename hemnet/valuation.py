@@ -0,0 +1,238 @@
+"""Comparable-sales valuation of active listings.
+
+Every active listing of a :mod:`hemnet.snapshot` (no ``sold_date``, with an
+``asked_price`` and living area; only its latest observation) is valued from
+the nearest sold rows (up to ``max_comparables``) of the same type
+(``hemnet.address.type_key``) within ``radius_m``. Each comparable gets a weight that decays with
+distance, size difference, rooms difference and age of the sale; the
+estimate is the weighted mean price per m² and the band is a weighted
+standard deviation scaled by ``z``. Results are upserted into
+``hemnet_valuations``::
+
+    python -m hemnet.valuation snapshot/
+"""
+import argparse
+import time
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+from sqlalchemy.dialects.postgresql import insert
+
+from .address import type_key
+from .geo import GeoIndex
+from .models import HemnetValuation
+from .snapshot import Snapshot, build_snapshot
+
+DEFAULTS = {
+    "radius_m": 1500.0,
+    "max_age_days": 730,
+    "distance_scale_m": 500.0,
+    "size_scale": 0.25,
+    "rooms_scale": 1.0,
+    "age_scale_days": 365.0,
+    "min_comparables": 3,
+    "max_comparables": 50,
+    "z": 1.645,
+}
+
+
+def _price_per_sqm(snapshot):
+    ppsqm = np.array(snapshot["price_per_square_meter"], dtype=np.float64)
+    derived = snapshot["price"] / snapshot["square_meters"]
+    missing = np.isnan(ppsqm) | (ppsqm <= 0)
+    ppsqm[missing] = derived[missing]
+    ppsqm[~np.isfinite(ppsqm) | (ppsqm <= 0)] = np.nan
+    return ppsqm
+
+
+def _type_codes(snapshot):
+    """Snapshot type codes mapped onto one code per canonical type (-1: none)."""
+    canonical = {}
+    codes = [canonical.setdefault(type_key(value), len(canonical))
+             for value in snapshot.dictionaries["type"]]
+    # The trailing -1 maps the "no type" code -1 onto itself.
+    return np.array(codes + [-1], dtype=np.int64)[np.asarray(snapshot["type"])]
+
+
+def _latest_observations(snapshot):
+    """True for the newest row of each hemnet_id (rows are in id order)."""
+    if "hemnet_id" not in snapshot.columns:  # snapshots from before the column
+        return np.ones(len(snapshot), dtype=bool)
+    hemnet_id = np.asarray(snapshot["hemnet_id"])
+    _, first_reversed = np.unique(hemnet_id[::-1], return_index=True)
+    latest = np.zeros(len(hemnet_id), dtype=bool)
+    latest[len(hemnet_id) - 1 - first_reversed] = True
+    return latest | (hemnet_id < 0)
+
+
+def value_listings(snapshot, today=None, chunk_size=10000, log=print, **params):
+    """Value all active listings of ``snapshot``.
+
+    Returns a dict of arrays aligned with ``item_id``. Listings with fewer
+    than ``min_comparables`` comparables get NaN estimates.
+    """
+    p = dict(DEFAULTS, **params)
+    today = np.datetime64(today or date.today(), "D")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ppsqm = _price_per_sqm(snapshot)
+    sold_date = snapshot["sold_date"]
+    sqm = np.asarray(snapshot["square_meters"])
+    rooms = np.asarray(snapshot["rooms"])
+    types = _type_codes(snapshot)
+    age = (today - sold_date).astype(np.float64)
+
+    sold = ~np.isnat(sold_date) & ~np.isnan(ppsqm) & (age <= p["max_age_days"])
+    active = (np.isnat(sold_date) & ~np.isnan(snapshot["asked_price"])
+              & (sqm > 0) & ~np.isnan(snapshot["latitude"])
+              & _latest_observations(snapshot))
+    sold_positions = np.flatnonzero(sold)
+    active_positions = np.flatnonzero(active)
+    # One index per type, so nearest() only ever sees valid comparables.
+    indexes = {}
+    for code in np.unique(types[sold_positions]):
+        positions = sold_positions[types[sold_positions] == code]
+        indexes[code] = GeoIndex(positions, snapshot["latitude"][positions],
+                                 snapshot["longitude"][positions],
+                                 cell_m=min(p["radius_m"], 250.0))
+    lat = snapshot["latitude"]
+    lon = snapshot["longitude"]
+
+    n = len(active_positions)
+    estimate = np.full(n, np.nan)
+    spread = np.full(n, np.nan)
+    count = np.zeros(n, dtype=np.int64)
+    n_eff = np.full(n, np.nan)
+
+    for start in range(0, n, chunk_size):
+        started = time.perf_counter()
+        chunk = active_positions[start:start + chunk_size]
+        owners, comps, meters = [], [], []
+        for offset, position in enumerate(chunk):
+            index = indexes.get(types[position])
+            if index is None:
+                continue
+            found, dist = index.nearest(lat[position], lon[position],
+                                        k=p["max_comparables"],
+                                        max_radius_m=p["radius_m"])
+            owners.append(np.full(len(found), offset, dtype=np.int64))
+            comps.append(found)
+            meters.append(dist)
+        owner = np.concatenate(owners or [np.empty(0, dtype=np.int64)])
+        comp = np.concatenate(comps or [np.empty(0, dtype=np.int64)])
+        dist = np.concatenate(meters or [np.empty(0)])
+
+        # All (listing, comparable) pairs of the chunk are weighted at once.
+        subject = chunk[owner]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            size_diff = np.abs(np.log(sqm[comp] / sqm[subject]))
+        size_diff[~np.isfinite(size_diff)] = 1.0
+        rooms_diff = np.abs(rooms[comp] - rooms[subject])
+        rooms_diff[np.isnan(rooms_diff)] = 1.0
+        weight = np.exp(
+            -dist / p["distance_scale_m"]
+            - size_diff / p["size_scale"]
+            - rooms_diff / p["rooms_scale"]
+            - age[comp] / p["age_scale_days"]
+        )
+        values = ppsqm[comp]
+        size = len(chunk)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            w_sum = np.bincount(owner, weights=weight, minlength=size)
+            w_sq = np.bincount(owner, weights=weight * weight, minlength=size)
+            mean = np.bincount(owner, weights=weight * values, minlength=size) / w_sum
+            var = np.bincount(owner, weights=weight * (values - mean[owner]) ** 2,
+                              minlength=size) / w_sum
+            hits = np.bincount(owner, minlength=size)
+            enough = (hits >= p["min_comparables"]) & (w_sum > 0)
+
+            sl = slice(start, start + size)
+            estimate[sl] = np.where(enough, mean, np.nan)
+            spread[sl] = np.where(enough, np.sqrt(var), np.nan)
+            count[sl] = hits
+            n_eff[sl] = np.where(enough, w_sum * w_sum / w_sq, np.nan)
+        if log:
+            log("valued {} listings ({} with estimate) in {:.2f} s".format(
+                size, int(enough.sum()), time.perf_counter() - started))
+
+    area = sqm[active_positions]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        band = p["z"] * spread * np.sqrt(1 + 1 / n_eff)
+    return {
+        "item_id": np.asarray(snapshot["id"])[active_positions],
+        "asked_price": np.asarray(snapshot["asked_price"])[active_positions],
+        "price_per_sqm": estimate,
+        "estimated_price": estimate * area,
+        "price_low": (estimate - band) * area,
+        "price_high": (estimate + band) * area,
+        "comparables": count,
+        "effective_comparables": n_eff,
+    }
+
+
+def _nullable(value, cast):
+    return None if np.isnan(value) else cast(value)
+
+
+def write_valuations(engine, results, batch_size=5000):
+    """Upsert valuation results in batches; returns the number of rows."""
+    table = HemnetValuation.__table__
+    now = datetime.now()
+    rows = [
+        {
+            "item_id": int(item_id),
+            "valued_at": now,
+            "asked_price": _nullable(asked, int),
+            "price_per_sqm": _nullable(ppsqm, float),
+            "estimated_price": _nullable(price, int),
+            "price_low": _nullable(low, int),
+            "price_high": _nullable(high, int),
+            "comparables": int(count),
+            "effective_comparables": _nullable(n_eff, float),
+        }
+        for item_id, asked, ppsqm, price, low, high, count, n_eff in zip(
+            results["item_id"], results["asked_price"], results["price_per_sqm"],
+            results["estimated_price"], results["price_low"],
+            results["price_high"], results["comparables"],
+            results["effective_comparables"],
+        )
+    ]
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["item_id"],
+        set_={c.name: stmt.excluded[c.name] for c in table.columns
+              if c.name != "item_id"},
+    )
+    with engine.begin() as conn:
+        for start in range(0, len(rows), batch_size):
+            conn.execute(stmt, rows[start:start + batch_size])
+    return len(rows)
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("snapshot", help="snapshot directory (built if missing)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild the snapshot from the database first")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    for name, value in DEFAULTS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(value),
+                            default=value)
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    if args.rebuild or not Path(args.snapshot).exists():
+        snapshot = build_snapshot(engine, args.snapshot)
+    else:
+        snapshot = Snapshot.load(args.snapshot)
+    params = {name: getattr(args, name) for name in DEFAULTS}
+    results = value_listings(snapshot, chunk_size=args.chunk_size, **params)
+    written = write_valuations(engine, results)
+    print("{} valuations written".format(written))
+
+
+if __name__ == "__main__":
+    main()
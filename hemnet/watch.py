@@ -0,0 +1,117 @@
+"""Continuous watch mode: new listings within minutes of publication.
+
+``scrapy crawl hemnetspider -a watch=1`` keeps the spider open and re-polls
+the ``published_since`` search sorted newest first. A poll pages only until
+it reaches listings that are already known, so a quiet poll costs one
+request. New listings go out with the highest listing priority (``new``,
+hemnet.priority) and straight through the pipeline. The poll interval adapts
+between ``watch_min`` and ``watch_max`` seconds: it halves after a poll that
+found something and grows by half after one that didn't or failed.
+
+Every watched listing records when the poll first saw it, and the pipeline
+stores that with its publication and commit time in hemnet_detections::
+
+    python -m hemnet.watch latency --days 7
+"""
+import argparse
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from sqlalchemy.dialects.postgresql import insert
+
+from .models import HemnetDetection
+
+# Hemnet's "newest first" ordering.
+NEWEST_FIRST = {"by": "creation", "order": "desc"}
+
+# A page with this many known listings ends the poll; a few known ones can be
+# top listings shown above the new ones.
+KNOWN_STOP = 3
+
+
+def newest_first(url):
+    """``url`` sorted by publication, newest first."""
+    return "{}{}{}".format(url, "&" if "?" in url else "?", urlencode(NEWEST_FIRST))
+
+
+class PollInterval(object):
+    """Seconds until the next poll: shorter while listings keep coming."""
+
+    def __init__(self, min_secs=60.0, max_secs=900.0, grow=1.5):
+        self.min_secs = float(min_secs)
+        self.max_secs = float(max(max_secs, min_secs))
+        self.grow = grow
+        self.secs = self.min_secs
+
+    def update(self, found):
+        if found:
+            self.secs = max(self.secs / 2, self.min_secs)
+        else:
+            self.secs = min(self.secs * self.grow, self.max_secs)
+        return self.secs
+
+
+def detection_secs(published_at, detected_at):
+    """Seconds from publication to detection, or None if unknown."""
+    if published_at is None or detected_at is None:
+        return None
+    if published_at.tzinfo is not None:
+        published_at = published_at.astimezone().replace(tzinfo=None)
+    return (detected_at - published_at).total_seconds()
+
+
+def record_detection(session, item, now=None):
+    """Store when a watched listing was published, detected and committed."""
+    detected_at = datetime.fromtimestamp(item["detected_at"])
+    published_at = item.get("published_at")
+    if published_at is not None and published_at.tzinfo is not None:
+        published_at = published_at.astimezone().replace(tzinfo=None)
+    session.execute(insert(HemnetDetection.__table__).values(
+        hemnet_id=item["hemnet_id"],
+        published_at=published_at,
+        detected_at=detected_at,
+        stored_at=now or datetime.now(),
+        detection_secs=detection_secs(published_at, detected_at),
+    ).on_conflict_do_nothing(index_elements=["hemnet_id"]))
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def latency(engine, days=7):
+    """Count, median and p90 of detection and detection-to-commit seconds."""
+    table = HemnetDetection.__table__
+    query = table.select().where(table.c.detected_at > datetime.now() - timedelta(days=days))
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+    summary = {"listings": len(rows)}
+    detect = [row.detection_secs for row in rows if row.detection_secs is not None]
+    store = [(row.stored_at - row.detected_at).total_seconds() for row in rows]
+    for name, values in (("detection", detect), ("commit", store)):
+        if values:
+            summary[name] = (_percentile(values, 0.5), _percentile(values, 0.9))
+    return summary
+
+
+def main(argv=None):
+    from .models import db_connect, create_hemnet_table
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    show = sub.add_parser("latency", help="time from publication to detection and commit")
+    show.add_argument("--days", type=int, default=7)
+    args = parser.parse_args(argv)
+
+    engine = db_connect()
+    create_hemnet_table(engine)
+    summary = latency(engine, args.days)
+    print("listings\t{}".format(summary["listings"]))
+    for name in ("detection", "commit"):
+        if name in summary:
+            print("{}\tmedian {:.0f} s\tp90 {:.0f} s".format(name, *summary[name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+-- Split the wide hemnet_items table into a narrow hot table and cold side
+-- tables (hemnet_item_details, hemnet_item_images).
+--
+-- Run once against an existing database created from the old create.sql:
+--   psql "$DATABASE_URL" -f migrations/001_hot_cold_split.sql
+--
+-- The old columns are dropped at the end; run VACUUM FULL hemnet_items
+-- afterwards to reclaim the space they used.
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS hemnet_item_details (
+    item_id BIGINT PRIMARY KEY REFERENCES hemnet_items(id) ON DELETE CASCADE,
+    description TEXT,
+    verified_bidding JSONB,
+    listing_broker_url VARCHAR,
+    listing_broker_gallery_url VARCHAR,
+    labels JSONB,
+    relevant_amenities JSONB,
+    listing_collection_ids JSONB,
+    breadcrumbs JSONB,
+    ad_targeting JSONB,
+    attachments JSONB,
+    images JSONB,
+    images_preview JSONB,
+    thumbnail JSONB,
+    photo_attribution JSONB,
+    price_change JSONB,
+    upcoming_open_houses JSONB,
+    floor_plan_images JSONB,
+    video_attachment JSONB,
+    three_d_attachment JSONB,
+    energy_classification JSONB,
+    active_package JSONB,
+    seller_package_recommendation JSONB,
+    housing_cooperative JSONB,
+    formatted_land_area VARCHAR,
+    formatted_living_area VARCHAR,
+    formatted_supplemental_area VARCHAR,
+    formatted_floor VARCHAR,
+    raw_listing JSONB,
+    raw_apollo_state JSONB,
+    broker_raw JSONB,
+    broker_agency_raw JSONB
+);
+
+CREATE TABLE IF NOT EXISTS hemnet_item_images (
+    item_id BIGINT PRIMARY KEY REFERENCES hemnet_items(id) ON DELETE CASCADE,
+    main_image_url VARCHAR,
+    main_image_bytes BYTEA,
+    main_image_mime VARCHAR,
+    floorplan_image_url VARCHAR,
+    floorplan_image_bytes BYTEA,
+    floorplan_image_mime VARCHAR
+);
+
+INSERT INTO hemnet_item_details (
+  item_id,
+  description,
+  verified_bidding,
+  listing_broker_url,
+  listing_broker_gallery_url,
+  labels,
+  relevant_amenities,
+  listing_collection_ids,
+  breadcrumbs,
+  ad_targeting,
+  attachments,
+  images,
+  images_preview,
+  thumbnail,
+  photo_attribution,
+  price_change,
+  upcoming_open_houses,
+  floor_plan_images,
+  video_attachment,
+  three_d_attachment,
+  energy_classification,
+  active_package,
+  seller_package_recommendation,
+  housing_cooperative,
+  formatted_land_area,
+  formatted_living_area,
+  formatted_supplemental_area,
+  formatted_floor,
+  raw_listing,
+  raw_apollo_state,
+  broker_raw,
+  broker_agency_raw
+)
+SELECT
+  id,
+  description,
+  verified_bidding,
+  listing_broker_url,
+  listing_broker_gallery_url,
+  labels,
+  relevant_amenities,
+  listing_collection_ids,
+  breadcrumbs,
+  ad_targeting,
+  attachments,
+  images,
+  images_preview,
+  thumbnail,
+  photo_attribution,
+  price_change,
+  upcoming_open_houses,
+  floor_plan_images,
+  video_attachment,
+  three_d_attachment,
+  energy_classification,
+  active_package,
+  seller_package_recommendation,
+  housing_cooperative,
+  formatted_land_area,
+  formatted_living_area,
+  formatted_supplemental_area,
+  formatted_floor,
+  raw_listing,
+  raw_apollo_state,
+  broker_raw,
+  broker_agency_raw
+FROM
+  hemnet_items
+ON CONFLICT (item_id) DO NOTHING;
+
+INSERT INTO hemnet_item_images (
+  item_id,
+  main_image_url,
+  main_image_bytes,
+  main_image_mime,
+  floorplan_image_url,
+  floorplan_image_bytes,
+  floorplan_image_mime
+)
+SELECT
+  id,
+  main_image_url,
+  main_image_bytes,
+  main_image_mime,
+  floorplan_image_url,
+  floorplan_image_bytes,
+  floorplan_image_mime
+FROM
+  hemnet_items
+WHERE
+  main_image_bytes IS NOT NULL
+  OR floorplan_image_bytes IS NOT NULL
+  OR main_image_url IS NOT NULL
+  OR floorplan_image_url IS NOT NULL
+ON CONFLICT (item_id) DO NOTHING;
+
+ALTER TABLE hemnet_items
+  DROP COLUMN description,
+  DROP COLUMN verified_bidding,
+  DROP COLUMN listing_broker_url,
+  DROP COLUMN listing_broker_gallery_url,
+  DROP COLUMN labels,
+  DROP COLUMN relevant_amenities,
+  DROP COLUMN listing_collection_ids,
+  DROP COLUMN breadcrumbs,
+  DROP COLUMN ad_targeting,
+  DROP COLUMN attachments,
+  DROP COLUMN images,
+  DROP COLUMN images_preview,
+  DROP COLUMN thumbnail,
+  DROP COLUMN photo_attribution,
+  DROP COLUMN price_change,
+  DROP COLUMN upcoming_open_houses,
+  DROP COLUMN floor_plan_images,
+  DROP COLUMN video_attachment,
+  DROP COLUMN three_d_attachment,
+  DROP COLUMN energy_classification,
+  DROP COLUMN active_package,
+  DROP COLUMN seller_package_recommendation,
+  DROP COLUMN housing_cooperative,
+  DROP COLUMN formatted_land_area,
+  DROP COLUMN formatted_living_area,
+  DROP COLUMN formatted_supplemental_area,
+  DROP COLUMN formatted_floor,
+  DROP COLUMN raw_listing,
+  DROP COLUMN raw_apollo_state,
+  DROP COLUMN broker_raw,
+  DROP COLUMN broker_agency_raw,
+  DROP COLUMN main_image_url,
+  DROP COLUMN main_image_bytes,
+  DROP COLUMN main_image_mime,
+  DROP COLUMN floorplan_image_url,
+  DROP COLUMN floorplan_image_bytes,
+  DROP COLUMN floorplan_image_mime;
+
+COMMIT;
@@ -0,0 +1,108 @@
+-- Convert hemnet_items and hemnet_comp_items into tables range-partitioned by
+-- month, with BRIN indexes on the time columns.
+--
+--   hemnet_items       partitioned by sold_date (active listings without a
+--                      sold_date go to hemnet_items_undated)
+--   hemnet_comp_items  partitioned by collected_at
+--
+-- Run after 001_hot_cold_split.sql:
+--   psql "$DATABASE_URL" -f migrations/002_partition_by_month.sql
+-- and set HEMNET_PARTITIONED=1 so the pipeline creates new month partitions
+-- on write. Old months can be detached with `python -m hemnet.partitions`.
+--
+-- A partitioned table cannot have a primary key or foreign key target that
+-- leaves out the partition key, so `id` becomes a plain indexed column and the
+-- cold tables lose their foreign keys to hemnet_items.
+BEGIN;
+
+ALTER TABLE hemnet_item_details DROP CONSTRAINT IF EXISTS hemnet_item_details_item_id_fkey;
+
+ALTER TABLE hemnet_item_images DROP CONSTRAINT IF EXISTS hemnet_item_images_item_id_fkey;
+
+-- hemnet_items -----------------------------------------------------------
+ALTER TABLE hemnet_items RENAME TO hemnet_items_unpartitioned;
+
+CREATE TABLE hemnet_items (
+  LIKE hemnet_items_unpartitioned INCLUDING DEFAULTS
+) PARTITION BY RANGE (sold_date);
+
+ALTER SEQUENCE hemnet_items_id_seq OWNED BY hemnet_items.id;
+
+CREATE TABLE hemnet_items_undated PARTITION OF hemnet_items DEFAULT;
+
+DO $$
+DECLARE
+  m date;
+BEGIN
+  FOR m IN
+    SELECT DISTINCT date_trunc('month', sold_date)::date
+    FROM hemnet_items_unpartitioned
+    WHERE sold_date IS NOT NULL
+  LOOP
+    EXECUTE format(
+      'CREATE TABLE %I PARTITION OF hemnet_items FOR VALUES FROM (%L) TO (%L)',
+      'hemnet_items_' || to_char(m, 'YYYY_MM'),
+      m,
+      (m + interval '1 month')::date
+    );
+  END LOOP;
+END $$;
+
+INSERT INTO hemnet_items SELECT * FROM hemnet_items_unpartitioned;
+
+DROP TABLE hemnet_items_unpartitioned;
+
+CREATE INDEX ix_hemnet_items_id ON hemnet_items (id);
+
+CREATE INDEX ix_hemnet_items_hemnet_id ON hemnet_items (hemnet_id);
+
+CREATE INDEX ix_hemnet_items_broker_email ON hemnet_items (broker_email);
+
+CREATE INDEX hemnet_items_sold_date_brin ON hemnet_items USING BRIN (sold_date);
+
+CREATE INDEX hemnet_items_collected_at_brin ON hemnet_items USING BRIN (collected_at);
+
+-- hemnet_comp_items ------------------------------------------------------
+ALTER TABLE hemnet_comp_items RENAME TO hemnet_comp_items_unpartitioned;
+
+CREATE TABLE hemnet_comp_items (
+  LIKE hemnet_comp_items_unpartitioned INCLUDING DEFAULTS
+) PARTITION BY RANGE (collected_at);
+
+ALTER SEQUENCE hemnet_comp_items_id_seq OWNED BY hemnet_comp_items.id;
+
+CREATE TABLE hemnet_comp_items_undated PARTITION OF hemnet_comp_items DEFAULT;
+
+DO $$
+DECLARE
+  m date;
+BEGIN
+  FOR m IN
+    SELECT DISTINCT date_trunc('month', collected_at)::date
+    FROM hemnet_comp_items_unpartitioned
+    WHERE collected_at IS NOT NULL
+  LOOP
+    EXECUTE format(
+      'CREATE TABLE %I PARTITION OF hemnet_comp_items FOR VALUES FROM (%L) TO (%L)',
+      'hemnet_comp_items_' || to_char(m, 'YYYY_MM'),
+      m,
+      (m + interval '1 month')::date
+    );
+  END LOOP;
+END $$;
+
+INSERT INTO hemnet_comp_items SELECT * FROM hemnet_comp_items_unpartitioned;
+
+DROP TABLE hemnet_comp_items_unpartitioned;
+
+CREATE INDEX ix_hemnet_comp_items_id ON hemnet_comp_items (id);
+
+CREATE INDEX ix_hemnet_comp_items_salda_id ON hemnet_comp_items (salda_id);
+
+CREATE INDEX ix_hemnet_comp_items_hemnet_id ON hemnet_comp_items (hemnet_id);
+
+CREATE INDEX hemnet_comp_items_collected_at_brin ON hemnet_comp_items USING BRIN (collected_at);
+
+CREATE INDEX hemnet_comp_items_publication_date_brin ON hemnet_comp_items USING BRIN (publication_date);
+
+COMMIT;
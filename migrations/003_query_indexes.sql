@@ -0,0 +1,39 @@
+-- Indexes for the filter and aggregate patterns used in queries.sql.
+--
+--   psql "$DATABASE_URL" -f migrations/003_query_indexes.sql
+--
+-- Works on both the plain and the partitioned (002) layout. Check the result
+-- with `python explain_queries.py`, which flags statements that still scan
+-- hemnet_items sequentially.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Superseded by ix_hemnet_items_broker_email_sold_date_price.
+DROP INDEX IF EXISTS ix_hemnet_items_broker_email;
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_hemnet_id ON hemnet_items (hemnet_id);
+
+-- Broker aggregates (top seller, objects sold per area and period) and the
+-- same-name/different-email self join.
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_broker_email_sold_date_price ON hemnet_items (broker_email, sold_date, price);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_broker_name_email ON hemnet_items (broker_name, broker_email);
+
+-- ORDER BY sold_date / price ... LIMIT and rooms BETWEEN filters.
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_sold_date ON hemnet_items (sold_date);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_price ON hemnet_items (price);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_rooms ON hemnet_items (rooms);
+
+-- Substring search: geographic_area LIKE '%Göteborg%', address LIKE '%...%'.
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_geographic_area_trgm ON hemnet_items USING GIN (geographic_area gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_address_trgm ON hemnet_items USING GIN (address gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_comp_items_salda_id ON hemnet_comp_items (salda_id);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_comp_items_hemnet_id ON hemnet_comp_items (hemnet_id);
+
+ANALYZE hemnet_items;
+
+ANALYZE hemnet_comp_items;
@@ -0,0 +1,35 @@
+-- Broker and area rollup tables. After creating them, fill them from the
+-- existing data with `python -m hemnet.rollups rebuild`.
+--
+--   psql "$DATABASE_URL" -f migrations/004_rollups.sql
+CREATE TABLE IF NOT EXISTS hemnet_broker_rollups (
+    broker_email VARCHAR NOT NULL,
+    broker_firm VARCHAR NOT NULL,
+    type VARCHAR NOT NULL,
+    week DATE NOT NULL,
+    items INTEGER NOT NULL DEFAULT 0,
+    price_total BIGINT NOT NULL DEFAULT 0,
+    priced_items INTEGER NOT NULL DEFAULT 0,
+    asked_price_total BIGINT NOT NULL DEFAULT 0,
+    asked_priced_items INTEGER NOT NULL DEFAULT 0,
+    square_meters_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_items INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (broker_email, broker_firm, type, week)
+);
+
+CREATE TABLE IF NOT EXISTS hemnet_area_rollups (
+    municipality_name VARCHAR NOT NULL,
+    geographic_area VARCHAR NOT NULL,
+    type VARCHAR NOT NULL,
+    week DATE NOT NULL,
+    items INTEGER NOT NULL DEFAULT 0,
+    price_total BIGINT NOT NULL DEFAULT 0,
+    priced_items INTEGER NOT NULL DEFAULT 0,
+    asked_price_total BIGINT NOT NULL DEFAULT 0,
+    asked_priced_items INTEGER NOT NULL DEFAULT 0,
+    square_meters_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_total FLOAT NOT NULL DEFAULT 0,
+    price_per_sqm_items INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (municipality_name, geographic_area, type, week)
+);
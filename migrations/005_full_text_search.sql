@@ -0,0 +1,57 @@
+-- Swedish full-text search over listing titles and descriptions.
+--
+--   psql "$DATABASE_URL" -f migrations/005_full_text_search.sql
+--
+-- Adds hemnet_item_details.search_vector, the triggers that keep it current
+-- and its GIN index, and backfills existing rows. Query it with
+-- `python -m hemnet.search` (see hemnet/search.py).
+ALTER TABLE hemnet_item_details ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+CREATE OR REPLACE FUNCTION hemnet_item_search_vector(title TEXT, description TEXT)
+RETURNS TSVECTOR LANGUAGE SQL IMMUTABLE AS $$
+    SELECT setweight(to_tsvector('swedish', coalesce(title, '')), 'A')
+        || setweight(to_tsvector('swedish', coalesce(description, '')), 'B')
+$$;
+
+CREATE OR REPLACE FUNCTION hemnet_item_details_search() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.search_vector := hemnet_item_search_vector(
+        (SELECT title FROM hemnet_items WHERE id = NEW.item_id),
+        NEW.description
+    );
+    RETURN NEW;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION hemnet_items_title_search() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE hemnet_item_details
+    SET search_vector = hemnet_item_search_vector(NEW.title, description)
+    WHERE item_id = NEW.id;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS hemnet_item_details_search ON hemnet_item_details;
+
+CREATE TRIGGER hemnet_item_details_search
+    BEFORE INSERT OR UPDATE OF description ON hemnet_item_details
+    FOR EACH ROW EXECUTE FUNCTION hemnet_item_details_search();
+
+DROP TRIGGER IF EXISTS hemnet_items_title_search ON hemnet_items;
+
+CREATE TRIGGER hemnet_items_title_search
+    AFTER UPDATE OF title ON hemnet_items
+    FOR EACH ROW WHEN (OLD.title IS DISTINCT FROM NEW.title)
+    EXECUTE FUNCTION hemnet_items_title_search();
+
+UPDATE hemnet_item_details AS d
+SET search_vector = hemnet_item_search_vector(i.title, d.description)
+FROM hemnet_items AS i
+WHERE i.id = d.item_id;
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_item_details_search_vector ON hemnet_item_details USING GIN (search_vector);
+
+ANALYZE hemnet_item_details;
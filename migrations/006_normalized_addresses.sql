@@ -0,0 +1,20 @@
+-- Normalized address columns on hemnet_items and their lookup indexes.
+--
+--   psql "$DATABASE_URL" -f migrations/006_normalized_addresses.sql
+--   python -m hemnet.address backfill
+--
+-- New rows get the columns from AddressPipeline; the backfill normalizes rows
+-- stored before this migration.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE hemnet_items ADD COLUMN IF NOT EXISTS address_street VARCHAR;
+
+ALTER TABLE hemnet_items ADD COLUMN IF NOT EXISTS address_number VARCHAR;
+
+ALTER TABLE hemnet_items ADD COLUMN IF NOT EXISTS address_unit VARCHAR;
+
+ALTER TABLE hemnet_items ADD COLUMN IF NOT EXISTS address_key VARCHAR;
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_address_key ON hemnet_items (address_key);
+
+CREATE INDEX IF NOT EXISTS ix_hemnet_items_address_key_trgm ON hemnet_items USING GIN (address_key gin_trgm_ops);
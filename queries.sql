@@ -127,6 +127,16 @@ WHERE
   AND sold_date > '2012-01-01'
   AND hemnet_items.geographic_area LIKE '%Göteborg%';
 
+-- Same, as an index lookup on the normalized address (hemnet/address.py)
+SELECT
+  AVG(price_per_square_meter)
+FROM
+  hemnet_items
+WHERE
+  address_key = 'andra langgatan 28'
+  AND sold_date > '2012-01-01'
+  AND geographic_area LIKE '%Göteborg%';
+
 SELECT
   *
 FROM
@@ -149,4 +159,47 @@ FROM
 SELECT
   DISTINCT type
 FROM
-  hemnet_items;
\ No newline at end of file
+  hemnet_items;
+
+-- Top seller, from the weekly rollups
+SELECT
+  broker_email,
+  sum(price_total) AS total,
+  sum(items) AS items
+FROM
+  hemnet_broker_rollups
+GROUP BY
+  broker_email
+ORDER BY
+  total DESC;
+
+-- Average price per square meter per area since 2016, from the weekly rollups
+SELECT
+  geographic_area,
+  sum(price_per_sqm_total) / NULLIF(sum(price_per_sqm_items), 0) AS avg_price_per_sqm,
+  sum(items) AS items
+FROM
+  hemnet_area_rollups
+WHERE
+  week >= '2016-01-01'
+GROUP BY
+  geographic_area
+ORDER BY
+  items DESC;
+
+-- Final price over asking price per municipality, from linked active/sold records
+SELECT
+  i.municipality_name,
+  avg(l.sold_price::float / l.asked_price) AS avg_final_over_asking,
+  avg(l.days_listed) AS avg_days_listed,
+  count(*) AS sales
+FROM
+  hemnet_listing_links l
+  JOIN hemnet_items i ON i.id = l.active_item_id
+WHERE
+  l.confidence >= 0.9
+  AND l.asked_price > 0
+GROUP BY
+  i.municipality_name
+ORDER BY
+  sales DESC;
@@ -1,9 +1,15 @@
 from __future__ import annotations
 
+import argparse
+import csv
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 
 
 def _load_env_file(path: Path) -> None:
@@ -30,7 +36,133 @@ def _load_statements(path: Path) -> list[str]:
     return [stmt.strip() for stmt in cleaned.split(";") if stmt.strip()]
 
 
+def _is_read_only(statement: str) -> bool:
+    return statement.split(None, 1)[0].lower() in ("select", "with")
+
+
+def _batches(statements: list[str]) -> list[list[tuple[int, str]]]:
+    """Group consecutive SELECTs so they can run in parallel; anything else runs alone."""
+    batches: list[list[tuple[int, str]]] = []
+    current: list[tuple[int, str]] = []
+    for index, statement in enumerate(statements, start=1):
+        if _is_read_only(statement):
+            current.append((index, statement))
+            continue
+        if current:
+            batches.append(current)
+            current = []
+        batches.append([(index, statement)])
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _plain(value):
+    if isinstance(value, (bytes, memoryview)):
+        return f"<{len(value)} bytes>"
+    return value
+
+
+class _ResultWriter:
+    def __init__(self, path: Path, fmt: str, columns: list[str]):
+        self.columns = columns
+        self.fmt = fmt
+        self.handle = path.open("w", encoding="utf-8", newline="")
+        if fmt == "csv":
+            self.writer = csv.writer(self.handle)
+            self.writer.writerow(columns)
+
+    def write(self, row) -> None:
+        values = [_plain(value) for value in row]
+        if self.fmt == "csv":
+            self.writer.writerow(values)
+        else:
+            record = dict(zip(self.columns, values))
+            self.handle.write(json.dumps(record, default=str, ensure_ascii=False) + "\n")
+
+    def close(self) -> None:
+        self.handle.close()
+
+
+def _run_statement(pool, index: int, statement: str, args) -> dict:
+    result = {"index": index, "rows": 0, "truncated": False, "path": None, "plan": None}
+    connection = pool.getconn()
+    started = time.perf_counter()
+    try:
+        if args.explain:
+            with connection.cursor() as cursor:
+                cursor.execute(f"EXPLAIN {statement}")
+                result["plan"] = "\n".join(line for line, in cursor.fetchall())
+            connection.rollback()
+            started = time.perf_counter()
+
+        if not _is_read_only(statement):
+            with connection.cursor() as cursor:
+                cursor.execute(statement)
+            connection.commit()
+            return result
+
+        # Named cursors stream from the server instead of buffering every row.
+        with connection.cursor(name=f"query_{index}") as cursor:
+            cursor.itersize = args.batch_size
+            cursor.execute(statement)
+            writer = None
+            try:
+                while True:
+                    remaining = args.limit - result["rows"] if args.limit else args.batch_size
+                    rows = cursor.fetchmany(min(args.batch_size, remaining))
+                    if writer is None:
+                        columns = [col.name for col in cursor.description or []]
+                        path = args.out_dir / f"query_{index:02d}.{args.format}"
+                        writer = _ResultWriter(path, args.format, columns)
+                        result["path"] = path
+                    for row in rows:
+                        writer.write(row)
+                    result["rows"] += len(rows)
+                    if len(rows) < min(args.batch_size, remaining):
+                        break
+                    if args.limit and result["rows"] >= args.limit:
+                        result["truncated"] = cursor.fetchone() is not None
+                        break
+            finally:
+                if writer is not None:
+                    writer.close()
+        connection.rollback()
+        return result
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        result["seconds"] = time.perf_counter() - started
+        pool.putconn(connection)
+
+
+def _report(result: dict, statement: str) -> None:
+    summary = " ".join(statement.split())
+    print(f"\n-- Query {result['index']} ------------------------------")
+    print(summary if len(summary) <= 200 else summary[:197] + "...")
+    if result["plan"]:
+        print(result["plan"])
+    if result["path"] is None:
+        print(f"OK ({result['seconds'] * 1000:.1f} ms)")
+        return
+    more = "+" if result["truncated"] else ""
+    print(f"Rows: {result['rows']}{more} ({result['seconds'] * 1000:.1f} ms) -> {result['path']}")
+
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the statements in queries.sql.")
+    parser.add_argument("--sql", default=None, help="queries file (default: queries.sql)")
+    parser.add_argument("--out-dir", default="query_results", help="directory for result files")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument(
+        "--limit", type=int, default=1000, help="max rows written per statement (0 = no limit)"
+    )
+    parser.add_argument("--batch-size", type=int, default=2000, help="rows fetched per round trip")
+    parser.add_argument("--workers", type=int, default=4, help="statements run in parallel")
+    parser.add_argument("--explain", action="store_true", help="print the plan for each statement")
+    args = parser.parse_args()
+
     base_dir = Path(__file__).resolve().parent
     _load_env_file(Path(os.getenv("ENV_FILE", "")) if os.getenv("ENV_FILE") else base_dir / ".env")
 
@@ -38,31 +170,35 @@ def main() -> None:
     if not database_url:
         raise SystemExit("Missing DATABASE_URL. Set it in the environment or .env.")
 
-    sql_path = base_dir / "queries.sql"
+    sql_path = Path(args.sql) if args.sql else base_dir / "queries.sql"
     if not sql_path.exists():
         raise SystemExit(f"Missing queries file: {sql_path}")
 
     statements = _load_statements(sql_path)
     if not statements:
-        raise SystemExit("No SQL statements found in queries.sql.")
-
-    connection = psycopg2.connect(database_url)
-    connection.autocommit = True
-    with connection:
-        with connection.cursor() as cursor:
-            for index, statement in enumerate(statements, start=1):
-                print(f"\n-- Query {index} ------------------------------")
-                print(statement)
-                cursor.execute(statement)
-                if cursor.description:
-                    rows = cursor.fetchall()
-                    print(f"Rows: {len(rows)}")
-                    columns = [col.name for col in cursor.description]
-                    for row in rows:
-                        record = dict(zip(columns, row))
-                        print(record)
-                else:
-                    print("OK")
+        raise SystemExit(f"No SQL statements found in {sql_path.name}.")
+
+    args.out_dir = Path(args.out_dir)
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    workers = max(1, args.workers)
+
+    pool = ThreadedConnectionPool(1, workers, database_url)
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch in _batches(statements):
+                futures = [
+                    executor.submit(_run_statement, pool, index, statement, args)
+                    for index, statement in batch
+                ]
+                for (index, statement), future in zip(batch, futures):
+                    try:
+                        _report(future.result(), statement)
+                    except psycopg2.Error as exc:
+                        print(f"\n-- Query {index} failed: {exc}".rstrip())
+    finally:
+        pool.closeall()
+    print(f"\n{len(statements)} statements in {time.perf_counter() - started:.2f} s")
 
 
 if __name__ == "__main__":
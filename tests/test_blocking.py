@@ -0,0 +1,79 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+
+from hemnet.blocking import RetryQueue
+from hemnet.models import CrawlRetryEntry, create_hemnet_table
+
+SPIDER = SimpleNamespace(name="testspider")
+
+
+class RecordingEngine(object):
+    """Compiles what RetryQueue executes for PostgreSQL instead of running it."""
+
+    def __init__(self, result=0):
+        self.result = result
+        self.statements = []
+
+    def connect(self):
+        return self
+
+    begin = connect
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, *args):
+        self.statements.append(str(statement.compile(dialect=postgresql.dialect())))
+        return SimpleNamespace(scalar=lambda: self.result)
+
+
+def test_pending_counts_waiting_rows_in_database_time():
+    engine = RecordingEngine(result=3)
+    assert RetryQueue(engine, fingerprint=None).pending(SPIDER, 60) == 3
+    sql, = engine.statements
+    assert sql.startswith("SELECT count(*)")
+    assert "now() +" in sql
+
+
+@pytest.mark.skipif(not os.getenv("HEMNET_TEST_DATABASE_URL"),
+                    reason="needs HEMNET_TEST_DATABASE_URL (a scratch PostgreSQL database)")
+def test_pending_against_postgres():
+    engine = create_engine(os.environ["HEMNET_TEST_DATABASE_URL"])
+    create_hemnet_table(engine)
+    table = CrawlRetryEntry.__table__
+    with engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.spider == SPIDER.name))
+        conn.execute(table.insert(), [
+            {"spider": SPIDER.name, "fingerprint": name, "url": "https://example.com",
+             "request": b"", "state": state,
+             "next_attempt_at": text_time}
+            for name, state, text_time in (
+                ("due", "waiting", "now"),
+                ("later", "waiting", "infinity"),
+                ("gave-up", "failed", "now"),
+            )
+        ])
+    queue = RetryQueue(engine, fingerprint=None)
+    try:
+        assert queue.pending(SPIDER, 60) == 1
+    finally:
+        with engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.spider == SPIDER.name))
+
+
+def test_push_schedules_in_database_time():
+    import scrapy
+
+    engine = RecordingEngine()
+    queue = RetryQueue(engine, fingerprint=lambda request: "fp")
+    assert queue.push(scrapy.Request("https://www.hemnet.se/bostad/1"),
+                      scrapy.Spider(SPIDER.name), "blocked") == 1
+    sql, = engine.statements
+    assert "(now() + %(now_1)s)" in sql